@@ -8,6 +8,8 @@
 import logging
 import operator
 import sys
+import threading
+import time
 import types
 
 import mixminion.Crypto as Crypto
@@ -23,7 +25,9 @@ if sys.version_info[:3] < (2,2,0):
 
 __all__ = ['buildForwardPacket', 'buildEncryptedForwardPacket',
            'buildReplyPacket', 'buildReplyBlock', 'checkPathLength',
-           'encodeMessage', 'decodePayload', 'getNPacketsToEncode' ]
+           'encodeMessage', 'decodePayload', 'getNPacketsToEncode',
+           'HeaderPool', 'PayloadDecoder', 'PrebuiltHeaders',
+           'prebuildForwardHeaders' ]
 
 
 log = logging.getLogger(__name__)
@@ -361,6 +365,230 @@ def checkPathLength(path1, path2, exitType, exitInfo, explicitSwap=0,
         raise UIError("Address and %s leg of path will not fit in one header"
                       % ["first", "second"][err-1])
 
+#----------------------------------------------------------------------
+# PRECOMPUTED HEADERS
+
+def prebuildForwardHeaders(exitType, exitInfo, path1, path2,
+                           paddingPRNG=None, suppressTag=0):
+    """Construct everything about a forward packet that doesn't depend on
+       its payload: the secrets for every hop, and both headers.  Takes the
+       same arguments as buildForwardPacket, and returns a PrebuiltHeaders
+       object whose buildPacket method can turn any payload into a packet.
+
+       This is where nearly all the work of building a forward packet goes
+       (one RSA encryption per hop), so it can be done ahead of time, when
+       the caller would otherwise be idle.
+    """
+    if paddingPRNG is None:
+        paddingPRNG = Crypto.getCommonPRNG()
+    if not path1:
+        raise MixError("First leg of path is empty")
+    if not path2:
+        raise MixError("Second leg of path is empty")
+
+    if not suppressTag:
+        exitInfo = _getRandomTag(paddingPRNG) + exitInfo
+    secrets1, secrets2, header1, header2 = _buildPacket(
+        None, exitType, exitInfo, path1, path2, paddingPRNG,
+        suppressTag=suppressTag)
+    return PrebuiltHeaders(path1, path2, secrets1, secrets2, header1, header2)
+
+class PrebuiltHeaders:
+    """A PrebuiltHeaders holds a pair of headers and the secrets used to
+       build them, ready to be combined with a payload.  Each one must be
+       used for at most one packet: reusing the secrets would make two
+       packets linkable.
+
+       Fields:
+           path1, path2: The legs of the path, as lists of ServerInfo.
+           validAfter, validUntil: The interval over which every server on
+               the path has a valid packet key.
+       """
+    ## Fields:
+    # _secrets1, _secrets2, _header1, _header2: As for _constructMessage.
+    def __init__(self, path1, path2, secrets1, secrets2, header1, header2):
+        self.path1 = path1
+        self.path2 = path2
+        self._secrets1 = secrets1
+        self._secrets2 = secrets2
+        self._header1 = header1
+        self._header2 = header2
+        servers = path1 + path2
+        self.validAfter = max([ s.getValidAfter() for s in servers ])
+        self.validUntil = min([ s.getValidUntil() for s in servers ])
+
+    def isValidFrom(self, startAt, endAt):
+        """Return true iff every server on our path is valid for the whole
+           interval from startAt to endAt."""
+        return self.validAfter <= startAt and endAt <= self.validUntil
+
+    def buildPacket(self, payload):
+        """Return a packet delivering 'payload' (which must be exactly 28K)
+           along our path."""
+        return _constructMessage(self._secrets1, self._secrets2,
+                                 self._header1, self._header2, payload)
+
+# Default number of PrebuiltHeaders to keep for each destination in a
+# HeaderPool.
+DEFAULT_HEADER_POOL_SIZE = 8
+
+class HeaderPool:
+    """A HeaderPool keeps a supply of PrebuiltHeaders for a set of frequent
+       destinations, so that a long-running client can send to any of them
+       while paying only for the payload encryption.
+
+       Callers register each destination with addDestination, call refill
+       whenever they would otherwise be idle, and call getHeaders when they
+       have a payload to send.  Headers expire along with the packet keys
+       of the servers on their paths.
+
+       All methods are threadsafe; refill does its expensive work without
+       holding the lock.
+    """
+    ## Fields:
+    # _destinations: map from destination key to a tuple of (exitType,
+    #    exitInfo, suppressTag, generatePaths, size).  Destination keys are
+    #    chosen by the caller.
+    # _pool: map from destination key to list of PrebuiltHeaders, oldest
+    #    first.
+    # _prng: the PRNG used to generate secrets and padding.
+    # _lock: a lock to protect _destinations and _pool.
+    def __init__(self, paddingPRNG=None):
+        """Create a new, empty HeaderPool.  If paddingPRNG is provided, use
+           it to generate secrets and padding."""
+        if paddingPRNG is None:
+            paddingPRNG = Crypto.getCommonPRNG()
+        self._destinations = {}
+        self._pool = {}
+        self._prng = paddingPRNG
+        self._lock = threading.Lock()
+
+    def addDestination(self, key, exitType, exitInfo, generatePaths,
+                       size=DEFAULT_HEADER_POOL_SIZE, suppressTag=0):
+        """Begin keeping up to 'size' PrebuiltHeaders for the destination
+           'key'.
+              exitType, exitInfo, suppressTag -- as for buildForwardPacket.
+              generatePaths -- a function that takes a number n, and returns
+                 a list of n (path1, path2) tuples, chosen according to the
+                 caller's path policy.
+           If we already had a destination with this key, replace it and
+           discard its headers.
+        """
+        self._lock.acquire()
+        try:
+            self._destinations[key] = (exitType, exitInfo, suppressTag,
+                                       generatePaths, size)
+            self._pool[key] = []
+        finally:
+            self._lock.release()
+
+    def removeDestination(self, key):
+        """Stop keeping headers for the destination 'key', and discard any
+           we have."""
+        self._lock.acquire()
+        try:
+            if self._destinations.has_key(key):
+                del self._destinations[key]
+                del self._pool[key]
+        finally:
+            self._lock.release()
+
+    def count(self, key):
+        """Return the number of headers we have for the destination 'key'."""
+        self._lock.acquire()
+        try:
+            return len(self._pool.get(key, []))
+        finally:
+            self._lock.release()
+
+    def expire(self, now=None):
+        """Discard all headers that use a server whose key is no longer
+           valid at 'now'."""
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            for key, headers in self._pool.items():
+                self._pool[key] = [ h for h in headers
+                                    if h.validUntil > now ]
+        finally:
+            self._lock.release()
+
+    def refill(self, now=None, timeLimit=None):
+        """Expire stale headers, then build new ones until every
+           destination has as many as it wants.  If 'timeLimit' is
+           provided, stop after about that many seconds.  Return the number
+           of headers built.
+
+           Destinations whose paths can't be generated or built are
+           skipped until the next call."""
+        if now is None:
+            now = time.time()
+        self.expire(now)
+        if timeLimit is not None:
+            deadline = time.time() + timeLimit
+        nBuilt = 0
+
+        self._lock.acquire()
+        try:
+            todo = []
+            for key, dest in self._destinations.items():
+                n = dest[-1] - len(self._pool[key])
+                if n > 0:
+                    todo.append((key, dest, n))
+        finally:
+            self._lock.release()
+
+        for key, dest, n in todo:
+            exitType, exitInfo, suppressTag, generatePaths, _ = dest
+            try:
+                paths = generatePaths(n)
+            except MixError, e:
+                log.warn("Couldn't generate paths for header pool: %s", e)
+                continue
+            for path1, path2 in paths:
+                if timeLimit is not None and time.time() >= deadline:
+                    return nBuilt
+                try:
+                    h = prebuildForwardHeaders(exitType, exitInfo,
+                                               path1, path2, self._prng,
+                                               suppressTag=suppressTag)
+                except MixError, e:
+                    log.warn("Couldn't build headers for header pool: %s",e)
+                    break
+                self._lock.acquire()
+                try:
+                    # The destination may have been replaced or removed
+                    # while we were working.
+                    if self._destinations.get(key) is not dest:
+                        break
+                    self._pool[key].append(h)
+                finally:
+                    self._lock.release()
+                nBuilt += 1
+
+        return nBuilt
+
+    def getHeaders(self, key, startAt=None, endAt=None):
+        """Remove and return a PrebuiltHeaders for the destination 'key'
+           whose servers are all valid from startAt through endAt.  Return
+           None if we have none."""
+        if startAt is None:
+            startAt = time.time()
+        if endAt is None:
+            endAt = startAt
+        self._lock.acquire()
+        try:
+            headers = self._pool.get(key, [])
+            for i in xrange(len(headers)):
+                if headers[i].isValidFrom(startAt, endAt):
+                    h = headers[i]
+                    del headers[i]
+                    return h
+            return None
+        finally:
+            self._lock.release()
+
 #----------------------------------------------------------------------
 # MESSAGE DECODING
 def decodePayload(payload, tag, key=None, userKeys=(), retNym=None):
@@ -380,52 +608,100 @@ def decodePayload(payload, tag, key=None, userKeys=(), retNym=None):
        If we can successfully decrypt the payload, we return it.  If we
        might be able to decrypt the payload given more/different keys,
        we return None.  If the payload is corrupt, we raise MixError.
-    """
-    if userKeys is None:
-        userKeys = []
-    elif type(userKeys) is types.StringType:
-        userKeys = [ ("", userKeys) ]
-    elif type(userKeys) is types.DictType:
-        userKeys = userKeys.items()
 
-    if len(payload) != PAYLOAD_LEN:
-        raise MixError("Wrong payload length")
-
-    if len(tag) not in (0, TAG_LEN):
-        raise MixError("Wrong tag length: %s"%len(tag))
+       To decode many payloads with the same keys, use a PayloadDecoder.
+    """
+    return PayloadDecoder(key, userKeys).decode(payload, tag, retNym)
+
+class PayloadDecoder:
+    """A PayloadDecoder decodes any number of received payloads with a
+       fixed set of keys.  All per-key work is done once, when the decoder
+       is constructed, so that decoding a whole mailbox costs one
+       validation hash per SURB key per message, plus LIONESS passes only
+       for the keys whose validation hash matches.
+    """
+    ## Fields:
+    # key: an RSA key to decode encrypted forward messages, or None.
+    # _userKeys: a list of (name, userKey+"Validate", userKey+"Generate")
+    #    for each SURB identity.
+    # _tagOwners: map from tag to the index in _userKeys of the identity
+    #    that last decoded a reply with that tag.
+    def __init__(self, key=None, userKeys=()):
+        """Create a new PayloadDecoder.  Arguments are as for
+           decodePayload."""
+        if userKeys is None:
+            userKeys = []
+        elif type(userKeys) is types.StringType:
+            userKeys = [ ("", userKeys) ]
+        elif type(userKeys) is types.DictType:
+            userKeys = userKeys.items()
+
+        self.key = key
+        self._userKeys = [ (name, userKey+"Validate", userKey+"Generate")
+                           for name, userKey in userKeys ]
+        self._tagOwners = {}
+
+    def decode(self, payload, tag, retNym=None):
+        """Given a 28K payload and a 20-byte decoding tag, attempt to
+           decode the original message.  Arguments and return values are
+           as for decodePayload."""
+        if len(payload) != PAYLOAD_LEN:
+            raise MixError("Wrong payload length")
+
+        if len(tag) not in (0, TAG_LEN):
+            raise MixError("Wrong tag length: %s"%len(tag))
+
+        # If the payload already contains a valid checksum, it's a forward
+        # message.
+        if _checkPayload(payload):
+            return parsePayload(payload)
 
-    # If the payload already contains a valid checksum, it's a forward
-    # message.
-    if _checkPayload(payload):
-        return parsePayload(payload)
+        if not tag:
+            return None
 
-    if not tag:
-        return None
+        # If we've already seen this tag (say, because the same reply was
+        # delivered twice), try its owner first.
+        idx = self._tagOwners.get(tag)
+        if idx is not None:
+            p = self._tryUserKey(payload, tag, idx, retNym)
+            if p is not None:
+                return p
 
-    # If H(tag|userKey|"Validate") ends with 0, then the message _might_
-    # be a reply message using H(tag|userKey|"Generate") as the seed for
-    # its master secrets.  (There's a 1-in-256 chance that it isn't.)
-    for name,userKey in userKeys:
-        if Crypto.sha1(tag+userKey+"Validate")[-1] == '\x00':
-            try:
-                p = _decodeStatelessReplyPayload(payload, tag, userKey)
-                if name:
-                    log.info("Decoded reply message to identity %r", name)
-                if retNym is not None:
-                    retNym.append(name)
+        # If H(tag|userKey|"Validate") ends with 0, then the message _might_
+        # be a reply message using H(tag|userKey|"Generate") as the seed for
+        # its master secrets.  (There's a 1-in-256 chance that it isn't.)
+        sha1 = Crypto.sha1
+        for i in xrange(len(self._userKeys)):
+            if i != idx and sha1(tag+self._userKeys[i][1])[-1] == '\x00':
+                p = self._tryUserKey(payload, tag, i, retNym)
+                if p is not None:
+                    return p
+
+        # If we have an RSA key, and none of the above steps get us a good
+        # payload, then we may as well try to decrypt the start of tag+key
+        # with our RSA key.
+        if self.key is not None:
+            p = _decodeEncryptedForwardPayload(payload, tag, self.key)
+            if p is not None:
                 return p
-            except MixError:
-                pass
 
-    # If we have an RSA key, and none of the above steps get us a good
-    # payload, then we may as well try to decrypt the start of tag+key with
-    # our RSA key.
-    if key is not None:
-        p = _decodeEncryptedForwardPayload(payload, tag, key)
-        if p is not None:
-            return p
+        return None
 
-    return None
+    def _tryUserKey(self, payload, tag, idx, retNym):
+        """Helper: try to decode 'payload' as a reply to the idx'th SURB
+           identity.  Return the decoded payload on success, or None on
+           failure."""
+        name, _, generate = self._userKeys[idx]
+        try:
+            p = _decodeStatelessReplyPayload(payload, tag, None, generate)
+        except MixError:
+            return None
+        self._tagOwners[tag] = idx
+        if name:
+            log.info("Decoded reply message to identity %r", name)
+        if retNym is not None:
+            retNym.append(name)
+        return p
 
 def _decodeForwardPayload(payload):
     """Helper function: decode a non-encrypted forward payload. Return values
@@ -485,13 +761,19 @@ def _decodeReplyPayload(payload, secrets, check=0):
 
     return parsePayload(payload)
 
-def _decodeStatelessReplyPayload(payload, tag, userKey):
-    """Decode a (state-carrying) reply payload."""
+def _decodeStatelessReplyPayload(payload, tag, userKey, generate=None):
+    """Decode a (state-carrying) reply payload.  If 'generate' is provided,
+       it must be userKey+"Generate"."""
+    if generate is None:
+        generate = userKey+"Generate"
     # Reconstruct the secrets we used to generate the reply block (possibly
-    # too many)
-    seed = Crypto.sha1(tag+userKey+"Generate")[:16]
-    prng = Crypto.AESCounterPRNG(seed)
-    secrets = [ prng.getBytes(SECRET_LEN) for _ in xrange(17) ]
+    # too many).  This is the start of the keystream that an AESCounterPRNG
+    # seeded with 'seed' would yield; we generate it directly, since the
+    # PRNG would compute a full chunk we'd never use.
+    seed = Crypto.sha1(tag+generate)[:16]
+    stream = Crypto.prng(seed, SECRET_LEN*17)
+    secrets = [ stream[i:i+SECRET_LEN]
+                for i in xrange(0, SECRET_LEN*17, SECRET_LEN) ]
 
     return _decodeReplyPayload(payload, secrets, check=1)
 
@@ -515,6 +797,9 @@ def _buildPacket(payload, exitType, exitInfo,
          OR
              a ReplyBlock object.
 
+    If payload is None, we build the headers but not the packet, and return
+    a tuple of (secrets1, secrets2, header1, header2) for _constructMessage.
+
     The following fields are optional:
        paddingPRNG: A pseudo-random number generator used to pad the headers.
          If not provided, we use a counter-mode AES stream seeded from our
@@ -524,7 +809,7 @@ def _buildPacket(payload, exitType, exitInfo,
          header secrets too.  Otherwise, we read all of our header secrets
          from the true entropy source.
     """
-    assert len(payload) == PAYLOAD_LEN
+    assert payload is None or len(payload) == PAYLOAD_LEN
     reply = None
     if isinstance(path2, ReplyBlock):
         reply = path2
@@ -574,6 +859,8 @@ def _buildPacket(payload, exitType, exitInfo,
     header1 = _buildHeader(path1,secrets1,path1exittype,path1exitinfo,
                            paddingPRNG)
 
+    if payload is None:
+        return secrets1, secrets2, header1, header2
     return _constructMessage(secrets1, secrets2, header1, header2, payload)
 
 def _buildHeader(path,secrets,exitType,exitInfo,paddingPRNG):
@@ -586,97 +873,155 @@ def _buildHeader(path,secrets,exitType,exitInfo,paddingPRNG):
                (Must include 20-byte decoding tag, if any.)
            paddingPRNG: A pseudo-random number generator to generate padding
     """
-    assert len(path) == len(secrets)
+    return HeaderBuilder(path,exitType,exitInfo).buildHeader(secrets,
+                                                             paddingPRNG)
 
-    for info in path:
-        if not info.supportsPacketVersion():
-            raise MixError("Server %s does not support any recognized packet format."%info.getNickname())
+class HeaderBuilder:
+    """A HeaderBuilder holds everything about a header that depends only
+       on its path and exit routing: the routing type and info for each
+       hop, the number of bytes each hop adds, where each hop's junk
+       begins, and each hop's packet key.  Once constructed, it can build
+       any number of headers over that path, each with its own secrets.
 
-    routing, sizes, totalSize = _getRouting(path, exitType, exitInfo)
-    if totalSize > HEADER_LEN:
-        raise MixError("Path cannot fit in header")
-
-    # headerKey[i]==the AES key object node i will use to decrypt the header
-    headerKeys = [ Crypto.Keyset(secret).get(Crypto.HEADER_SECRET_MODE)
-                       for secret in secrets ]
-
-    # Length of padding needed for the header
-    paddingLen = HEADER_LEN - totalSize
-
-    # Calculate junk.
-    #   junkSeen[i]==the junk that node i will see, before it does any
-    #                encryption.   Note that junkSeen[0]=="", because node 0
-    #                sees no junk.
-    junkSeen = [""]
-    for secret, headerKey, size in zip(secrets, headerKeys, sizes):
-        # Here we're calculating the junk that node i+1 will see.
+       Fields:
+           path: A sequence of serverinfo objects.
+           routing: A list of (routingtype, routinginfo) for each hop.
+           sizes: sizes[i] is the number of bytes hop i removes from the
+               header.
+           paddingLen: The number of bytes of random padding at the end
+               of the header.
+       """
+    ## Fields:
+    # _junkStart: _junkStart[i] is the counter index at which hop i begins
+    #    encrypting the junk it has seen.
+    # _junkLen: _junkLen[i] is the total length of the junk that hop i+1
+    #    sees.
+    # _underflow: _underflow[i] is the number of bytes of the header that
+    #    follow subheader i inside its RSA-encrypted part.
+    # _overflow: _overflow[i] is the portion of routing info for hop i
+    #    that doesn't fit in the RSA-encrypted part.
+    # _pubkeys: _pubkeys[i] is the packet key for hop i.
+    def __init__(self, path, exitType, exitInfo):
+        """Create a new HeaderBuilder for a given path and exit.
+           exitType: The routing type for the last node in the header
+           exitInfo: The routing info for the last node in the header.
+               (Must include 20-byte decoding tag, if any.)
+
+           Raises MixError if the path is unusable or won't fit in a
+           header."""
+        for info in path:
+            if not info.supportsPacketVersion():
+                raise MixError("Server %s does not support any recognized packet format."%info.getNickname())
+
+        routing, sizes, totalSize = _getRouting(path, exitType, exitInfo)
+        if totalSize > HEADER_LEN:
+            raise MixError("Path cannot fit in header")
+
+        self.path = path
+        self.routing = routing
+        self.sizes = sizes
+        self.paddingLen = HEADER_LEN - totalSize
+
+        # Before a node encrypts the junk, it has encrypted all the data
+        # and the initial padding, but not the RSA-encrypted part.  This
+        # is equal to - 256 + sum(size[current]...size[last]) + paddingLen,
+        # which simplifies to HEADER_LEN - 256 - len(junk so far).
+        self._junkStart = []
+        self._junkLen = []
+        junkLen = 0
+        for size in sizes:
+            self._junkStart.append(HEADER_LEN - ENC_SUBHEADER_LEN - junkLen)
+            junkLen += size
+            self._junkLen.append(junkLen)
+
+        self._underflow = []
+        self._overflow = []
+        for rt, ri in routing:
+            subhead = Subheader(MAJOR_NO, MINOR_NO, None, None, rt, ri)
+            self._underflow.append(subhead.getUnderflowLength())
+            self._overflow.append(subhead.getOverflow())
+
+        self._pubkeys = [ info.getPacketKey() for info in path ]
+
+    def buildHeader(self, secrets, paddingPRNG):
+        """Construct a single header over this builder's path.
+           secrets: A list of 16-byte strings to use as master-secrets for
+               each of the subheaders.
+           paddingPRNG: A pseudo-random number generator to generate padding
+        """
+        nHops = len(self.path)
+        assert len(secrets) == nHops
+
+        # headerKeys[i]==the AES key object node i will use to decrypt the
+        # header.  We expand each key schedule exactly once, since we use
+        # it both for the junk and for the header itself.
+        headerKeys = [None] * nHops
+        junkKeys = [None] * nHops
+        for i in xrange(nHops):
+            ks = Crypto.Keyset(secrets[i])
+            headerKeys[i] = Crypto.aes_key(ks.get(Crypto.HEADER_SECRET_MODE))
+            junkKeys[i] = ks.get(Crypto.RANDOM_JUNK_MODE)
+
+        # Calculate junk.
+        #   junkSeen[i]==the junk that node i will see, before it does any
+        #                encryption.   Note that junkSeen[0]=="", because node 0
+        #                sees no junk.
         #
-        # Node i+1 sees the junk that node i saw, plus the junk that i appends,
-        # all encrypted by i.
-
-        prngKey = Crypto.Keyset(secret).get(Crypto.RANDOM_JUNK_MODE)
-
-        # newJunk is the junk that node i will append. (It's as long as
-        #   the data that i removes.)
-        newJunk = Crypto.prng(prngKey,size)
-        lastJunk = junkSeen[-1]
-        nextJunk = lastJunk + newJunk
-
-        # Before we encrypt the junk, we'll encrypt all the data, and
-        # all the initial padding, but not the RSA-encrypted part.
-        #    This is equal to - 256
-        #                     + sum(size[current]....size[last])
-        #                     + paddingLen
-        #    This simplifies to:
-        #startIdx = paddingLen - 256 + totalSize - len(lastJunk)
-        startIdx = HEADER_LEN - ENC_SUBHEADER_LEN - len(lastJunk)
-        nextJunk = Crypto.ctr_crypt(nextJunk, headerKey, startIdx)
-        junkSeen.append(nextJunk)
-
-    # We start with the padding.
-    header = paddingPRNG.getBytes(paddingLen)
-
-    # Now, we build the subheaders, iterating through the nodes backwards.
-    for i in range(len(path)-1, -1, -1):
-        rt, ri = routing[i]
-
-        # Create a subheader object for this node, but don't fill in the
-        # digest until we've constructed the rest of the header.
-        subhead = Subheader(MAJOR_NO, MINOR_NO,
-                            secrets[i],
-                            None, #placeholder for as-yet-uncalculated digest
-                            rt, ri)
-
-        # Do we need to include some of the remaining header in the
-        # RSA-encrypted portion?
-        underflowLength = subhead.getUnderflowLength()
-        if underflowLength > 0:
-            underflow = header[:underflowLength]
-            header = header[underflowLength:]
-        else:
-            underflow = ""
-
-        # Do we need to spill some of the routing info out from the
-        # RSA-encrypted portion?  If so, prepend it.
-        header = subhead.getOverflow() + header
-
-        # Encrypt the symmetrically encrypted part of the header
-        header = Crypto.ctr_crypt(header, headerKeys[i])
-
-        # What digest will the next server see?
-        subhead.digest = Crypto.sha1(header+junkSeen[i])
-
-        # Encrypt the subheader, plus whatever portion of the previous header
-        # underflows, into 'esh'.
-        pubkey = path[i].getPacketKey()
-        rsaPart = subhead.pack() + underflow
-        esh = Crypto.pk_encrypt(rsaPart, pubkey)
-
-        # Concatenate the asymmetric and symmetric parts, to get the next
-        # header.
-        header = esh + header
-
-    return header
+        # Node i+1 sees the junk that node i saw, plus the junk that i
+        # appends, all encrypted by i.  The junk that i appends is as long
+        # as the data that i removes, so we can generate the plaintext
+        # junk for every node in a single buffer up front.
+        junkSeen = [None] * (nHops+1)
+        junkSeen[0] = ""
+        newJunk = "".join([ Crypto.prng(junkKeys[i], self.sizes[i])
+                            for i in xrange(nHops) ])
+        lastLen = 0
+        for i in xrange(nHops):
+            junkLen = self._junkLen[i]
+            junkSeen[i+1] = Crypto.ctr_crypt(
+                junkSeen[i]+newJunk[lastLen:junkLen], headerKeys[i],
+                self._junkStart[i])
+            lastLen = junkLen
+
+        # We start with the padding.
+        header = paddingPRNG.getBytes(self.paddingLen)
+
+        # Now, we build the subheaders, iterating through the nodes backwards.
+        for i in xrange(nHops-1, -1, -1):
+            rt, ri = self.routing[i]
+
+            # Do we need to include some of the remaining header in the
+            # RSA-encrypted portion?
+            underflowLength = self._underflow[i]
+            if underflowLength > 0:
+                underflow = header[:underflowLength]
+                header = header[underflowLength:]
+            else:
+                underflow = ""
+
+            # Do we need to spill some of the routing info out from the
+            # RSA-encrypted portion?  If so, prepend it; then encrypt the
+            # symmetrically encrypted part of the header.
+            header = Crypto.ctr_crypt(self._overflow[i] + header,
+                                      headerKeys[i])
+
+            # What digest will the next server see?
+            subhead = Subheader(MAJOR_NO, MINOR_NO, secrets[i],
+                                Crypto.sha1(header+junkSeen[i]), rt, ri)
+
+            # Encrypt the subheader, plus whatever portion of the previous
+            # header underflows, and prepend it to get the next header.
+            rsaPart = subhead.pack() + underflow
+            header = Crypto.pk_encrypt(rsaPart, self._pubkeys[i]) + header
+
+        return header
+
+    def buildHeaders(self, secretsList, paddingPRNG):
+        """Construct one header over this builder's path for each list of
+           secrets in secretsList, and return a list of the headers in the
+           same order."""
+        return [ self.buildHeader(secrets, paddingPRNG)
+                 for secrets in secretsList ]
 
 def _constructMessage(secrets1, secrets2, header1, header2, payload):
     """Helper method: Builds a message, given both headers, all known
@@ -14,18 +14,21 @@ __all__ = [ 'ClientDirectory', 'parsePath', 'parseAddress',
 import cPickle
 import errno
 import logging
+import mmap
 import operator
 import os
 import re
 import socket
 import ssl
 import stat
+import struct
 import sys
 import threading
 import time
 import types
 import rfc822
 import urllib2
+import zlib
 
 from httplib import HTTPException
 
@@ -34,10 +37,10 @@ import mixminion.Crypto
 import mixminion.NetUtils
 import mixminion.ServerInfo
 
-from mixminion.Common import MixError, MixFatalError, UIError, \
+from mixminion.Common import IntervalSet, MixError, MixFatalError, UIError, \
      ceilDiv, createPrivateDir, formatDate, formatFnameTime, openUnique, \
      previousMidnight, readPickled, readPossiblyGzippedFile, \
-     replaceFile, tryUnlink, writePickled, floorDiv, isSMTPMailbox
+     replaceFile, tryUnlink, writeFile, writePickled, floorDiv, isSMTPMailbox
 from mixminion.Packet import MBOX_TYPE, SMTP_TYPE, DROP_TYPE, FRAGMENT_TYPE, \
      parseMBOXInfo, parseRelayInfoByType, parseSMTPInfo, ParseError, \
      ServerSideFragmentedMessage
@@ -464,12 +467,105 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
 
     def _downloadDirectoryImpl(self, url, lock=None):
         """Helper function: does the actual work of fetching a directory."""
+        if lock is None:
+            lock = RWLock()
+
+        if isinstance(self.serverDir, mixminion.ServerInfo.ServerDirectory):
+            # If the directory server has a diff from the directory we
+            # have, we only need to fetch the descriptors that are new.
+            try:
+                if self._downloadDirectoryDiff(url, lock):
+                    return
+            except GotInvalidDirectoryError, e:
+                log.warn("%s; downloading the full directory.", e)
+
         log.info("Downloading directory from %s", url)
+        if url.endswith(".gz"):
+            isGzipped = 1
+            tmpname = self.fnameBase + "_new.gz"
+        else:
+            isGzipped = 0
+            tmpname = self.fnameBase + "_new"
+        self._fetchURL(url, tmpname)
+
+        # Open and validate the directory
+        log.info("Validating directory")
+
+        lock.read_in()
+        digestMap = self._s.digestMap.copy()
+        lock.read_out()
+
+        try:
+            directory = mixminion.ServerInfo.parseDirectory(
+                fname=tmpname,
+                validatedDigests=digestMap)
+        except mixminion.Config.ConfigError, e:
+            raise GotInvalidDirectoryError(
+                "Received an invalid directory: %s"%e)
+
+        self._installDirectory(directory, tmpname, isGzipped, lock)
+
+    def _downloadDirectoryDiff(self, url, lock):
+        """Helper function: try to fetch a diff from our current directory
+           to the one at 'url', and use it to rebuild the new directory.
+           Return true on success, or false if no diff was available.
+           Raise GotInvalidDirectoryError if the diff was no good.
+        """
+        oldDir = self.serverDir
+        digest = oldDir['Signature']['DirectoryDigest']
+        for fname in self.fnameBase, self.fnameBase+".gz":
+            if os.path.exists(fname):
+                break
+        else:
+            return 0
+
+        diffURL = mixminion.ServerInfo.getDirectoryDiffLocation(url, digest)
+        if diffURL.endswith(".gz"):
+            tmpname = self.fnameBase + "_diff.gz"
+        else:
+            tmpname = self.fnameBase + "_diff"
+        log.info("Downloading directory diff from %s", diffURL)
+        try:
+            self._fetchURL(diffURL, tmpname)
+        except DirectoryDownloadError, e:
+            log.info("No directory diff available: %s", e)
+            return 0
+
+        log.info("Validating directory")
+        try:
+            try:
+                text = mixminion.ServerInfo.applyDirectoryDiff(
+                    readPossiblyGzippedFile(fname),
+                    readPossiblyGzippedFile(tmpname))
+            finally:
+                tryUnlink(tmpname)
+            known = {}
+            for s in oldDir.getAllServers():
+                known[s.getDigest()] = s
+            lock.read_in()
+            digestMap = self._s.digestMap.copy()
+            lock.read_out()
+            directory = mixminion.ServerInfo.ServerDirectory(
+                string=text, validatedDigests=digestMap, knownServers=known)
+        except (mixminion.Config.ConfigError, IOError, zlib.error), e:
+            raise GotInvalidDirectoryError(
+                "Received an invalid directory diff: %s"%e)
+        if (directory['Directory']['Published'] <=
+            oldDir['Directory']['Published']):
+            raise GotInvalidDirectoryError(
+                "Directory diff led to an out-of-date directory")
+
+        tmpname = self.fnameBase + "_new"
+        writeFile(tmpname, text)
+        self._installDirectory(directory, tmpname, 0, lock)
+        return 1
+
+    def _fetchURL(self, url, outFname):
+        """Helper function: download the contents of 'url' into the file
+           'outFname'.  Raise DirectoryDownloadError on failure."""
         # XXXX Refactor download logic.
         if self.timeout:
             mixminion.NetUtils.setGlobalTimeout(self.timeout)
-        if lock is None:
-            lock = RWLock()
         try:
             try:
                 # Tell HTTP proxies and their ilk not to cache the directory.
@@ -505,15 +601,8 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
             if self.timeout:
                 mixminion.NetUtils.unsetGlobalTimeout()
 
-        if url.endswith(".gz"):
-            isGzipped = 1
-            tmpname = self.fnameBase + "_new.gz"
-        else:
-            isGzipped = 0
-            tmpname = self.fnameBase + "_new"
-
         # Open a temporary output file.
-        outfile = open(tmpname, 'wb')
+        outfile = open(outFname, 'wb')
 
         # Read the file off the network.
         while 1:
@@ -527,21 +616,10 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
         dateHeader = infile.info().get("Date","")
         if dateHeader: self._warnIfSkewed(dateHeader, expected=startTime)
 
-        # Open and validate the directory
-        log.info("Validating directory")
-
-        lock.read_in()
-        digestMap = self._s.digestMap.copy()
-        lock.read_out()
-
-        try:
-            directory = mixminion.ServerInfo.parseDirectory(
-                fname=tmpname,
-                validatedDigests=digestMap)
-        except mixminion.Config.ConfigError, e:
-            raise GotInvalidDirectoryError(
-                "Received an invalid directory: %s"%e)
-
+    def _installDirectory(self, directory, tmpname, isGzipped, lock):
+        """Helper function: check that the newly downloaded 'directory',
+           stored in 'tmpname', is signed by the right key; then make it
+           our current directory."""
         if isinstance(directory, mixminion.ServerInfo.ServerDirectory):
             identity = directory['Signature']['DirectoryIdentity']
             fp = MIXMINION_DIRECTORY_FINGERPRINT #XXXX
@@ -595,6 +673,7 @@ class CachingDescriptorSource(DescriptorSource):
     ##Fields:
     # bases: a list of DescriptorSource objects to delegate to.
     # cacheFile: filename to store our cache in.
+    # indexFile: filename to store a DescriptorIndex for our cache in.
     MAGIC = "CDS-0.1"
     def __init__(self,state):
         """Create a new CachingDescriptorSource."""
@@ -602,6 +681,7 @@ class CachingDescriptorSource(DescriptorSource):
         self.bases = []
         self._setSharedState(state)
         self.cacheFile = None
+        self.indexFile = None
 
     def getServerList(self):
         servers = []
@@ -618,6 +698,8 @@ class CachingDescriptorSource(DescriptorSource):
     def configure(self,config):
         self.cacheFile = os.path.join(config.getDirectoryRoot(),
                                       "cache")
+        self.indexFile = os.path.join(config.getDirectoryRoot(),
+                                      "cache.idx")
         createPrivateDir(config.getDirectoryRoot())
         for b in self.bases: b.configure(config)
 
@@ -666,11 +748,33 @@ class CachingDescriptorSource(DescriptorSource):
             return
 
         writePickled(self.cacheFile, self)
+        self.saveIndex()
 
         for b in self.bases:
             b._changed = 0
         self._s._changed = 0
 
+    def getLastDownload(self):
+        """Return the time when we last downloaded a directory, or 0 if
+           we have no directory."""
+        for b in self.bases:
+            if getattr(b, 'serverDir', None) is not None:
+                return b.lastDownload
+        return 0
+
+    def saveIndex(self):
+        """Write a DescriptorIndex summarizing the contents of our cache
+           file.  Failure to write the index is not fatal: we will just
+           load the full cache next time."""
+        try:
+            writeDescriptorIndex(self.indexFile, self.cacheFile,
+                                 self.getServerList(),
+                                 self.getRecommendedNicknames(),
+                                 self.getRecommendedVersions(),
+                                 self.getLastDownload())
+        except (OSError, IOError), e:
+            log.warn("Couldn't write directory index: %s", e)
+
     def __getattr__(self, attr):
         candidate = None
         for b in self.bases:
@@ -699,6 +803,8 @@ def loadCachingDescriptorSource(config):
         store = readPickled(cacheFile)
         if isinstance(store, CachingDescriptorSource):
             store.configure(config)
+            if loadDescriptorIndex(config) is None:
+                store.saveIndex()
             return store
         elif isinstance(store, types.TupleType):
             # changed to OO format in 0.0.8.
@@ -723,6 +829,306 @@ def loadCachingDescriptorSource(config):
     store.save()
     return store
 
+#----------------------------------------------------------------------
+# Compact descriptor index
+
+# Order in which ServerInfo.getCaps lists capabilities; a server's caps are
+# stored in the index as a bitmask over this list.
+_INDEX_CAPS = [ 'mbox', 'smtp', 'relay', 'frag' ]
+# Flag set in an index record if the server supports our packet version.
+_INDEX_FLAG_PACKET_VERSION = 1
+
+class DescriptorIndex:
+    """A DescriptorIndex is a read-only, memory-mapped view of the compact
+       summary we write beside the directory cache.  For every cached
+       descriptor it holds the nickname, digests, validity interval,
+       publication time, capabilities, and MMTP protocols, which are all we
+       need for lookup and path selection.  Each record also gives the position of
+       a separately pickled copy of its ServerInfo at the end of the file,
+       so that when somebody needs more than the index knows, we unpickle
+       only the descriptor they asked for.
+
+       The index is only trusted while the cache file it summarizes has
+       the same size and modification time as when the index was written.
+
+       File format:
+          HEADER: MAGIC, last download time, cache mtime, cache size,
+                  number of records, length of META.
+          META: pickled (recommended nicknames, (client versions,
+                server versions))
+          RECORDS: fixed-width records, sorted by lowercase nickname and
+                publication time.
+          DATA: nicknames, each followed by its server's incoming and
+                outgoing MMTP protocols; then pickled ServerInfo objects.
+                Both are referenced by offset and length from RECORDS.
+    """
+    ## Fields:
+    # fname: The name of the index file.
+    # cacheFile: The name of the directory cache this index summarizes.
+    # lastDownload: When did we last download a directory? (0 for never.)
+    # cacheMtime, cacheSize: The mtime and size of the cache file at the time
+    #     we wrote this index.
+    # recommendedNicknames: A list of lowercase recommended nicknames.
+    # clientVersions, serverVersions: Lists of recommended software.
+    # _contents: An mmap object (or a string, if mmap fails) holding the
+    #     contents of the index file.
+    # _nRecords: The number of records in the index.
+    # _recordsOffset: The offset of the first record in _contents.
+    MAGIC = "MMCDI\x00\x00\x03"
+    HEADER_FMT = "!8sddLLL"
+    HEADER_LEN = struct.calcsize(HEADER_FMT)
+    # key digest, descriptor digest, valid-after, valid-until, published,
+    # flags, caps, nickname length, nickname offset, protocols length,
+    # descriptor length, descriptor offset.  The protocols come right after
+    # the nickname, as "incoming;outgoing" with comma-separated versions.
+    RECORD_FMT = "!20s20sdddBBHLHLL"
+    RECORD_LEN = struct.calcsize(RECORD_FMT)
+
+    def __init__(self, fname, cacheFile):
+        """Open the index stored in 'fname', summarizing the directory
+           cache in 'cacheFile'.  Raise ValueError if the file is not a
+           well-formed index; OSError or IOError if we can't read it."""
+        self.fname = fname
+        self.cacheFile = cacheFile
+        f = open(fname, 'rb')
+        try:
+            try:
+                self._contents = mmap.mmap(f.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                # Empty files and some platforms can't be mapped.
+                self._contents = f.read()
+        finally:
+            f.close()
+
+        if len(self._contents) < self.HEADER_LEN:
+            raise ValueError("Truncated header")
+        magic, self.lastDownload, self.cacheMtime, self.cacheSize, \
+               self._nRecords, metaLen = struct.unpack(
+            self.HEADER_FMT, self._contents[:self.HEADER_LEN])
+        if magic != self.MAGIC:
+            raise ValueError("Unrecognized index format")
+        self._recordsOffset = self.HEADER_LEN + metaLen
+        end = self._recordsOffset + self._nRecords*self.RECORD_LEN
+        if end > len(self._contents):
+            raise ValueError("Truncated index")
+        if self._nRecords:
+            # The descriptor for the last record is stored last.
+            last = struct.unpack(self.RECORD_FMT,
+                                 self._contents[end-self.RECORD_LEN:end])
+            if last[10]+last[11] != len(self._contents):
+                raise ValueError("Truncated index")
+        try:
+            meta = cPickle.loads(
+                self._contents[self.HEADER_LEN:self._recordsOffset])
+            self.recommendedNicknames, \
+                (self.clientVersions, self.serverVersions) = meta
+        except (cPickle.UnpicklingError, EOFError, TypeError), e:
+            raise ValueError("Corrupt index metadata: %s" % e)
+
+    def isCurrent(self):
+        """Return true iff this index describes the current contents of
+           its cache file."""
+        try:
+            st = os.stat(self.cacheFile)
+        except OSError:
+            return 0
+        return (st[stat.ST_SIZE] == self.cacheSize and
+                os.path.getmtime(self.cacheFile) == self.cacheMtime)
+
+    def getServerList(self):
+        """Return a list of IndexedServerInfo for every descriptor in this
+           index."""
+        res = []
+        c = self._contents
+        unpack = struct.unpack
+        fmt = self.RECORD_FMT
+        pos = self._recordsOffset
+        for _ in xrange(self._nRecords):
+            rec = unpack(fmt, c[pos:pos+self.RECORD_LEN])
+            nickLen, nickOffset, protoLen = rec[7], rec[8], rec[9]
+            nickname = c[nickOffset:nickOffset+nickLen]
+            nickOffset += nickLen
+            protocols = c[nickOffset:nickOffset+protoLen]
+            res.append(IndexedServerInfo(self, nickname, protocols, rec))
+            pos += self.RECORD_LEN
+        return res
+
+    def _loadServerInfo(self, length, offset):
+        """Helper: unpickle and return the ServerInfo stored in the 'length'
+           bytes at 'offset'.  Raise MixError if it is corrupt."""
+        try:
+            return cPickle.loads(self._contents[offset:offset+length])
+        except (cPickle.UnpicklingError, EOFError, ValueError, TypeError,
+                AttributeError), e:
+            raise MixError("Corrupt descriptor in directory index: %s" % e)
+
+    def close(self):
+        """Release the mapping of the index file."""
+        if hasattr(self._contents, "close"):
+            self._contents.close()
+
+def writeDescriptorIndex(fname, cacheFile, servers, recommendedNicknames,
+                         versions, lastDownload):
+    """Write a DescriptorIndex to 'fname' describing the ServerInfo objects
+       in 'servers', as currently stored in 'cacheFile'.  See
+       DescriptorIndex for the format."""
+    servers = [ (s.getNickname().lower(), s['Server']['Published'], s)
+                for s in servers ]
+    servers.sort()
+    meta = cPickle.dumps((recommendedNicknames, versions), 1)
+    hLen = DescriptorIndex.HEADER_LEN
+    rLen = DescriptorIndex.RECORD_LEN
+    pickled = [ cPickle.dumps(s, 1) for _, _, s in servers ]
+    protocols = [ "%s;%s" % (",".join(s.getIncomingMMTPProtocols()),
+                             ",".join(s.getOutgoingMMTPProtocols()))
+                  for _, _, s in servers ]
+    data = []
+    for (_, _, s), p in zip(servers, protocols):
+        data.append(s.getNickname())
+        data.append(p)
+    data = "".join(data)
+    offset = hLen + len(meta) + rLen*len(servers)
+    descOffset = offset + len(data)
+    records = []
+    for (_, _, s), p, proto in zip(servers, pickled, protocols):
+        nickname = s.getNickname()
+        flags = 0
+        if s.supportsPacketVersion():
+            flags |= _INDEX_FLAG_PACKET_VERSION
+        caps = 0
+        for c in s.getCaps():
+            caps |= 1<<_INDEX_CAPS.index(c)
+        sec = s['Server']
+        records.append(struct.pack(DescriptorIndex.RECORD_FMT,
+                                   s.getKeyDigest(), s.getDigest(),
+                                   sec['Valid-After'], sec['Valid-Until'],
+                                   sec['Published'], flags, caps,
+                                   len(nickname), offset, len(proto),
+                                   len(p), descOffset))
+        offset += len(nickname) + len(proto)
+        descOffset += len(p)
+
+    header = struct.pack(DescriptorIndex.HEADER_FMT, DescriptorIndex.MAGIC,
+                         lastDownload, os.path.getmtime(cacheFile),
+                         os.stat(cacheFile)[stat.ST_SIZE], len(servers),
+                         len(meta))
+    writeFile(fname, "".join([header, meta]+records+[data]+pickled), binary=1)
+
+def loadDescriptorIndex(config):
+    """Return a DescriptorIndex for the directory cache of our current
+       configuration, or None if there is no index or if the index is out
+       of date."""
+    root = config.getDirectoryRoot()
+    try:
+        index = DescriptorIndex(os.path.join(root, "cache.idx"),
+                                os.path.join(root, "cache"))
+    except (OSError, IOError):
+        return None
+    except ValueError, e:
+        log.info("Couldn't read directory index: %s", e)
+        return None
+    if not index.isCurrent():
+        log.debug("Directory index is out of date.")
+        index.close()
+        return None
+    return index
+
+class IndexedServerInfo(mixminion.ServerInfo.ServerInfo):
+    """A ServerInfo whose fields are loaded lazily from a DescriptorIndex.
+
+       The methods used for lookup and path selection are answered from
+       the index record.  Any other access unpickles the full descriptor
+       from the index and delegates to it.
+    """
+    ## Fields:
+    # _index: The DescriptorIndex we came from.
+    # _info: The full ServerInfo, or None if we haven't loaded it yet.
+    # _nickname, _keyDigest, _digest, _validAfter, _validUntil, _published,
+    # _flags, _caps, _descLen, _descOffset: as stored in the index record.
+    # _incoming, _outgoing: Lists of the MMTP protocols this server supports.
+    def __init__(self, index, nickname, protocols, record):
+        self._index = index
+        self._info = None
+        self._nickname = nickname
+        (self._keyDigest, self._digest, self._validAfter, self._validUntil,
+         self._published, self._flags, self._caps, _, _, _, self._descLen,
+         self._descOffset) = record
+        self._incoming, self._outgoing = [
+            filter(None, p.split(",")) for p in protocols.split(";") ]
+
+    def getServerInfo(self):
+        """Return the full ServerInfo for this descriptor."""
+        if self._info is None:
+            self._info = self._index._loadServerInfo(self._descLen,
+                                                     self._descOffset)
+        return self._info
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return getattr(self.getServerInfo(), attr)
+
+    def getNickname(self):
+        return self._nickname
+
+    def getDigest(self):
+        return self._digest
+
+    def getKeyDigest(self):
+        return self._keyDigest
+
+    getIdentityDigest = getKeyDigest
+
+    def getValidAfter(self):
+        return self._validAfter
+
+    def getValidUntil(self):
+        return self._validUntil
+
+    def getCaps(self):
+        caps = []
+        for i in xrange(len(_INDEX_CAPS)):
+            if self._caps & (1<<i):
+                caps.append(_INDEX_CAPS[i])
+        return caps
+
+    def supportsPacketVersion(self):
+        return self._flags & _INDEX_FLAG_PACKET_VERSION
+
+    def getIncomingMMTPProtocols(self):
+        return self._incoming
+
+    def getOutgoingMMTPProtocols(self):
+        return self._outgoing
+
+    def getIntervalSet(self):
+        return IntervalSet([(self._validAfter, self._validUntil)])
+
+    def isExpiredAt(self, when):
+        return self._validUntil < when
+
+    def isValidAt(self, when):
+        return self._validAfter <= when <= self._validUntil
+
+    def isValidFrom(self, startAt, endAt):
+        assert startAt <= endAt
+        return self._validAfter <= startAt and endAt <= self._validUntil
+
+    def isValidAtPartOf(self, startAt, endAt):
+        assert startAt <= endAt
+        va, vu = self._validAfter, self._validUntil
+        return ((startAt <= va and va <= endAt) or
+                (startAt <= vu and vu <= endAt) or
+                (va <= startAt and endAt <= vu))
+
+    def isNewerThan(self, other):
+        if isinstance(other, IndexedServerInfo):
+            other = other._published
+        elif isinstance(other, mixminion.ServerInfo.ServerInfo):
+            other = other['Server']['Published']
+        return self._published > other
+
 class ClientDirectory:
     """Utility wrapper around a CachingDescriptorSource to handle common
        functionality such as server lookup, path generation, and so on.
@@ -731,7 +1137,11 @@ class ClientDirectory:
     # _lock: An instance of RWLock; protects all modifications to self or
     #    to the underlying sources.
     # _diskLock: A lock to protect all access to the disk.
-    # store: An instance of DescriptorSource.
+    # _config: The configuration we were created with, if any.
+    # store: An instance of DescriptorSource, or None if we haven't needed
+    #    to load one yet.
+    # _index: A DescriptorIndex that we use in place of self.store until
+    #    somebody needs the full store, or None.
     ## Fields derived from self.source:
     # allServers: A list of all known server descriptors.
     # clientVersions, serverVersions: Lists of recommended software.
@@ -746,18 +1156,40 @@ class ClientDirectory:
     # blockedNicknames: a map from lowercase nickname to a list of the purposes
     #   ('entry', 'exit', or '*') for which the corresponding server shouldn't
     #   be selected in automatic path generation.  Set by configure.
+    # _allByDay, _goodByDay: Maps from day number (seconds since the epoch,
+    #   divided by INDEX_BUCKET_WIDTH) to lists of the descriptors (all or
+    #   recommended, respectively) that are valid at some time during that
+    #   day.  Descriptors valid for longer than MAX_INDEX_BUCKETS days are
+    #   stored under the key None instead.
+    # _candidates: A map from path position ('entry', 'exit', or 'relay') to
+    #   a dict whose keys are the recommended descriptors whose nicknames
+    #   aren't blocked for that position.  Built lazily; cleared whenever
+    #   we rescan or reconfigure.
+
+    # Width of the buckets in _allByDay and _goodByDay.
+    INDEX_BUCKET_WIDTH = 24*60*60
+    # Longest validity period, in buckets, that we bother to index.
+    MAX_INDEX_BUCKETS = 400
+
     def __init__(self, config=None, store=None, diskLock=None):
         self._lock = RWLock()
         if diskLock is None:
             self._diskLock = DummyLock()
         else:
             self._diskLock = diskLock
+        self._config = config
+        self.store = self._index = None
+        self._candidates = {}
         if store:
             self.store = store
         elif config:
             self._diskLock.acquire()
             try:
-                self.store = loadCachingDescriptorSource(config)
+                # Use the compact index if we can; we only load the full
+                # cache once somebody needs to change it.
+                self._index = loadDescriptorIndex(config)
+                if self._index is None:
+                    self.store = loadCachingDescriptorSource(config)
             finally:
                 self._diskLock.release()
         if config:
@@ -765,18 +1197,27 @@ class ClientDirectory:
         self.__scan()
 
     def __scan(self):
-        """Helper: update all fields derived from self.store.
+        """Helper: update all fields derived from self.store (or from
+           self._index, if we have not loaded the store).
 
            Must hold write lock if other threads can reach this object.
         """
-        self.allServers = self.store.getServerList()
-        self.clientVersions, self.serverVersions = \
-                             self.store.getRecommendedVersions()
+        if self.store is None:
+            source = self._index
+            self.allServers = source.getServerList()
+            self.clientVersions = source.clientVersions
+            self.serverVersions = source.serverVersions
+            recommended = source.recommendedNicknames
+        else:
+            self.allServers = self.store.getServerList()
+            self.clientVersions, self.serverVersions = \
+                                 self.store.getRecommendedVersions()
+            recommended = self.store.getRecommendedNicknames()
         self.goodNicknames = {}
         self.goodServers = []
         self.byNickname = {}
         self.byKeyID = {}
-        for n in self.store.getRecommendedNicknames():
+        for n in recommended:
             assert n == n.lower()
             self.goodNicknames[n]=1
         for s in self.allServers:
@@ -786,6 +1227,52 @@ class ClientDirectory:
             self.byNickname.setdefault(lcnickname,[]).append(s)
             if self.goodNicknames.has_key(lcnickname):
                 self.goodServers.append(s)
+        self._allByDay = self.__indexByDay(self.allServers)
+        self._goodByDay = self.__indexByDay(self.goodServers)
+        self._candidates = {}
+
+    def __indexByDay(self, lst):
+        """Helper: Given a list of ServerInfo, return a map from day number
+           to the elements of 'lst' that are valid at some point during
+           that day.  See the documentation for _allByDay."""
+        width = self.INDEX_BUCKET_WIDTH
+        byDay = { None : [] }
+        for s in lst:
+            first = int(floorDiv(s.getValidAfter(), width))
+            last = int(floorDiv(s.getValidUntil(), width))
+            if last - first > self.MAX_INDEX_BUCKETS:
+                byDay[None].append(s)
+                continue
+            for day in xrange(first, last+1):
+                byDay.setdefault(day, []).append(s)
+        return byDay
+
+    def __getValidAt(self, byDay, when):
+        """Helper: Given a map as built by __indexByDay, return a list
+           holding every descriptor in it that is valid at 'when', along
+           with some that may not be.  Caller must hold read lock."""
+        day = int(floorDiv(when, self.INDEX_BUCKET_WIDTH))
+        return byDay.get(day, []) + byDay[None]
+
+    def __loadStoreAsNeeded(self):
+        """Helper: if we have been answering queries from a DescriptorIndex,
+           load the full descriptor store from disk.
+
+           Callers should hold no locks.
+        """
+        if self.store is not None:
+            return
+        self._diskLock.acquire()
+        self._lock.write_in()
+        try:
+            if self.store is None:
+                self.store = loadCachingDescriptorSource(self._config)
+                self.__scan()
+                self._index.close()
+                self._index = None
+        finally:
+            self._lock.write_out()
+            self._diskLock.release()
 
     def flush(self):
         """Save any pending changes to disk, and update all derivative
@@ -794,7 +1281,7 @@ class ClientDirectory:
         self._diskLock.acquire()
         self._lock.write_in()
         try:
-            if self.store.hasChanged():
+            if self.store is not None and self.store.hasChanged():
                 self.store.save()
                 self.__scan()
         finally:
@@ -811,7 +1298,7 @@ class ClientDirectory:
         #XXXX008 some calls are probably needless.
         self._lock.read_in()
         try:
-            if not self.store.hasChanged():
+            if self.store is None or not self.store.hasChanged():
                 return
         finally:
             self._lock.read_out()
@@ -822,7 +1309,9 @@ class ClientDirectory:
         """ """
         self._lock.write_in()
         try:
-            self.store.configure(config)
+            self._config = config
+            if self.store is not None:
+                self.store.configure(config)
 
             sec = config.get("Security", {})
             blocked = {}
@@ -837,11 +1326,14 @@ class ClientDirectory:
                     blocked[nn.lower()] = ['*']
 
             self.blockedNicknames = blocked
+            self._candidates = {}
         finally:
             self._lock.write_out()
 
     def save(self):
         """Flush all changes to disk, whether we need to or not."""
+        if self.store is None:
+            return
         self._diskLock.acquire()
         self._lock.read_in()
         try:
@@ -852,6 +1344,7 @@ class ClientDirectory:
 
     def rescan(self,force=0):
         """Rescan the underlying source."""
+        self.__loadStoreAsNeeded()
         self._diskLock.acquire()
         self._lock.write_in()
         try:
@@ -863,6 +1356,13 @@ class ClientDirectory:
 
     def update(self, force=0, now=None):
         """Download a directory as needed."""
+        if self.store is None and not force:
+            if now is None:
+                now = time.time()
+            if self._index.lastDownload >= previousMidnight(now):
+                log.debug("Directory is up to date.")
+                return
+        self.__loadStoreAsNeeded()
         self._diskLock.acquire()
         try:
             self.store.update(force=force,now=now,lock=self._lock)
@@ -872,6 +1372,7 @@ class ClientDirectory:
 
     def clean(self, now=None):
         """Remove expired and superseded descriptors."""
+        self.__loadStoreAsNeeded()
         self._diskLock.acquire()
         self._lock.write_in()
         try:
@@ -883,6 +1384,7 @@ class ClientDirectory:
 
     def importFromFile(self, sourceFname):
         """See FSBackedDescriptorSource.importFromFile"""
+        self.__loadStoreAsNeeded()
         self._diskLock.acquire()
         self._lock.write_in()
         try:
@@ -897,6 +1399,7 @@ class ClientDirectory:
 
     def expungeByNickname(self, nickname):
         """See FSBackedDescriptorSource.expungeByNickname"""
+        self.__loadStoreAsNeeded()
         self._diskLock.acquire()
         self._lock.write_in()
         try:
@@ -1045,7 +1548,11 @@ class ClientDirectory:
                     feature = mixminion.Config.resolveFeatureName(
                         f, mixminion.ServerInfo.ServerInfo)
                     resFeatures.append((f, feature))
-            for sd in self.allServers:
+            if at:
+                servers = self.__getValidAt(self._allByDay, at)
+            else:
+                servers = self.allServers
+            for sd in servers:
                 if at and not sd.isValidAt(at):
                     continue
                 nickname = sd.getNickname()
@@ -1129,16 +1636,46 @@ class ClientDirectory:
         else:
             return 0
 
-    def __excludeBlocked(self, lst, isEntry=0, isExit=0):
-        """Given a list of ServerInfo, return a new list with all the
-           blocked servers removed.  'isEntry' and 'isExit' are as for
-           __nicknameIsBlocked.
+    def __findGood(self, startAt, endAt, isEntry=0, isExit=0):
+        """Helper: as __find(self.goodServers, startAt, endAt), but with
+           all blocked servers removed.  'isEntry' and 'isExit' are as for
+           __nicknameIsBlocked.  Uses the day index and the cached candidate
+           sets, so that we don't look at every descriptor.
+
+           Caller must hold read lock.
+        """
+        found = self.__find(self.__getValidAt(self._goodByDay, startAt),
+                            startAt, endAt)
+        positions = []
+        if isEntry:
+            positions.append('entry')
+        if isExit:
+            positions.append('exit')
+        if not positions:
+            positions.append('relay')
+        for p in positions:
+            candidates = self.__getCandidates(p)
+            found = [ s for s in found if candidates.has_key(s) ]
+        return found
+
+    def __getCandidates(self, position):
+        """Helper: Return a dict whose keys are all the recommended
+           ServerInfo objects that are not blocked in 'position' (one of
+           'entry', 'exit', or 'relay').
+
+           Caller must hold read lock.
         """
-        # must hold lock
-        res = []
-        for info in lst:
+        try:
+            return self._candidates[position]
+        except KeyError:
+            pass
+        isEntry = position == 'entry'
+        isExit = position == 'exit'
+        res = {}
+        for info in self.goodServers:
             if not self.__nicknameIsBlocked(info.getNickname(),isEntry,isExit):
-                res.append(info)
+                res[info] = 1
+        self._candidates[position] = res
         return res
 
     def getLiveServers(self, startAt=None, endAt=None, isEntry=0, isExit=0):
@@ -1156,9 +1693,8 @@ class ClientDirectory:
         self.__scanAsNeeded()
         self._lock.read_in()
         try:
-            return self.__excludeBlocked(
-                self.__find(self.goodServers, startAt, endAt),
-                isEntry=isEntry, isExit=isExit)
+            return self.__findGood(startAt, endAt, isEntry=isEntry,
+                                   isExit=isExit)
         finally:
             self._lock.read_out()
 
@@ -1348,14 +1884,15 @@ class ClientDirectory:
                 servers.append(self.getServerInfo(name, startAt, endAt, 1))
 
         # Now figure out which relays we haven't used yet.
-        relays = self.__find(self.goodServers, startAt, endAt)
-        relays = self.__excludeBlocked(relays)
+        relays = self.__findGood(startAt, endAt)
         if not relays:
             raise UIError("No relays known")
         elif len(relays) == 2:
             log.warn("Not enough servers to avoid same-server hops")
         elif len(relays) == 1:
             log.warn("Only one relay known")
+        entries = self.__getCandidates('entry')
+        exits = self.__getCandidates('exit')
 
         # Now fill in the servers. For each relay we need...
         for i in xrange(len(servers)):
@@ -1374,12 +1911,10 @@ class ClientDirectory:
             candidates = []
             for c in relays:
                 # Skip blocked entry points
-                if i==0 and self.__nicknameIsBlocked(c.getNickname(),
-                                                     isEntry=1):
+                if i==0 and not entries.has_key(c):
                     continue
                 # Skip blocked exit points
-                if i==(len(servers)-1) and self.__nicknameIsBlocked(
-                    c.getNickname(), isExit=1):
+                if i==(len(servers)-1) and not exits.has_key(c):
                     continue
                 # Avoid same-server hops
                 if ((prev and c.hasSameNicknameAs(prev)) or
@@ -15,6 +15,13 @@ import sys
 import time
 from types import IntType, StringType
 
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5 and earlier have no multiprocessing module; we build all
+    # our packets in this process.
+    multiprocessing = None
+
 import mixminion.BuildMessage
 import mixminion.ClientUtils
 import mixminion.ClientDirectory
@@ -32,7 +39,7 @@ from mixminion.Common import Lockfile, LockfileLocked, MixError, \
 from mixminion.Packet import encodeMailHeaders, ParseError, parseMBOXInfo, \
      parseReplyBlocks, parseSMTPInfo, parseTextEncodedMessages, \
      parseTextReplyBlocks, ReplyBlock, parseMessageAndHeaders, \
-     CompressedDataTooLong
+     CompressedDataTooLong, TextEncodedMessageReader
 
 from mixminion.ServerInfo import displayServerByRouting, ServerInfo
 
@@ -162,6 +169,44 @@ class ClientKeyring:
         if self.keyring.isDirty(): self.keyring.save()
         return self.keyring.getAllSURBKeys()
 
+#----------------------------------------------------------------------
+# Global variable; while a pool of worker processes is building forward
+# packets, holds a tuple of (routingType, routingInfo, suppressTag, jobs),
+# where jobs is a list of (payload, path1, path2, seed) for each packet.
+# The workers inherit it when they fork, so that we never need to pickle
+# the ServerInfo objects in the paths.
+_PACKET_JOBS = None
+
+def _initPacketWorker():
+    """Helper: called in each worker process before it builds any packets."""
+    # Otherwise, our workers would share our cached entropy and each
+    # other's OpenSSL state.
+    mixminion.Crypto.reinit_after_fork()
+
+def _buildPacketJob(idx):
+    """Helper: called in a worker process to build the idx'th packet in
+       _PACKET_JOBS."""
+    routingType, routingInfo, suppressTag, jobs = _PACKET_JOBS
+    payload, path1, path2, seed = jobs[idx]
+    prng = mixminion.Crypto.AESCounterPRNG(seed)
+    return mixminion.BuildMessage.buildForwardPacket(
+        payload, routingType, routingInfo, path1, path2, prng,
+        suppressTag=suppressTag)
+
+# How long, in seconds, do we spend refilling the header pool each time we
+# find ourselves waiting on the network?
+HEADER_POOL_IDLE_TIME = 0.1
+
+def _getHeaderPoolKey(address, pathSpec):
+    """Helper: return the key we use in MixminionClient.headerPool for
+       single-packet messages to 'address' along 'pathSpec'."""
+    routingType, routingInfo, _ = address.getRouting()
+    return (routingType, routingInfo, str(pathSpec))
+
+def canBuildPacketsInParallel():
+    """Return true iff we can use more than one process to build packets."""
+    return multiprocessing is not None and hasattr(os, "fork")
+
 def installDefaultConfig(fname):
     """Create a default, 'fail-safe' configuration in a given file"""
     log.warn("No configuration file found. Installing default file in %s",
@@ -179,6 +224,8 @@ def installDefaultConfig(fname):
 #EntropySource: /dev/urandom
 ## Set this option to 'no' to disable permission checking
 #FileParanoia: yes
+## Use this many processes to build packets for large messages.
+#BuildProcesses: 1
 
 [DirectoryServers]
 DirectoryTimeout: 1 minute
@@ -214,6 +261,8 @@ DirectoryTimeout: 1 minute
 
 [Network]
 Timeout: 2 minutes
+## Give up on any first hops we haven't finished sending to after this long.
+#TotalTimeout: 10 minutes
 """ % fields)
 
 class MixminionClient:
@@ -226,6 +275,11 @@ class MixminionClient:
     # keys: A ClientKeyring object.
     # queue: A ClientQueue object.
     # surbLogFilename: The filename used by the SURB log.
+    # headerPool: None, or a HeaderPool holding precomputed headers for
+    #    destinations added with addPooledDestination.  (The command-line
+    #    tools never set one up: the pool only lives in memory, so it only
+    #    pays off for a program that keeps a MixminionClient around and
+    #    sends with it repeatedly.)
     def __init__(self, conf, password_fileno=None):
         """Create a new MixminionClient with a given configuration"""
         self.config = conf
@@ -245,6 +299,67 @@ class MixminionClient:
         self.prng = mixminion.Crypto.getCommonPRNG()
         self.queue = mixminion.ClientUtils.ClientQueue(os.path.join(userdir, "queue"))
         self.pool = mixminion.ClientUtils.ClientFragmentPool(os.path.join(userdir, "fragments"))
+        self.headerPool = None
+
+    def addPooledDestination(self, directory, address, pathSpec, size=None,
+                             duration=24*60*60):
+        """Begin precomputing up to 'size' headers for single-packet
+           forward messages to 'address' along paths chosen by 'pathSpec'.
+           Headers are built by refillHeaderPool, and while we're waiting
+           on the network in sendPacketBatches; generateForwardPackets
+           uses them when it can.  Each path must be valid for 'duration'
+           seconds from when it's built.
+
+           This is for programs that keep this MixminionClient for many
+           messages; the pool is lost when the process exits.
+        """
+        if size is None:
+            size = mixminion.BuildMessage.DEFAULT_HEADER_POOL_SIZE
+        if self.headerPool is None:
+            self.headerPool = mixminion.BuildMessage.HeaderPool(self.prng)
+        address.setFragmented(0,1)
+        routingType, routingInfo, _ = address.getRouting()
+        def generatePaths(n, directory=directory, address=address,
+                          pathSpec=pathSpec, duration=duration):
+            now = time.time()
+            return directory.generatePaths(n, pathSpec, address, now,
+                                           now+duration)
+        self.headerPool.addDestination(
+            _getHeaderPoolKey(address, pathSpec), routingType, routingInfo,
+            generatePaths, size, address.suppressTag())
+
+    def refillHeaderPool(self, timeLimit=None):
+        """Build headers for pooled destinations, for up to about
+           'timeLimit' seconds.  Return the number of headers built."""
+        if self.headerPool is None:
+            return 0
+        return self.headerPool.refill(timeLimit=timeLimit)
+
+    def _getPooledHeaders(self, directory, address, pathSpec, startAt,
+                          endAt):
+        """Helper: return a PrebuiltHeaders from our header pool for a
+           single-packet message to 'address' along 'pathSpec', or None if
+           we have none that the current directory still accepts."""
+        key = _getHeaderPoolKey(address, pathSpec)
+        while 1:
+            headers = self.headerPool.getHeaders(key, startAt, endAt)
+            if headers is None:
+                return None
+            # The directory may have changed since we built these.
+            DPE = mixminion.ClientDirectory.DescriptorPathElement
+            spec = mixminion.ClientDirectory.PathSpecifier(
+                map(DPE, headers.path1), map(DPE, headers.path2), 0, 0, 0)
+            try:
+                directory.validatePath(spec, address, startAt, endAt,
+                                       warnUnrecommended=0)
+                for s in headers.path1+headers.path2:
+                    if directory.getServerInfo(s.getNickname(),
+                                               startAt, endAt) is None:
+                        raise UIError("Unknown server %s"%s.getNickname())
+            except UIError, e:
+                log.debug("Discarding precomputed headers: %s", e)
+                continue
+            return headers
 
     def _sortPackets(self, packets, shuffle=1):
         """Helper function.  Takes a list of tuples of (packet,
@@ -299,11 +414,8 @@ class MixminionClient:
             directory, address, pathSpec, message, forceNoServerSideFragments,
             startAt, endAt)
 
-        for routing, packets in self._sortPackets(allPackets):
-            if forceQueue:
-                self.queuePackets(packets, routing)
-            else:
-                self.sendPackets(packets, routing, noQueue=forceNoQueue)
+        self._sendOrQueueBatches(self._sortPackets(allPackets),
+                                 forceQueue, forceNoQueue)
 
     def sendReplyMessage(self, directory, address, pathSpec, surbList, message,
                          startAt, endAt, forceQueue=0,
@@ -329,11 +441,18 @@ class MixminionClient:
         allPackets = self.generateReplyPackets(
             directory, address, pathSpec, message, surbList, startAt, endAt)
 
-        for routing, packets in self._sortPackets(allPackets):
-            if forceQueue:
+        self._sendOrQueueBatches(self._sortPackets(allPackets),
+                                 forceQueue, forceNoQueue)
+
+    def _sendOrQueueBatches(self, batches, forceQueue, forceNoQueue):
+        """Helper: given a list of (routing, packet list) tuples as returned
+           by _sortPackets, queue all the packets if forceQueue is true;
+           otherwise send them to all their first hops at once."""
+        if forceQueue:
+            for routing, packets in batches:
                 self.queuePackets(packets, routing)
-            else:
-                self.sendPackets(packets, routing, noQueue=forceNoQueue)
+        else:
+            self.sendPacketBatches(batches, noQueue=forceNoQueue)
 
     def generateReplyBlock(self, address, servers, name="", expiryTime=0):
         """Generate an return a new ReplyBlock object.
@@ -355,7 +474,7 @@ class MixminionClient:
         return block
 
     def generateForwardPackets(self, directory, address, pathSpec, message,
-                               noSSFragments, startAt, endAt):
+                               noSSFragments, startAt, endAt, processes=None):
         """Generate packets for a forward message, but do not send
            them.  Return a list of tuples of (the packet body, a
            ServerInfo for the first hop.)
@@ -371,6 +490,9 @@ class MixminionClient:
                recipient rather than having the exit server defragment them.
             startAt, endAt -- an interval over which all servers in the path
                must be valid.
+            processes -- the number of processes to use to build the
+               packets.  If None, use the BuildProcesses option from the
+               configuration.
             """
         #XXXX we need to factor more of this long-message logic out to the
         #XXXX common code.  For now, this is a temporary measure.
@@ -396,8 +518,26 @@ class MixminionClient:
         directory.validatePath(pathSpec, address, startAt, endAt,
                                warnUnrecommended=0)
 
-        for p, (path1,path2) in zip(payloads, directory.generatePaths(
-            len(payloads), pathSpec, address, startAt, endAt)):
+        if len(payloads) == 1 and self.headerPool is not None:
+            headers = self._getPooledHeaders(directory, address, pathSpec,
+                                             startAt, endAt)
+            if headers is not None:
+                log.info("Using precomputed headers")
+                return [ (headers.buildPacket(payloads[0]),
+                          headers.path1[0]) ]
+
+        paths = directory.generatePaths(
+            len(payloads), pathSpec, address, startAt, endAt)
+
+        if processes is None:
+            processes = self.config['Host'].get('BuildProcesses', 1)
+        processes = min(processes, len(payloads))
+        if processes > 1 and canBuildPacketsInParallel():
+            return self._generateForwardPacketsInParallel(
+                payloads, paths, routingType, routingInfo,
+                address.suppressTag(), processes)
+
+        for p, (path1,path2) in zip(payloads, paths):
 
             pkt = mixminion.BuildMessage.buildForwardPacket(
                 p, routingType, routingInfo, path1, path2,
@@ -406,6 +546,41 @@ class MixminionClient:
 
         return r
 
+    def _generateForwardPacketsInParallel(self, payloads, paths, routingType,
+                                          routingInfo, suppressTag, processes):
+        """Helper: build one forward packet for each payload in 'payloads',
+           using the corresponding (path1,path2) in 'paths', and a pool of
+           'processes' worker processes.  Return a list of tuples of (the
+           packet body, a ServerInfo for the first hop), in the same order
+           as the payloads.
+
+           Each packet gets its own PRNG, seeded from our PRNG before any
+           work begins, so that no two packets share secrets or padding, and
+           the packets we build don't depend on which worker builds them.
+        """
+        global _PACKET_JOBS
+        jobs = []
+        for p, (path1,path2) in zip(payloads, paths):
+            seed = self.prng.getBytes(mixminion.Crypto.AES_KEY_LEN)
+            jobs.append((p, path1, path2, seed))
+
+        log.info("Building %s packets in %s processes...",
+                 len(jobs), processes)
+        _PACKET_JOBS = (routingType, routingInfo, suppressTag, jobs)
+        try:
+            pool = multiprocessing.Pool(processes, _initPacketWorker)
+            try:
+                pkts = pool.map(_buildPacketJob, range(len(jobs)))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            pool.join()
+        finally:
+            _PACKET_JOBS = None
+
+        return [ (pkt, path1[0]) for pkt, (_, path1, _, _) in zip(pkts, jobs) ]
+
     def generateReplyPackets(self, directory, address, pathSpec, message,
                              surbList, startAt, endAt):
         """Generate a reply message, but do not send it.  Returns
@@ -487,37 +662,78 @@ class MixminionClient:
 
            XXXX return 1 if all delivered
            """
+        return self.sendPacketBatches([(routingInfo, pktList)], noQueue,
+                                      lazyQueue, alreadyQueued, warnIfLost)[0]
+
+    def sendPacketBatches(self, batches, noQueue=0, lazyQueue=0,
+                          alreadyQueued=0, warnIfLost=1):
+        """Given a list of tuples of (IPV4Info, list of packets), as returned
+           by _sortPackets, send each list of packets to its server via
+           MMTP.  We connect to all the servers at once.  The queueing
+           options are as for sendPackets.
+
+           Return a list of the number of packets delivered from each
+           batch.
+           """
         #XXXX write unit tests
         timeout = self.config.getTimeout()
-
-        if noQueue or lazyQueue:
-            handles = []
+        totalTimeout = self.config.getTotalTimeout()
+
+        handleLists = []
+        sentLists = []
+        mmtpBatches = []
+        for routingInfo, pktList in batches:
+            if noQueue or lazyQueue:
+                handles = []
+            else:
+                handles = self.queuePackets(pktList, routingInfo)
+            handleLists.append(handles)
+
+            packetsSentByIndex = {}
+            def callback(idx, packetsSentByIndex=packetsSentByIndex):
+                packetsSentByIndex[idx] = 1
+            sentLists.append(packetsSentByIndex)
+            mmtpBatches.append((routingInfo, pktList, callback))
+
+        if self.headerPool is not None:
+            def idleHook(self=self):
+                return self.refillHeaderPool(HEADER_POOL_IDLE_TIME)
         else:
-            handles = self.queuePackets(pktList, routingInfo)
-
-        packetsSentByIndex = {}
-        def callback(idx, packetsSentByIndex=packetsSentByIndex):
-            packetsSentByIndex[idx] = 1
+            idleHook = None
 
         try:
-            # May raise TimeoutError
             log.info("Connecting...")
-            mixminion.MMTPClient.sendPackets(routingInfo,
-                                             pktList,
-                                             timeout,
-                                             callback=callback)
-
+            errors = mixminion.MMTPClient.sendPacketsToServers(
+                mmtpBatches, timeout, totalTimeout, idleHook=idleHook)
         except:
-            exc = sys.exc_info()
-        else:
-            exc = None
+            errors = [ sys.exc_info()[1] ] * len(batches)
+
+        results = []
+        for idx in xrange(len(batches)):
+            routingInfo, pktList = batches[idx]
+            results.append(self._noteDeliveryResults(
+                pktList, routingInfo, handleLists[idx], sentLists[idx],
+                errors[idx], noQueue, lazyQueue, alreadyQueued, warnIfLost))
+        return results
+
+    def _noteDeliveryResults(self, pktList, routingInfo, handles,
+                             packetsSentByIndex, err, noQueue, lazyQueue,
+                             alreadyQueued, warnIfLost):
+        """Helper for sendPacketBatches: after trying to deliver the packets
+           in 'pktList' to 'routingInfo', remove the ones that were
+           delivered (whose indices are in 'packetsSentByIndex') from the
+           queue, and queue or warn about the rest as appropriate.  'err'
+           is None, or the error we got while delivering the packets.
+           Return the number of packets delivered.
+        """
         nGood = len(packetsSentByIndex)
         nBad = len(pktList)-nGood
 
         clientLock()
         try:
             if nGood:
-                log.info("... %s sent", nGood)
+                log.info("... %s sent to %s", nGood,
+                         displayServerByRouting(routingInfo))
                 log.trace("Removing %s successful packets from queue", nGood)
             for idx in packetsSentByIndex.keys():
                 if handles and handles[idx]:
@@ -549,10 +765,10 @@ class MixminionClient:
                 assert not (noQueue or lazyQueue)
                 log.info("Error while delivering packets; leaving %s/%s in queue",
                          nBad, nBad+nGood)
-            if exc and not nBad:
+            if err and not nBad:
                 log.info("Got error after all packets were delivered.")
-            if exc:
-                log.info("Error was: %s", exc[1])
+            if err:
+                log.info("Error was: %s", err)
         finally:
             clientUnlock()
 
@@ -600,16 +816,16 @@ class MixminionClient:
 
         nPackets = len(packets)
         nSent = 0
-        for routing, packets in self._sortPackets(packets):
+        batches = self._sortPackets(packets)
+        for routing, packets in batches:
             log.info("Sending %s packets to %s...",
                      len(packets), displayServerByRouting(routing))
-            try:
-                ok = self.sendPackets(packets, routing, noQueue=1,
-                                      warnIfLost=0, alreadyQueued=1)
+        try:
+            for ok in self.sendPacketBatches(batches, noQueue=1,
+                                             warnIfLost=0, alreadyQueued=1):
                 nSent += ok
-            except MixError, e:
-                log.error("Can't deliver packets to %s: %s; leaving in queue",
-                          displayServerByRouting(routing), str(e))
+        except MixError, e:
+            log.error("Can't deliver packets: %s; leaving in queue", str(e))
 
         if nSent == nPackets:
             log.info("Queue flushed")
@@ -670,27 +886,46 @@ class MixminionClient:
            Raise ParseError on malformatted messages.  Unless 'force' is
            true, do not uncompress possible zlib bombs.
         """
-        #XXXX write unit tests
         results = []
+        self.decodeMessages(parseTextEncodedMessages(s, force=force),
+                            results.append, force=force, isatty=isatty)
+        return results
+
+    def decodeMessages(self, msgs, deliver, force=0, isatty=0):
+        """Given a sequence of TextEncodedMessage objects 'msgs', decode
+           each one in turn, and call 'deliver' with each decoded message
+           as soon as it is ready.  Fragments are added to the fragment
+           pool.  'msgs' may be a TextEncodedMessageReader, so that we
+           never hold more than one message in memory at a time.
+
+           Raise ParseError on malformatted messages.  Unless 'force' is
+           true, do not uncompress possible zlib bombs.  If 'isatty' is
+           true and 'force' is false, raise UIError instead of delivering
+           a binary message.
+        """
+        #XXXX write unit tests
         foundAFragment = 0
-        for msg in parseTextEncodedMessages(s, force=force):
+        # We only load our SURB keys once we find an encrypted message, and
+        # we decode every such message with the same decoder.
+        decoder = None
+        for msg in msgs:
             if msg.isOvercompressed() and not force:
                 log.warn("Message is a possible zlib bomb; not uncompressing")
 
+            result = None
             if not msg.isEncrypted():
                 if msg.isFragment():
                     foundAFragment = 1
                     self.pool.addFragment(msg.getContents(), "---")
                 else:
-                    results.append(msg.getContents())
+                    result = msg.getContents()
             else:
                 assert msg.isEncrypted()
-                surbKeys = self.keys.getSURBKeys()
+                if decoder is None:
+                    decoder = mixminion.BuildMessage.PayloadDecoder(
+                        userKeys=self.keys.getSURBKeys())
                 nym = []
-                p = mixminion.BuildMessage.decodePayload(msg.getContents(),
-                                                         tag=msg.getTag(),
-                                                         userKeys=surbKeys,
-                                                         retNym=nym)
+                p = decoder.decode(msg.getContents(), msg.getTag(), nym)
                 if p:
                     if nym == []:
                         nym = "---"
@@ -699,19 +934,20 @@ class MixminionClient:
                     else:
                         nym = nym[0]
                     if p.isSingleton():
-                        results.append(p.getUncompressedContents())
+                        result = p.getUncompressedContents()
                     else:
                         foundAFragment = 1
                         self.pool.addFragment(p,nym)
                 else:
                     raise UIError("Unable to decode message")
-        if isatty and not force:
-            for p in results:
-                if not isPrintingAscii(p,allowISO=1):
+
+            if result is not None:
+                if isatty and not force and not isPrintingAscii(result,
+                                                                allowISO=1):
                     raise UIError("Not writing binary message to terminal: Use -F to do it anyway.")
+                deliver(result)
         if foundAFragment:
             self.pool.process()
-        return results
 
 def readConfigFile(configFile):
     """Given a configuration file (possibly none) as specified on the command
@@ -1758,20 +1994,24 @@ def clientDecode(cmd, args):
     tty = os.isatty(out.fileno())
 
     if inputFile == '-':
-        s = sys.stdin.read()
+        inp = sys.stdin
     else:
         try:
-            s = readFile(inputFile)
-        except OSError, e:
-            log.error("Could not read file %s: %s", inputFile, e)
+            inp = open(inputFile, 'r')
+        except (IOError, OSError), e:
+            raise UIError("Could not read file %s: %s" % (inputFile, e))
+    # We write each message as soon as it's decoded, so that we never need
+    # to hold the whole input in memory.
     try:
-        res = client.decodeMessage(s, force=force, isatty=tty)
-    except ParseError, e:
-        raise UIError("Couldn't parse message: %s"%e)
-
-    for r in res:
-        out.write(r)
-    out.close()
+        try:
+            client.decodeMessages(TextEncodedMessageReader(inp, force=force),
+                                  out.write, force=force, isatty=tty)
+        except ParseError, e:
+            raise UIError("Couldn't parse message: %s"%e)
+    finally:
+        if inp is not sys.stdin:
+            inp.close()
+        out.close()
 
 _GENERATE_SURB_USAGE = """\
 Usage: %(cmd)s [options]
@@ -26,7 +26,8 @@ import mixminion.Packet
 
 from mixminion.Common import MixError, UIError, ceilDiv, \
      createPrivateDir, floorDiv, previousMidnight, readFile, \
-     succeedingMidnight, writeFile, armorText, unarmorText, MixFatalError
+     succeedingMidnight, writeFile, armorText, unarmorText, MixFatalError, \
+     iterFileLines
 from mixminion.Crypto import sha1, ctr_crypt, DIGEST_LEN, AES_KEY_LEN, \
      getCommonPRNG, trng
 
@@ -569,9 +570,22 @@ class SURBLog(mixminion.Filestore.DBBase):
        """
     #FFFF Using this feature should be optional.
     ## Format:
-    # The database holds two kinds of keys:
+    # The database holds these kinds of keys:
     #    "LAST_CLEANED" -> an integer of the last time self.clean() was called.
-    #    20-byte-hash-of-SURB -> str(expiry-time-of-SURB)
+    #    "BUCKETED" -> "1" if every SURB entry is listed in a bucket.  Logs
+    #        written by older versions lack this key; we fix them up on
+    #        the next clean().
+    #    "FIRST_BUCKET" -> the lowest bucket number that may be present.
+    #    "B<n>" -> the concatenated hex digests of every SURB whose expiry
+    #        time falls in [n*BUCKET_WIDTH, (n+1)*BUCKET_WIDTH).
+    #    40-byte-hex-hash-of-SURB -> str(expiry-time-of-SURB)
+    ## Fields:
+    # _firstBucket: cached value of FIRST_BUCKET, or None if there are
+    #    no buckets.
+
+    # How many seconds of expiry times go into a single bucket?
+    BUCKET_WIDTH = 24*60*60
+
     def __init__(self, filename, forceClean=0):
         """Open a new SURBLog to store data in the file 'filename'.  If
            forceClean is true, remove expired entries on startup.
@@ -582,8 +596,13 @@ class SURBLog(mixminion.Filestore.DBBase):
             lastCleaned = int(self.log['LAST_CLEANED'])
         except (KeyError, ValueError):
             lastCleaned = 0
+        try:
+            self._firstBucket = int(self.log['FIRST_BUCKET'])
+        except (KeyError, ValueError):
+            self._firstBucket = None
 
-        if lastCleaned < time.time()-24*60*60 or forceClean:
+        if (lastCleaned < time.time()-24*60*60 or forceClean or
+            not self.log.has_key('BUCKETED')):
             self.clean()
         self.sync()
 
@@ -597,11 +616,14 @@ class SURBLog(mixminion.Filestore.DBBase):
         if now is None:
             now = time.time()
         nUsed = nExpired = nShortlived = 0
+        unused = {}
+        for surb in self.filterUnused(surbList):
+            unused[id(surb)] = 1
         result = []
         for surb in surbList:
             expiry = surb.timestamp
             timeLeft = expiry - now
-            if self.isSURBUsed(surb):
+            if not unused.has_key(id(surb)):
                 nUsed += 1
             elif timeLeft < 60:
                 nExpired += 1
@@ -622,6 +644,22 @@ class SURBLog(mixminion.Filestore.DBBase):
 
         return result
 
+    def filterUnused(self, surbList):
+        """Given a list of ReplyBlock objects, return a list of those that
+           are not marked as used, in the same order."""
+        # Look up each distinct digest once, all under a single lock.
+        used = {}
+        for surb in surbList:
+            used[surb.getHexDigest()] = 0
+        self._lock.acquire()
+        try:
+            has_key = self.log.has_key
+            for h in used.keys():
+                used[h] = has_key(h)
+        finally:
+            self._lock.release()
+        return [ surb for surb in surbList if not used[surb.getHexDigest()] ]
+
     def close(self):
         """Release resources associated with the surblog."""
         mixminion.Filestore.DBBase.close(self)
@@ -633,7 +671,15 @@ class SURBLog(mixminion.Filestore.DBBase):
 
     def markSURBUsed(self, surb):
         """Mark the ReplyBlock object 'surb' as used."""
-        self[surb] = surb.timestamp
+        h = surb.getHexDigest()
+        self._lock.acquire()
+        try:
+            if self.log.has_key(h):
+                return
+            self.log[h] = self._encodeVal(surb.timestamp)
+            self._addToBucket(h, surb.timestamp)
+        finally:
+            self._lock.release()
 
     def clean(self, now=None):
         """Remove all entries from this SURBLog the correspond to expired
@@ -641,19 +687,74 @@ class SURBLog(mixminion.Filestore.DBBase):
            able to use it inadvertently."""
         if now is None:
             now = time.time() + 60*60
+        self._lock.acquire()
+        try:
+            if not self.log.has_key('BUCKETED'):
+                self._cleanAndBucketAll(now)
+            else:
+                self._cleanBuckets(now)
+            self.log['LAST_CLEANED'] = str(int(now))
+            self.sync()
+        finally:
+            self._lock.release()
+
+    def _cleanBuckets(self, now):
+        """Helper: remove every bucket whose SURBs have all expired by
+           'now', along with the SURBs it lists.  Caller must hold the
+           lock."""
+        if self._firstBucket is None:
+            return
+        # Every SURB in bucket b has expired once (b+1)*BUCKET_WIDTH <= now.
+        lastDead = int(now // self.BUCKET_WIDTH) - 1
+        for b in xrange(self._firstBucket, lastDead+1):
+            k = "B%d"%b
+            try:
+                hashes = self.log[k]
+            except KeyError:
+                continue
+            for i in xrange(0, len(hashes), DIGEST_LEN*2):
+                try:
+                    del self.log[hashes[i:i+DIGEST_LEN*2]]
+                except KeyError:
+                    pass
+            del self.log[k]
+        if lastDead >= self._firstBucket:
+            self._setFirstBucket(lastDead+1)
+
+    def _cleanAndBucketAll(self, now):
+        """Helper: remove every expired SURB from a log written by an older
+           version, and put the others into buckets.  Caller must hold the
+           lock."""
         allHashes = self.log.keys()
-        removed = []
         for h in allHashes:
-            if self._decodeVal(self.log[h]) < now:
-                removed.append(h)
-        del allHashes
-        for h in removed:
-            del self.log[h]
-        self.log['LAST_CLEANED'] = str(int(now))
-        self.sync()
+            if len(h) != DIGEST_LEN*2:
+                continue
+            expiry = self._decodeVal(self.log[h])
+            if expiry < now:
+                del self.log[h]
+            else:
+                self._addToBucket(h, expiry)
+        self.log['BUCKETED'] = "1"
+
+    def _addToBucket(self, h, expiry):
+        """Helper: add the hex digest 'h' to the bucket for SURBs expiring
+           at 'expiry'.  Caller must hold the lock."""
+        b = int(expiry // self.BUCKET_WIDTH)
+        k = "B%d"%b
+        try:
+            self.log[k] += h
+        except KeyError:
+            self.log[k] = h
+        if self._firstBucket is None or b < self._firstBucket:
+            self._setFirstBucket(b)
+
+    def _setFirstBucket(self, b):
+        """Helper: remember that no bucket lower than 'b' is present."""
+        self._firstBucket = b
+        self.log['FIRST_BUCKET'] = str(b)
 
     def _encodeKey(self, surb):
-        return binascii.b2a_hex(sha1(surb.pack()))
+        return surb.getHexDigest()
     def _encodeVal(self, timestamp):
         return str(timestamp)
     def _decodeVal(self, timestamp):
@@ -670,22 +771,32 @@ class ClientQueue:
        tell us not to."""
     ## Fields:
     # dir -- a directory to store packets in.
-    # store -- an instance of ObjectMetadataStore.  The objects are of the
-    #    format:
+    # store -- an instance of StringMetadataStore.  The messages are
+    #    either:
+    #           a raw 32K string (the packet), or
+    #           (for packets queued by older versions) a pickled tuple of
     #           ("PACKET-0",
     #             a 32K string (the packet),
     #             an instance of IPV4Info or HostInfo (the first hop),
     #             the latest midnight preceding the time when this
     #                 packet was inserted into the queue
     #           )
-    #    The metadata is of the format:
+    #    The metadata is a pickled tuple of the format:
     #           ("V0",
     #             an instance of IPV4Info or HostInfo (the first hop),
     #             the latest midnight preceding the time when this
     #                 packet was inserted into the queue
     #           )
-    #    [These formats are redundant so that 0.0.6 and 0.0.5 clients
-    #     stay backward compatible for now.]
+    # metadataLoaded -- true iff we have loaded the routing index.
+    # _index -- map from handle to a (routing, date) tuple for every
+    #    packet in the queue, once the index is loaded.
+    # _indexFile -- the name of the file holding the routing index.  It
+    #    contains one line for each packet, of the format
+    #           "handle type hex-routing-info date\n"
+    #    where 'type' is "4" for IPV4Info and "H" for MMTPHostInfo.  Lines
+    #    are appended as packets are queued; the file is rewritten whenever
+    #    we notice that it disagrees with the store.  The metadata files
+    #    remain authoritative.
     #
     # XXXX write unit tests
     def __init__(self, directory, prng=None):
@@ -703,10 +814,12 @@ class ClientQueue:
                 fname_new = os.path.join(directory, "msg_"+handle)
                 os.rename(fname_old, fname_new)
 
-        self.store = mixminion.Filestore.ObjectMetadataStore(
+        self.store = mixminion.Filestore.StringMetadataStore(
             directory, create=1)
 
         self.metadataLoaded = 0
+        self._index = {}
+        self._indexFile = os.path.join(directory, "index")
 
     def queuePacket(self, packet, routing, now=None):
         """Insert the 32K packet 'packet' (to be delivered to 'routing')
@@ -715,9 +828,18 @@ class ClientQueue:
             now = time.time()
         mixminion.ClientMain.clientLock()
         try:
-            fmt = ("PACKET-0", packet, routing, previousMidnight(now))
-            meta = ("V0", routing, previousMidnight(now))
-            return self.store.queueObjectAndMetadata(fmt,meta)
+            when = previousMidnight(now)
+            meta = ("V0", routing, when)
+            handle = self.store.queueMessageAndMetadata(packet, meta)
+            if self.metadataLoaded:
+                self._index[handle] = (routing, when)
+            f = os.fdopen(os.open(self._indexFile,
+                           os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0600), 'a')
+            try:
+                f.write(_encodeIndexLine(handle, routing, when))
+            finally:
+                f.close()
+            return handle
         finally:
             mixminion.ClientMain.clientUnlock()
 
@@ -735,8 +857,7 @@ class ClientQueue:
            the queue before 'notAfter'."""
         self.loadMetadata()
         result = []
-        for h in self.store.getAllMessages():
-            _,_,when = self.store.getMetadata(h)
+        for h, (_, when) in self._index.items():
             if when <= notAfter: result.append(h)
         return result
 
@@ -769,8 +890,7 @@ class ClientQueue:
         result = []
         foundAny = {}
         foundMatch = {}
-        for h in self.store.getAllMessages():
-            _, r, when = self.store.getMetadata(h)
+        for h, (r, when) in self._index.items():
             if (destSet.has_key(r.keyinfo) or
                 (hasattr(r, 'hostname') and destSet.has_key(r.hostname)) or
                 (hasattr(r, 'ip') and destSet.has_key(r.ip))):
@@ -796,23 +916,35 @@ class ClientQueue:
 
     def getRouting(self, handle):
         """Return the routing information associated with the given handle."""
-        self.loadMetadata()
-        return self.store.getMetadata(handle)[1]
+        return self._getIndexEntry(handle)[0]
 
     def getDate(self, handle):
         """Return the date a given handle was inserted."""
-        self.loadMetadata()
-        return self.store.getMetadata(handle)[2]
+        return self._getIndexEntry(handle)[1]
 
     def getPacket(self, handle):
         """Given a handle, return a 3-tuple of the corresponding
            32K packet, {IPV4/Host}Info, and time of first queueing.  (The time
            is rounded down to the closest midnight GMT.)  May raise
            CorruptedFile."""
-        obj = self.store.getObject(handle)
         try:
-            magic, packet, routing, when = obj
-        except (ValueError, TypeError):
+            contents = self.store.messageContents(handle)
+        except IOError, e:
+            log.error("Couldn't read queued packet %s: %s", handle, e)
+            raise mixminion.Filestore.CorruptedFile()
+        if len(contents) == mixminion.Packet.PACKET_LEN:
+            routing, when = self._getIndexEntry(handle)
+            return contents, routing, when
+        else:
+            return self._parseOldPacket(handle, contents)
+
+    def _parseOldPacket(self, handle, contents):
+        """Helper: given the contents of a packet file written by an older
+           version, return a 3-tuple as for getPacket, or None if the file
+           is unrecognized."""
+        try:
+            magic, packet, routing, when = cPickle.loads(contents)
+        except (cPickle.UnpicklingError, EOFError, ValueError, TypeError):
             magic = None
         if magic != "PACKET-0":
             log.error("Unrecognized packet format for %s",handle)
@@ -827,6 +959,12 @@ class ClientQueue:
     def removePacket(self, handle):
         """Remove the packet named with the handle 'handle'."""
         self.store.removeMessage(handle)
+        # The index file keeps its line for this packet until the next time
+        # we load it and notice that the packet is gone.
+        try:
+            del self._index[handle]
+        except KeyError:
+            pass
 
     def inspectQueue(self):
         """Return a dict from routinginfo to a tuple of: (n,t), where
@@ -834,23 +972,15 @@ class ClientQueue:
            t is the insertion-data of the oldest packet waiting for that
            routinginfo.
         """
-        handles = self.getHandles()
-        if not handles:
-            return {}
-            return
         self.loadMetadata()
-        timesByServer = {}
-        for h in handles:
+        res = {}
+        for routing, when in self._index.values():
             try:
-                _, routing, when = self.store.getMetadata(h)
-            except mixminion.Filestore.CorruptedFile:
+                count, oldest = res[routing]
+            except KeyError:
+                res[routing] = (1, when)
                 continue
-            timesByServer.setdefault(routing, []).append(when)
-        res = {}
-        for s in timesByServer.keys():
-            count = len(timesByServer[s])
-            oldest = min(timesByServer[s])
-            res[s] = (count, oldest)
+            res[routing] = (count+1, min(oldest, when))
         return res
 
     def cleanQueue(self):
@@ -859,23 +989,105 @@ class ClientQueue:
         self.store.cleanMetadata()
 
     def loadMetadata(self):
-        """Ensure that we've loaded metadata for this queue from disk."""
+        """Ensure that we've loaded the routing index for this queue from
+           disk."""
         if self.metadataLoaded:
             return
 
-        # Helper function: create metadata from a file without it.
-        def fixupHandle(h,self=self):
-            packet, routing, when = self.getPacket(h)
-            return "V0", routing, when
-
         mixminion.ClientMain.clientLock()
         try:
-            self.store.loadAllMetadata(fixupHandle)
+            oldIndex = self._readIndex()
+            index = {}
+            dirty = 0
+            for h in self.store.getAllMessages():
+                try:
+                    index[h] = oldIndex[h]
+                    continue
+                except KeyError:
+                    pass
+                # This packet isn't in the index; fall back to its metadata.
+                dirty = 1
+                try:
+                    _, routing, when = self.store.getMetadata(h)
+                except KeyError:
+                    # We can only recover the routing for packets in the
+                    # old format, which included it.
+                    log.warn("Missing metadata for file %s",h)
+                    p = self._parseOldPacket(h, self.store.messageContents(h))
+                    if p is None:
+                        continue
+                    _, routing, when = p
+                    self.store.setMetadata(h, ("V0", routing, when))
+                except mixminion.Filestore.CorruptedFile:
+                    continue
+                index[h] = (routing, when)
+
+            self._index = index
+            if dirty or len(index) != len(oldIndex):
+                self._writeIndex()
         finally:
             mixminion.ClientMain.clientUnlock()
 
         self.metadataLoaded = 1
 
+    def _getIndexEntry(self, handle):
+        """Helper: return the (routing, date) tuple for a given handle.
+           Raise KeyError if there is no such packet, or CorruptedFile if
+           its metadata is damaged."""
+        self.loadMetadata()
+        try:
+            return self._index[handle]
+        except KeyError:
+            # Maybe somebody else queued it after we loaded the index.
+            _, routing, when = self.store.getMetadata(handle)
+            self._index[handle] = (routing, when)
+            return routing, when
+
+    def _readIndex(self):
+        """Helper: read the index file, and return a map from handle to
+           (routing, date).  Lines we can't parse are ignored."""
+        index = {}
+        try:
+            f = open(self._indexFile, 'r')
+        except IOError:
+            return index
+        try:
+            for line in iterFileLines(f):
+                try:
+                    h, tp, ri, when = line.split()
+                    ri = binascii.a2b_hex(ri)
+                    if tp == "4":
+                        routing = mixminion.Packet.parseIPV4Info(ri)
+                    elif tp == "H":
+                        routing = mixminion.Packet.parseMMTPHostInfo(ri)
+                    else:
+                        continue
+                    index[h] = (routing, long(when))
+                except (ValueError, TypeError,
+                        mixminion.Packet.ParseError):
+                    continue
+        finally:
+            f.close()
+        return index
+
+    def _writeIndex(self):
+        """Helper: replace the index file with the contents of
+           self._index."""
+        lines = [ _encodeIndexLine(h, routing, when)
+                  for h, (routing, when) in self._index.items() ]
+        writeFile(self._indexFile, "".join(lines), mode=0600)
+
+def _encodeIndexLine(handle, routing, when):
+    """Helper: return a line for a ClientQueue index file describing the
+       packet 'handle', which will go to 'routing' and was queued at
+       'when'."""
+    if isinstance(routing, mixminion.Packet.IPV4Info):
+        tp = "4"
+    else:
+        tp = "H"
+    return "%s %s %s %d\n" % (handle, tp, binascii.b2a_hex(routing.pack()),
+                              when)
+
 # ----------------------------------------------------------------------
 
 class ClientFragmentPool:
@@ -946,16 +1158,21 @@ class ClientFragmentPool:
         pool = self.__getPool()
         state = pool.getStateByMsgID(msgid)
         if state is not None:
-            msg = pool.getReadyMessage(state.messageid)
-            if msg is not None:
+            f = pool.openReadyMessage(state.messageid)
+            if f is not None:
+                # Decompress straight from the pool's scratch file, so we
+                # stop reading as soon as the message looks overcompressed.
                 try:
-                    if force:
-                        maxSize = None
-                    else:
-                        maxSize = len(msg)*20
-                    return mixminion.Packet.uncompressData(msg,maxSize)
-                except mixminion.Packet.ParseError, e:
-                    raise UIError("Invalid message %s: %s"%(msgid,e))
+                    try:
+                        if force:
+                            maxSize = None
+                        else:
+                            maxSize = f.length*20
+                        return mixminion.Packet.uncompressFile(f,maxSize)
+                    except mixminion.Packet.ParseError, e:
+                        raise UIError("Invalid message %s: %s"%(msgid,e))
+                finally:
+                    f.close()
 
         if state is None:
             raise UIError("No such message as '%s'" % msgid)
@@ -4,12 +4,13 @@
 
    Common functionality and utility code for Mixminion"""
 
-__all__ = ['IntervalSet', 'Lockfile', 'LockfileLocked', 'LOG', 'LogStream',
-           'MixError',
+__all__ = ['ArmoredTextReader', 'IntervalSet', 'Lockfile', 'LockfileLocked',
+           'LOG', 'LogStream', 'MixError',
            'MixFatalError', 'MixProtocolError', 'UIError', 'UsageError',
            'armorText', 'ceilDiv', 'checkPrivateDir', 'checkPrivateFile',
            'createPrivateDir', 'disp64',
-           'encodeBase64', 'englishSequence', 'floorDiv', 'formatBase64',
+           'encodeBase64', 'englishSequence', 'floorDiv', 'flushLogs',
+           'formatBase64',
            'formatDate', 'formatFnameDate', 'formatFnameTime', 'formatTime',
            'installSIGCHLDHandler', 'isSMTPMailbox', 'iterFileLines',
            'openUnique', 'parseFnameDate',
@@ -318,10 +319,6 @@ def unarmorText(s, findTypes, base64=1, base64fn=None):
     result = []
 
     while 1:
-        tp = None
-        fields = []
-        value = None
-
         mBegin = BEGIN_LINE_RE.search(s)
         if not mBegin:
             return result
@@ -342,41 +339,102 @@ def unarmorText(s, findTypes, base64=1, base64fn=None):
         endIdx = mEnd.start()
 
         assert s[idx-1] == s[endIdx-1] == '\n'
-        while idx < endIdx:
-            nl = s.index("\n", idx, endIdx)
-            line = s[idx:nl]
-            idx = nl+1
-            if ":" in line:
-                m = ARMOR_KV_RE.match(line)
-                if not m:
-                    raise ValueError("Bad header for '%s'" % tp.lower())
-                fields.append((m.group(1), m.group(2)))
-            elif line.strip() == '':
-                break
+        result.append(_parseArmoredBody(tp, s, idx, endIdx, base64,
+                                        base64fn))
 
-        if base64fn:
-            base64 = base64fn(tp, fields)
+        s = s[mEnd.end()+1:]
 
-        if base64:
-            try:
-                if stringContains(s[idx:endIdx], "\n[...]"):
-                    raise UIError("Corrupted data: value seems to be "
-                                  "truncated by a Mixminion/Mixmaster gateway")
-                value = binascii.a2b_base64(s[idx:endIdx])
-            except (TypeError, binascii.Incomplete, binascii.Error), e:
-                raise ValueError(str(e))
-        else:
-            v = s[idx:endIdx].split("\n")
-            for i in xrange(len(v)):
-                if v[i].startswith("- "):
-                    v[i] = v[i][2:]
-            value = "\n".join(v)
+    raise MixFatalError("Unreachable code somehow reached.")
 
-        result.append((tp, fields, value))
+def _parseArmoredBody(tp, s, idx, endIdx, base64, base64fn):
+    """Helper: parse the headers and body of an armored message of type
+       'tp', found in s[idx:endIdx].  Arguments are as for unarmorText.
+       Returns a (type, headers, body) tuple."""
+    fields = []
+    while idx < endIdx:
+        nl = s.index("\n", idx, endIdx)
+        line = s[idx:nl]
+        idx = nl+1
+        if ":" in line:
+            m = ARMOR_KV_RE.match(line)
+            if not m:
+                raise ValueError("Bad header for '%s'" % tp.lower())
+            fields.append((m.group(1), m.group(2)))
+        elif line.strip() == '':
+            break
 
-        s = s[mEnd.end()+1:]
+    if base64fn:
+        base64 = base64fn(tp, fields)
 
-    raise MixFatalError("Unreachable code somehow reached.")
+    if base64:
+        try:
+            if stringContains(s[idx:endIdx], "\n[...]"):
+                raise UIError("Corrupted data: value seems to be "
+                              "truncated by a Mixminion/Mixmaster gateway")
+            value = binascii.a2b_base64(s[idx:endIdx])
+        except (TypeError, binascii.Incomplete, binascii.Error), e:
+            raise ValueError(str(e))
+    else:
+        v = s[idx:endIdx].split("\n")
+        for i in xrange(len(v)):
+            if v[i].startswith("- "):
+                v[i] = v[i][2:]
+        value = "\n".join(v)
+
+    return tp, fields, value
+
+class ArmoredTextReader:
+    """An ArmoredTextReader parses OpenPGP-style ASCII-armored messages
+       from a file object one at a time, so that we never hold more than
+       one message in memory.  Iterating over it yields the same
+       (type, headers, body) tuples that unarmorText returns, and raises
+       the same errors.
+    """
+    ## Fields:
+    # _file: the file we're reading from.
+    # _findTypes, _base64, _base64fn: as for unarmorText.
+    def __init__(self, f, findTypes, base64=1, base64fn=None):
+        """Create a new ArmoredTextReader to read messages from the file
+           object 'f'.  Other arguments are as for unarmorText."""
+        self._file = f
+        self._findTypes = findTypes
+        self._base64 = base64
+        self._base64fn = base64fn
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the next (type, headers, body) tuple, or raise
+           StopIteration if there are no more messages."""
+        readline = self._file.readline
+        while 1:
+            line = readline()
+            if not line:
+                raise StopIteration
+            mBegin = BEGIN_LINE_RE.match(line)
+            if not mBegin:
+                continue
+
+            tp = mBegin.group(1)
+            endRE = re.compile(r"^-----END %s-----[ \t]*\r?$" % tp)
+            wanted = tp in self._findTypes
+            body = []
+            while 1:
+                line = readline()
+                if not line:
+                    raise ValueError("Couldn't find end line for '%s'"
+                                     % tp.lower())
+                if endRE.match(line):
+                    break
+                if wanted:
+                    body.append(line)
+            if not wanted:
+                continue
+
+            body = "".join(body)
+            return _parseArmoredBody(tp, body, 0, len(body), self._base64,
+                                     self._base64fn)
 
 # ----------------------------------------------------------------------
 
@@ -884,22 +942,37 @@ def _logtime(_time=time.time, _strftime=time.strftime,
     #    (t*1000)%1000)
 
 
+# How often, in seconds, do we flush buffered log messages to disk?
+LOG_FLUSH_INTERVAL = 5
+# How many log messages will we buffer before flushing them regardless?
+LOG_MAX_BUFFERED = 256
+
 class _FileLogHandler:
     """Helper class for logging.  Represents a file on disk, and allows the
-       usual close-and-open gimmick for log rotation."""
+       usual close-and-open gimmick for log rotation.
+
+       Messages are buffered in memory, and written out when a WARN-or-worse
+       message arrives, when LOG_FLUSH_INTERVAL seconds have passed since the
+       last flush, when the buffer holds LOG_MAX_BUFFERED messages, or when
+       flush() is called."""
     # Fields:
     #     file -- a file object, or None if the file is closed.
     #     fname -- this log's associated filename
+    #     buf -- a list of formatted lines not yet written to file.
+    #     nextFlush -- the time after which we flush on the next write.
     def __init__(self, fname):
         "Create a new FileLogHandler to append messages to fname"
         self.file = None
         self.fname = fname
+        self.buf = []
+        self.nextFlush = 0
         self.reset()
 
     def reset(self):
         """Close and reopen our underlying file.  This behavior is needed
            to implement log rotation."""
         if self.file is not None:
+            self.flush()
             self.file.close()
         try:
             parent = os.path.split(self.fname)[0]
@@ -912,14 +985,27 @@ class _FileLogHandler:
 
     def close(self):
         "Close the underlying file"
+        self.flush()
         self.file.close()
 
+    def flush(self):
+        "Write all buffered messages to the underlying file."
+        self.nextFlush = time.time() + LOG_FLUSH_INTERVAL
+        if self.file is None or not self.buf:
+            return
+        self.file.write("".join(self.buf))
+        del self.buf[:]
+        self.file.flush()
+
     def write(self, severity, message):
         """(Used by Log: write a message to this log handler.)"""
         if self.file is None:
             return
-        print >> self.file, "%s [%s] %s" % (_logtime(), severity, message)
-        self.file.flush()
+        self.buf.append("%s [%s] %s\n" % (_logtime(), severity, message))
+        if (_SEVERITIES.get(severity, 100) >= _SEVERITIES['WARN'] or
+            len(self.buf) >= LOG_MAX_BUFFERED or
+            time.time() >= self.nextFlush):
+            self.flush()
 
 
 class _ConsoleLogHandler:
@@ -935,6 +1021,9 @@ class _ConsoleLogHandler:
     def close(self):
         pass
 
+    def flush(self):
+        pass
+
     def write(self, severity, message):
         """(Used by Log: write a message to this log handler.)"""
         print >> self.file, "%s [%s] %s" % (_logtime(), severity, message)
@@ -948,6 +1037,10 @@ _SEVERITIES = {'TRACE': -2,
                'FATAL': 3,
                'NEVER': 100}
 
+# List of (method name, severity) for the per-severity methods on Log.
+_SEVERITY_METHODS = [('trace', 'TRACE'), ('debug', 'DEBUG'), ('info', 'INFO'),
+                     ('warn', 'WARN'), ('error', 'ERROR'), ('fatal', 'FATAL')]
+
 
 class Log:
     """A Log is a set of destinations for system messages, along with the
@@ -1026,6 +1119,13 @@ class Log:
         """Sets the minimum severity of messages to be logged.
               minSeverity -- the string representation of a severity level."""
         self.severity = _SEVERITIES.get(minSeverity, 1)
+        # Shadow the methods for suppressed severities with a no-op, so
+        # that calls like LOG.trace in hot paths cost only a function call.
+        for name, severity in _SEVERITY_METHODS:
+            if _SEVERITIES[severity] < self.severity:
+                setattr(self, name, self._ignore)
+            elif self.__dict__.has_key(name):
+                delattr(self, name)
 
     def getMinSeverity(self):
         """Return a string representation of this log's minimum severity
@@ -1056,6 +1156,15 @@ class Log:
         for h in self.handlers:
             h.close()
 
+    def flush(self):
+        """Write any buffered messages to disk."""
+        self.__lock.acquire()
+        try:
+            for h in self.handlers:
+                h.flush()
+        finally:
+            self.__lock.release()
+
     def log(self, severity, message, *args):
         """Send a message of a given severity to the log.  If additional
            arguments are provided, write 'message % args'. """
@@ -1065,18 +1174,13 @@ class Log:
         """Helper method: If we aren't ignoring messages of level 'severity',
            then send message%args to all the underlying log handlers."""
 
-        # Enable this block to bail early in production versions
-        # if _SEVERITIES.get(severity, 100) < self.severity:
-        #    return
+        if _SEVERITIES.get(severity, 100) < self.severity:
+            return
         if args is None:
             m = message
         else:
             m = message % args
 
-        # Enable this block to debug message formats.
-        if _SEVERITIES.get(severity, 100) < self.severity:
-            return
-
         self.__lock.acquire()
         try:
             for h in self.handlers:
@@ -1084,6 +1188,10 @@ class Log:
         finally:
             self.__lock.release()
 
+    def _ignore(self, message, *args):
+        "Stands in for the method of any severity we are suppressing."
+        pass
+
     def trace(self, message, *args):
         "Write a trace (hyperverbose) message to the log"
         self.log("TRACE", message, *args)
@@ -1139,6 +1247,53 @@ class Log:
         "Same as log_exc, but logs a fatal message."
         self.log_exc("FATAL", (exclass, ex, tb), message, *args)
 
+class _BufferedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """A TimedRotatingFileHandler that doesn't flush the file after every
+       record.  Records below flushLevel stay in the file's buffer until
+       flushInterval seconds have passed since the last flush, or until
+       someone calls flush() directly (as flushLogs does)."""
+    # Fields:
+    #     flushInterval -- the longest we'll hold a record before flushing.
+    #     flushLevel -- records at this level or above are flushed at once.
+    #     _deferFlush -- true while we are emitting a low-severity record.
+    #     _nextFlush -- the time after which emit will flush again.
+    def __init__(self, filename, flushInterval=LOG_FLUSH_INTERVAL,
+                 flushLevel=logging.WARN, **kwargs):
+        logging.handlers.TimedRotatingFileHandler.__init__(
+            self, filename, **kwargs)
+        self.flushInterval = flushInterval
+        self.flushLevel = flushLevel
+        self._deferFlush = 0
+        self._nextFlush = time.time() + flushInterval
+
+    def emit(self, record):
+        # (Called with our lock held.)
+        self._deferFlush = record.levelno < self.flushLevel
+        try:
+            logging.handlers.TimedRotatingFileHandler.emit(self, record)
+        finally:
+            self._deferFlush = 0
+
+    def flush(self):
+        self.acquire()
+        try:
+            now = time.time()
+            if self._deferFlush and now < self._nextFlush:
+                return
+            self._nextFlush = now + self.flushInterval
+            logging.handlers.TimedRotatingFileHandler.flush(self)
+        finally:
+            self.release()
+
+def _noTrace(self, message, *args, **kws):
+    "Stands in for Logger.trace when no handler accepts TRACE messages."
+    pass
+
+def flushLogs():
+    """Write any log messages buffered by the server's log handlers."""
+    for h in logging.getLogger('mixminion').handlers:
+        h.flush()
+
 def initLogging(config):
     # Python's logging module doesn't include TRACE by default.
     logging.TRACE = 9
@@ -1146,7 +1301,6 @@ def initLogging(config):
     def trace(self, message, *args, **kws):
         if self.isEnabledFor(logging.TRACE):
             self._log(logging.TRACE, message, args, **kws)
-    logging.Logger.trace = trace
 
     # Map loglevels so they can be easily defined in a config file
     loglevels = {'trace': logging.TRACE,
@@ -1165,9 +1319,8 @@ def initLogging(config):
 
     # Create the mixminion logging instance
     log = logging.getLogger('mixminion')
-    log.setLevel(logging.TRACE)
     # Create log file handler
-    fh = logging.handlers.TimedRotatingFileHandler(
+    fh = _BufferedRotatingFileHandler(
         logfile,
         when='midnight',
         interval=1,
@@ -1189,6 +1342,14 @@ def initLogging(config):
     # Add handlers to log
     log.addHandler(ch)
     log.addHandler(fh)
+    # Don't accept records that every handler would discard: that way,
+    # log.debug() and friends return before building a LogRecord.  If no
+    # handler wants TRACE, make Logger.trace a no-op altogether.
+    log.setLevel(min(fh.level, ch.level))
+    if log.isEnabledFor(logging.TRACE):
+        logging.Logger.trace = trace
+    else:
+        logging.Logger.trace = _noTrace
     return log
 
 
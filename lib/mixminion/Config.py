@@ -1031,6 +1031,7 @@ class ClientConfig(_ConfigFile):
              'EntropySource': ('ALLOW', "filename", "/dev/urandom"),
              'TrustedUser': ('ALLOW*', "user", None),
              'FileParanoia': ('ALLOW', "boolean", "yes"),
+             'BuildProcesses': ('ALLOW', "int", "1"),
              },
         'DirectoryServers':
             {'__SECTION__': ('ALLOW', None, None),
@@ -1057,6 +1058,7 @@ class ClientConfig(_ConfigFile):
         'Network':
             {'ConnectionTimeout': ('ALLOW', "interval", None),
              'Timeout': ('ALLOW', "interval", None),
+             'TotalTimeout': ('ALLOW', "interval", None),
              }
 
         }
@@ -1082,6 +1084,8 @@ class ClientConfig(_ConfigFile):
 
     def validate(self, lines, contents):
         _validateHostSection(self['Host'])
+        if self['Host'].get('BuildProcesses', 1) < 1:
+            raise ConfigError("BuildProcesses must be at least 1")
 
         t = self['Network'].get('ConnectionTimeout')
         if t is not None:
@@ -1117,6 +1121,14 @@ class ClientConfig(_ConfigFile):
         # ...default to 2 minutes.
         return 120
 
+    def getTotalTimeout(self):
+        """Return the longest time to spend sending a batch of packets to
+           all their first hops, or None if there is no limit."""
+        t = self.get("Network", {}).get("TotalTimeout", None)
+        if t is not None:
+            return int(t)
+        return None
+
     def isServerConfig(self):
         """Return true iff this is a server configuration."""
         return 0
@@ -23,13 +23,14 @@ from mixminion.Common import MixError, MixFatalError, floorDiv, ceilDiv
 
 __all__ = ['AESCounterPRNG', 'CryptoError', 'Keyset', 'bear_decrypt',
            'bear_encrypt', 'ctr_crypt', 'getCommonPRNG', 'init_crypto',
-           'lioness_decrypt', 'lioness_encrypt', 'openssl_seed',
+           'lioness_decrypt', 'lioness_encrypt', 'new_sha1', 'openssl_seed',
            'pk_check_signature', 'pk_decode_private_key',
            'pk_decode_public_key', 'pk_decrypt', 'pk_encode_private_key',
            'pk_encode_public_key', 'pk_encrypt', 'pk_fingerprint',
            'pk_from_modulus', 'pk_generate', 'pk_get_modulus',
-           'pk_same_public_key', 'pk_sign', 'prng', 'sha1', 'strxor', 'trng',
-           'unwhiten', 'whiten',
+           'pk_same_public_key', 'pk_sign', 'prng', 'reinit_after_fork',
+           'sha1', 'strxor', 'trng',
+           'unwhiten', 'unwhiten_file', 'whiten',
            'AES_KEY_LEN', 'DIGEST_LEN', 'HEADER_SECRET_MODE', 'PRNG_MODE',
            'RANDOM_JUNK_MODE', 'HEADER_ENCRYPT_MODE', 'APPLICATION_KEY_MODE',
            'PAYLOAD_ENCRYPT_MODE', 'HIDE_HEADER_MODE']
@@ -47,6 +48,14 @@ generate_cert = _ml.generate_cert
 AES_KEY_LEN = 128 >> 3
 # Number of bytes in a SHA1 digest
 DIGEST_LEN = 160 >> 3
+# Number of bytes to read at a time when operating on files.
+FILE_CHUNK_LEN = 64*1024
+
+# Older versions of Python have no hashlib; fall back to the sha module.
+try:
+    from hashlib import sha1 as _new_sha1
+except ImportError:
+    from sha import new as _new_sha1
 
 
 def init_crypto(config=None):
@@ -63,11 +72,33 @@ def init_crypto(config=None):
     openssl_seed(40)
 
 
+def reinit_after_fork():
+    """Called in a newly forked child process: make sure that the child
+       shares no cached entropy or pseudorandom state with its parent."""
+    global _theTrueRNG
+    if _TRNG_FILENAME is not None and isinstance(_theTrueRNG, _TrueRNG):
+        _theTrueRNG = _TrueRNG(1024)
+    else:
+        configure_trng(None)
+    try:
+        del threading.currentThread().minion_shared_PRNG
+    except AttributeError:
+        pass
+    openssl_seed(40)
+
+
 def sha1(s):
     """Return the SHA1 hash of a string"""
     return _ml.sha1(s)
 
 
+def new_sha1(s=""):
+    """Return a new incremental SHA1 object, initialized with the string
+       's'.  Use its update() and digest() methods to hash data that is
+       too large to hold in memory all at once."""
+    return _new_sha1(s)
+
+
 def strxor(s1, s2):
     """Computes the bitwise xor of two strings.  Raises an exception if the
        strings' lengths are unequal.
@@ -96,105 +127,41 @@ def prng(key, count, idx=0):
     return _ml.aes_ctr128_crypt(key, "", idx, count)
 
 
-def lioness_encrypt(s, (key1, key2, key3, key4)):
+def lioness_encrypt(s, keys):
     """Given four 20-byte keys, encrypts s using the LIONESS
        super-pseudorandom permutation.
-    """
 
-    assert len(key1) == len(key3) == DIGEST_LEN
-    assert len(key2) == len(key4) == DIGEST_LEN
-    assert len(s) > DIGEST_LEN
-
-    # Split the message.
-    left = s[:DIGEST_LEN]
-    right = s[DIGEST_LEN:]
-    del s
-    # Performance note: This business with sha1("".join((key,right,key)))
-    # may look slow, but it contributes only .7% to the total time for
-    # LIONESS.
-    right = _ml.aes_ctr128_crypt(
-        _ml.aes_key(_ml.sha1("".join((key1, left, key1)))[:AES_KEY_LEN]),
-        right, 0)
-    left = _ml.strxor(left, _ml.sha1("".join((key2, right, key2))))
-    right = _ml.aes_ctr128_crypt(
-        _ml.aes_key(_ml.sha1("".join((key3, left, key3)))[:AES_KEY_LEN]),
-        right, 0)
-    left = _ml.strxor(left, _ml.sha1("".join((key4, right, key4))))
-
-    # You could write the above as:
-    #   right = ctr_crypt(right, "".join((key1,left,key1))[:AES_KEY_LEN])
-    #   left = strxor(left, sha1("".join((key2,right,key2))))
-    #   right = ctr_crypt(right, "".join((key3,left,key3))[:AES_KEY_LEN])
-    #   left = strxor(left, sha1("".join((key4,right,key4))))
-    # but that would be slower by about 10%.  (Since LIONESS is in the
-    # critical path, we care.)
-    return left + right
-
-
-def lioness_decrypt(s, (key1, key2, key3, key4)):
-    """Given a 16-byte key2 and key4, and a 20-byte key1 and key3, decrypts
-       s using the LIONESS super-pseudorandom permutation.
+       If s is a string, returns the encrypted string.  If s is a writable
+       buffer (such as an array.array('c')), encrypts it in place.
     """
+    # The whole operation happens in C, without the GIL: two keyed SHA1
+    # digests of the right half, two counter-mode passes, and no
+    # temporary strings.
+    return _ml.lioness_encrypt(s, keys)
 
-    assert len(key1) == len(key3) == DIGEST_LEN
-    assert len(key2) == len(key4) == DIGEST_LEN
-    assert len(s) > DIGEST_LEN
-
-    left = s[:DIGEST_LEN]
-    right = s[DIGEST_LEN:]
-    del s
-
-    # Slow, comprehensible version:
-    # left = strxor(left,  sha1("".join([key4,right,key4])))
-    # right = ctr_crypt(right, sha1("".join([key3,left,key3]))[:AES_KEY_LEN])
-    # left = strxor(left,  sha1("".join([key2,right,key2])))
-    # right = ctr_crypt(right, sha1("".join([key1,left,key1]))[:AES_KEY_LEN])
-
-    # Equivalent-but-faster version:
-    left = _ml.strxor(left, _ml.sha1("".join((key4, right, key4))))
-    right = _ml.aes_ctr128_crypt(
-        _ml.aes_key(_ml.sha1("".join((key3, left, key3)))[:AES_KEY_LEN]),
-        right, 0)
-    left = _ml.strxor(left, _ml.sha1("".join((key2, right, key2))))
-    right = _ml.aes_ctr128_crypt(
-        _ml.aes_key(_ml.sha1("".join((key1, left, key1)))[:AES_KEY_LEN]),
-        right, 0)
-
-    return left + right
-
-
-def bear_encrypt(s, (key1, key2)):
-    """Given four 20-byte keys, encrypts s using the BEAR
-       pseudorandom permutation.
-    """
-
-    assert len(key1) == len(key2) == DIGEST_LEN
-    assert len(s) > DIGEST_LEN
 
-    left = s[:DIGEST_LEN]
-    right = s[DIGEST_LEN:]
-    del s
-    left = _ml.strxor(left, _ml.sha1("".join((key1, right, key1))))
-    right = ctr_crypt(right, _ml.sha1(left)[:AES_KEY_LEN])
-    left = _ml.strxor(left, _ml.sha1("".join((key2, right, key2))))
-    return left + right
+def lioness_decrypt(s, keys):
+    """Given four 20-byte keys, decrypts s using the LIONESS
+       super-pseudorandom permutation.  Handles writable buffers as
+       lioness_encrypt does.
+    """
+    return _ml.lioness_decrypt(s, keys)
 
 
-def bear_decrypt(s, (key1, key2)):
-    """Given four 20-byte keys, decrypts s using the BEAR
-       pseudorandom permutation.
+def bear_encrypt(s, keys):
+    """Given two 20-byte keys, encrypts s using the BEAR
+       pseudorandom permutation.  Handles writable buffers as
+       lioness_encrypt does.
     """
+    return _ml.bear_encrypt(s, keys)
 
-    assert len(key1) == len(key2) == DIGEST_LEN
-    assert len(s) > DIGEST_LEN
 
-    left = s[:DIGEST_LEN]
-    right = s[DIGEST_LEN:]
-    del s
-    left = _ml.strxor(left, _ml.sha1("".join((key2, right, key2))))
-    right = ctr_crypt(right, _ml.sha1(left)[:AES_KEY_LEN])
-    left = _ml.strxor(left, _ml.sha1("".join((key1, right, key1))))
-    return left + right
+def bear_decrypt(s, keys):
+    """Given two 20-byte keys, decrypts s using the BEAR
+       pseudorandom permutation.  Handles writable buffers as
+       lioness_encrypt does.
+    """
+    return _ml.bear_decrypt(s, keys)
 
 
 def whiten(s):
@@ -213,6 +180,72 @@ def unwhiten(s):
     return lioness_decrypt(s, keys)
 
 
+def unwhiten_file(f, length):
+    """Given a file object 'f', open for reading and writing, whose first
+       'length' bytes are a whitened string, replace those bytes with the
+       original string.  Unlike unwhiten, this function uses a bounded
+       amount of memory no matter how long the string is."""
+    keys = Keyset("WHITEN").getLionessKeys("WHITEN")
+    lioness_decrypt_file(f, length, keys)
+
+
+def _sha1_file(f, offset, length, key):
+    """Helper: return SHA1(key || data || key), where data is the 'length'
+       bytes of the file 'f' beginning at 'offset'."""
+    d = _new_sha1(key)
+    f.seek(offset)
+    while length > 0:
+        s = f.read(min(length, FILE_CHUNK_LEN))
+        if not s:
+            raise MixError("File too short")
+        d.update(s)
+        length -= len(s)
+    d.update(key)
+    return d.digest()
+
+
+def _ctr_crypt_file(f, offset, length, key):
+    """Helper: encrypt the 'length' bytes of the file 'f' beginning at
+       'offset' in place, in counter mode with the 16-byte key 'key'.  The
+       counter begins at 0 at 'offset'."""
+    key = _ml.aes_key(key)
+    pos = 0
+    while pos < length:
+        f.seek(offset+pos)
+        s = f.read(min(length-pos, FILE_CHUNK_LEN))
+        if not s:
+            raise MixError("File too short")
+        f.seek(offset+pos)
+        f.write(_ml.aes_ctr128_crypt(key, s, pos))
+        pos += len(s)
+
+
+def lioness_decrypt_file(f, length, (key1, key2, key3, key4)):
+    """Given four 20-byte keys, decrypt the first 'length' bytes of the
+       file 'f' in place using the LIONESS super-pseudorandom permutation.
+       'f' must be open for reading and writing.  Equivalent to
+       lioness_decrypt, but reads the file FILE_CHUNK_LEN bytes at a
+       time."""
+    assert len(key1) == len(key3) == DIGEST_LEN
+    assert len(key2) == len(key4) == DIGEST_LEN
+    assert length > DIGEST_LEN
+
+    f.seek(0)
+    left = f.read(DIGEST_LEN)
+    rlen = length - DIGEST_LEN
+
+    left = _ml.strxor(left, _sha1_file(f, DIGEST_LEN, rlen, key4))
+    _ctr_crypt_file(f, DIGEST_LEN, rlen,
+                    _ml.sha1("".join((key3, left, key3)))[:AES_KEY_LEN])
+    left = _ml.strxor(left, _sha1_file(f, DIGEST_LEN, rlen, key2))
+    _ctr_crypt_file(f, DIGEST_LEN, rlen,
+                    _ml.sha1("".join((key1, left, key1)))[:AES_KEY_LEN])
+
+    f.seek(0)
+    f.write(left)
+    f.flush()
+
+
 def openssl_seed(count):
     """Seeds the openssl rng with 'count' bytes of real entropy."""
     _ml.openssl_seed(trng(count))
@@ -215,6 +215,12 @@ class BaseStore:
             return f, handle
         raise AssertionError # unreached; appease pychecker
 
+    def reopenNewMessage(self, handle):
+        """Given a handle for a message returned by openNewMessage, and not
+           yet finished or aborted, return a new file object open for
+           reading and writing that message."""
+        return open(os.path.join(self.dir, "inp_"+handle), 'r+b')
+
     def finishMessage(self, f, handle, _ismeta=0):
         """Given a file and a corresponding handle, closes the file
            commits the corresponding message."""
@@ -257,10 +263,10 @@ class BaseStore:
                 rmv.append(os.path.join(self.dir, m))
             elif m.startswith("inp_"):
                 try:
-                    s = os.stat(m)
+                    s = os.stat(os.path.join(self.dir, m))
                     if s[stat.ST_MTIME] < allowedTime:
                         self._changeState(m[4:], "inp", "rmv")
-                        rmv.append(os.path.join(self.dir, m))
+                        rmv.append(os.path.join(self.dir, "rmv_"+m[4:]))
                 except OSError:
                     pass
         if secureDeleteFn:
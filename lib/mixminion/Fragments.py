@@ -5,14 +5,18 @@
    Code to fragment and reassemble messages."""
 
 import binascii
+import bisect
+import cPickle
 import logging
 import math
+import os
 import time
 import mixminion._minionlib
 import mixminion.Filestore
-from mixminion.Crypto import ceilDiv, getCommonPRNG, sha1, whiten, unwhiten
-from mixminion.Common import disp64, previousMidnight, MixError, \
-     MixFatalError
+from mixminion.Crypto import ceilDiv, getCommonPRNG, new_sha1, sha1, \
+     whiten, unwhiten_file, FILE_CHUNK_LEN
+from mixminion.Common import disp64, previousMidnight, readPickled, \
+     writePickled, MixError, MixFatalError
 from mixminion.Packet import ENC_FWD_OVERHEAD, PAYLOAD_LEN, \
      FRAGMENT_PAYLOAD_OVERHEAD
 
@@ -110,8 +114,7 @@ class FragmentationParams:
                 blocks.append( chunks[i][j*self.fragCapacity:
                                          (j+1)*self.fragCapacity] )
             chunks[i] = None
-            for j in xrange(self.n):
-                fragments.append( self.fec.encode(j, blocks) )
+            fragments.extend( self.fec.encodeAll(blocks) )
         return fragments
 
 # ======================================================================
@@ -125,13 +128,28 @@ class FragmentPool:
     # store -- instance of StringMetadataStore.  The messages are either
     #    the contents of invidual fragments or reconstructed chunks.
     #    The metadata are instances of FragmentMetadata.
+    # metadata -- map from handle to FragmentMetadata for every fragment
+    #    and chunk in the store.  Saved to 'indexFile' on sync(), so that
+    #    we don't need to unpickle every metadata file on startup.
+    # handlesByMsgID -- map from messageid to a map from the handles of
+    #    that message's fragments and chunks to 1.
+    # indexFile -- name of the file holding the saved metadata index.
+    # indexDirty -- true iff 'metadata' has changed since it was saved.
+    # readyMessages -- map from messageid to 1 for every message whose
+    #    chunks have all been reconstructed.
+    # messagesWithReadyChunks -- map from messageid to 1 for every message
+    #    that has chunks pending reconstruction.
+    # expiryList -- sorted list of (inserted date, messageid) for every
+    #    message in 'states'.
     def __init__(self, dir):
-        """Open a FragmentPool storing fragments in 'dir' and records of
-           old messages in 'dir_db'.
+        """Open a FragmentPool storing fragments in 'dir', records of
+           old messages in 'dir_db', and an index of fragment metadata
+           in 'dir_idx'.
            """
         self.store = mixminion.Filestore.StringMetadataStore(
             dir,create=1)
         self.db = FragmentDB(dir+"_db")
+        self.indexFile = dir+"_idx"
         self.rescan()
 
     def cleanQueue(self, deleteFn=None):
@@ -141,13 +159,16 @@ class FragmentPool:
     def sync(self):
         """Flush pending changes to disk."""
         self.db.sync()
+        self._saveIndex()
 
     def close(self):
         """Release open resources for this pool."""
+        self._saveIndex()
         self.db.close()
         del self.db
         del self.store
         del self.states
+        del self.metadata
 
     def addFragment(self, fragmentPacket, nym=None, now=None, verbose=0):
         """Given an instance of mixminion.Packet.FragmentPayload, record
@@ -191,6 +212,7 @@ class FragmentPool:
                                  nym=nym,
                                  digest=sha1(fragmentPacket.data))
         # ... and allocate or find the MessageState for this message.
+        isNew = not self.states.has_key(meta.messageid)
         state = self._getState(meta)
         try:
             # Check whether we can/should add this message, but do not
@@ -199,7 +221,13 @@ class FragmentPool:
             # No exception was thrown; queue the message.
             h = self.store.queueMessageAndMetadata(fragmentPacket.data, meta)
             # And *now* update the message state.
+            if isNew:
+                oldInserted = None
+            else:
+                oldInserted = state.inserted
             state.addFragment(h, meta)
+            self._noteHandle(h, meta)
+            self._noteStateChanged(state, oldInserted)
             say("Stored fragment %s of message %s",
                 fragmentPacket.index+1, disp64(fragmentPacket.msgID,12))
             return fragmentPacket.msgID
@@ -220,14 +248,55 @@ class FragmentPool:
         """Return the complete message associated with messageid 'msgid'.
            (If no such complete message is found, return None.)  The
            resulting message is unwhitened, but not uncompressed."""
+        f = self.openReadyMessage(msgid)
+        if f is None:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def openReadyMessage(self, msgid):
+        """Return a file-like object to read the complete message associated
+           with messageid 'msgid', or None if no such complete message is
+           found.  The message is unwhitened, but not uncompressed.
+
+           The chunks are copied and unwhitened in a scratch file within
+           the pool, a block at a time, so memory use does not depend on
+           the message length.  The caller must close() the returned
+           object; the scratch file is then removed on the next call to
+           cleanQueue()."""
         s = self.states.get(msgid)
         if not s or not s.isDone():
             return None
 
-        hs = s.getChunkHandles()
-        msg = "".join([self.store.messageContents(h) for h in hs])
-        msg = unwhiten(msg[:s.params.length])
-        return msg
+        length = s.params.length
+        f, handle = self.store.openNewMessage()
+        try:
+            # Concatenate the first 'length' bytes of the chunks.
+            remaining = length
+            for h in s.getChunkHandles():
+                chunk = self.store.openMessage(h)
+                try:
+                    while remaining:
+                        block = chunk.read(min(remaining, FILE_CHUNK_LEN))
+                        if not block:
+                            break
+                        f.write(block)
+                        remaining -= len(block)
+                finally:
+                    chunk.close()
+            f.close()
+            if remaining:
+                raise MixFatalError("Reconstructed chunks too short for %s"
+                                    % disp64(msgid,12))
+            f = self.store.reopenNewMessage(handle)
+            unwhiten_file(f, length)
+            f.seek(0)
+        except:
+            self.store.abortMessage(f, handle)
+            raise
+        return _ReadyMessageFile(self.store, f, handle, length)
 
     def markMessageCompleted(self, msgid, rejected=0):
         """Release all resources associated with the messageid 'msgid', and
@@ -246,42 +315,71 @@ class FragmentPool:
     def listReadyMessages(self):
         """Return a list of all messageIDs that have been completely
            reconstructed."""
-        return [ msgid
-                 for msgid,state in self.states.items()
-                 if state.isDone() ]
+        return self.readyMessages.keys()
 
     def unchunkMessages(self):
         """If any messages are ready for partial or full reconstruction,
            reconstruct as many of their chunks as possible."""
-        for msgid, state in self.states.items():
-            if not state.hasReadyChunks():
-                continue
-            state.reconstruct(self.store)
+        for msgid in self.messagesWithReadyChunks.keys():
+            state = self.states[msgid]
+            oldInserted = state.inserted
+            added, removed = state.reconstruct(self.store)
+            for h in removed:
+                self._forgetHandle(h)
+            for h, fm in added:
+                self._noteHandle(h, fm)
+            self._noteStateChanged(state, oldInserted)
 
     def expireMessages(self, cutoff):
         """Remove all pending messages that were first inserted before
            'cutoff'. """
         expiredMessageIDs = {}
-        for s in self.states.values():
-            if s.inserted < cutoff:
-                expiredMessageIDs[s.messageid] = 1
+        for inserted, msgid in self.expiryList:
+            if inserted >= cutoff:
+                break
+            expiredMessageIDs[msgid] = 1
         self._deleteMessageIDs(expiredMessageIDs, "REJECTED")
 
     def rescan(self):
         """Check all fragment metadata objects on disk, and reconstruct our
            internal view of message states.
+
+           We only unpickle the metadata files for fragments and chunks
+           that are missing from our saved index; if the pool was closed
+           cleanly, that's none of them.
         """
-        # Delete all internal state; reload FragmentMetadatas from disk.
-        self.store.loadAllMetadata(lambda: None)
-        meta = self.store._metadata_cache
+        # Delete all internal state; reload FragmentMetadatas from the
+        # index, and from disk if they aren't indexed.
+        self._loadIndex()
+        meta = self.metadata
+        present = {}
+        for h in self.store.getAllMessages():
+            present[h] = 1
+            if meta.has_key(h):
+                continue
+            try:
+                meta[h] = self.store.getMetadata(h)
+            except KeyError:
+                log.warn("Missing metadata for file %s",h)
+                meta[h] = None
+            except mixminion.Filestore.CorruptedFile:
+                continue
+            self.indexDirty = 1
+        for h in meta.keys():
+            if not present.has_key(h):
+                del meta[h]
+                self.indexDirty = 1
+
         self.states = {}
+        self.handlesByMsgID = {}
         badMessageIDs = {} # map from bad messageID to 1
         unneededHandles = [] # list of handles that aren't needed.
         for h, fm in meta.items():
             if not fm:
                 log.debug("Removing fragment %s with missing metadata", h)
-                self.store.removeMessage(h)
+                self._removeHandle(h)
                 continue
+            self._noteHandle(h, fm)
             try:
                 mid = fm.messageid
                 if badMessageIDs.has_key(mid):
@@ -315,7 +413,14 @@ class FragmentPool:
                 continue
             log.debug("Removing unneeded fragment %s from message ID %r",
                       fm.idx, fm.messageid)
-            self.store.removeMessage(h)
+            self._removeHandle(h)
+
+        # Rebuild the ready sets and the expiry list.
+        self.readyMessages = {}
+        self.messagesWithReadyChunks = {}
+        self.expiryList = []
+        for s in self.states.values():
+            self._noteStateChanged(s, None)
 
         # Now nuke inconsistent messages.
         self._deleteMessageIDs(badMessageIDs, "REJECTED")
@@ -355,12 +460,13 @@ class FragmentPool:
                 whythis = why
             self.db.markStatus(mid, whythis, today)
             try:
-                del self.states[mid]
+                state = self.states[mid]
             except KeyError:
                 pass
-        for h, fm in self.store._metadata_cache.items():
-            if messageIDSet.has_key(fm.messageid):
-                self.store.removeMessage(h)
+            else:
+                self._forgetState(state)
+            for h in self.handlesByMsgID.get(mid, {}).keys():
+                self._removeHandle(h)
 
     def _getState(self, fm):
         """Helper function.  Return the MessageState object associated with
@@ -376,6 +482,98 @@ class FragmentPool:
             self.states[fm.messageid] = state
             return state
 
+    def _noteStateChanged(self, state, oldInserted):
+        """Helper function.  Update readyMessages, messagesWithReadyChunks,
+           and expiryList after a change to the MessageState 'state'.
+           'oldInserted' is the value of state.inserted before the change,
+           or None if the state is not yet in expiryList."""
+        mid = state.messageid
+        if state.isDone():
+            self.readyMessages[mid] = 1
+        if state.hasReadyChunks():
+            self.messagesWithReadyChunks[mid] = 1
+        elif self.messagesWithReadyChunks.has_key(mid):
+            del self.messagesWithReadyChunks[mid]
+        if oldInserted == state.inserted:
+            return
+        if oldInserted is not None:
+            _removeSorted(self.expiryList, (oldInserted, mid))
+        bisect.insort(self.expiryList, (state.inserted, mid))
+
+    def _forgetState(self, state):
+        """Helper function.  Remove the MessageState 'state' from states,
+           readyMessages, messagesWithReadyChunks, and expiryList."""
+        mid = state.messageid
+        del self.states[mid]
+        for d in self.readyMessages, self.messagesWithReadyChunks:
+            try:
+                del d[mid]
+            except KeyError:
+                pass
+        _removeSorted(self.expiryList, (state.inserted, mid))
+
+    def _noteHandle(self, h, fm):
+        """Helper function. Record that the store holds a fragment or chunk
+           with handle 'h' and FragmentMetadata 'fm'."""
+        if not self.metadata.has_key(h):
+            self.metadata[h] = fm
+            self.indexDirty = 1
+        self.handlesByMsgID.setdefault(fm.messageid, {})[h] = 1
+
+    def _forgetHandle(self, h):
+        """Helper function. Record that the fragment or chunk with handle
+           'h' has been removed from the store."""
+        try:
+            fm = self.metadata[h]
+        except KeyError:
+            return
+        del self.metadata[h]
+        self.indexDirty = 1
+        if fm is None:
+            return
+        hs = self.handlesByMsgID.get(fm.messageid)
+        if hs is not None:
+            try:
+                del hs[h]
+            except KeyError:
+                pass
+            if not hs:
+                del self.handlesByMsgID[fm.messageid]
+
+    def _removeHandle(self, h):
+        """Helper function. Remove the fragment or chunk with handle 'h'
+           from the store, and forget about it."""
+        self.store.removeMessage(h)
+        self._forgetHandle(h)
+
+    def _loadIndex(self):
+        """Helper function.  Set self.metadata from the saved index file,
+           or to an empty map if there is no usable index."""
+        self.metadata = {}
+        self.indexDirty = 1
+        try:
+            magic, metadata = readPickled(self.indexFile)
+        except (OSError, IOError, EOFError, cPickle.UnpicklingError,
+                ValueError, TypeError, MixFatalError), e:
+            if os.path.exists(self.indexFile):
+                log.warn("Couldn't read fragment index %s: %s",
+                         self.indexFile, e)
+            return
+        if magic != "FRAGMENT-INDEX-0":
+            log.warn("Unrecognized fragment index %s; ignoring",
+                     self.indexFile)
+            return
+        self.metadata = metadata
+        self.indexDirty = 0
+
+    def _saveIndex(self):
+        """Helper function.  Write self.metadata to the index file, if it has
+           changed."""
+        if not self.indexDirty:
+            return
+        writePickled(self.indexFile, ("FRAGMENT-INDEX-0", self.metadata))
+        self.indexDirty = 0
+
     def getStateByMsgID(self, msgid):
         """Given a message ID (either a 20-byte full ID or a 12-byte
            pretty-printed ID prefix), return a MessageState object for
@@ -409,6 +607,32 @@ class FragmentPool:
                 }
         return result
 
+class _ReadyMessageFile:
+    """Helper class: a read-only file-like object for a reassembled message
+       in a FragmentPool's scratch file.  Closing it removes the scratch
+       file from the pool's store."""
+    ## Fields:
+    # store -- the StringMetadataStore holding the scratch file.
+    # f -- an open file object for the scratch file, or None if closed.
+    # handle -- the handle of the scratch file within 'store'.
+    # length -- the length of the message, in bytes.
+    def __init__(self, store, f, handle, length):
+        self.store = store
+        self.f = f
+        self.handle = handle
+        self.length = length
+
+    def read(self, n=-1):
+        """Read at most n bytes from the message; read all remaining bytes
+           if n is negative."""
+        return self.f.read(n)
+
+    def close(self):
+        """Release the scratch file."""
+        if self.f is not None:
+            self.store.abortMessage(self.f, self.handle)
+            self.f = None
+
 # ======================================================================
 
 class MismatchedFragment(Exception):
@@ -603,9 +827,13 @@ class MessageState:
 
     def reconstruct(self, store):
         """If any of the chunks in this message are pending reconstruction,
-           reconstruct them in a given store."""
+           reconstruct them in a given store.  Return a 2-tuple of a list
+           of (handle, FragmentMetadata) for the newly stored chunks, and
+           a list of the handles of the fragments they replace."""
+        added = []
+        removed = []
         if not self.readyChunks:
-            return
+            return added, removed
         for chunkno in self.readyChunks.keys():
             # Get the first K fragments in the chunk. (list of h,fm)
             ch = self.fragmentsByChunk[chunkno].values()[:self.params.k]
@@ -613,24 +841,36 @@ class MessageState:
             # Build a list of (position-within-chunk, fragment-contents).
             frags = [(self.params.getPosition(fm.idx)[1],
                       store.messageContents(h)) for h,fm in ch]
-            chunkText = "".join(self.params.getFEC().decode(frags))
+            blocks = self.params.getFEC().decode(frags)
             del frags
+            # Write the chunk a block at a time, rather than joining the
+            # decoded blocks into one big string.
+            f, h2 = store.openNewMessage()
+            digest = new_sha1()
+            for i in xrange(len(blocks)):
+                f.write(blocks[i])
+                digest.update(blocks[i])
+                blocks[i] = None
+            del blocks
             fm2 = FragmentMetadata(messageid=self.messageid,
                                    idx=chunkno, size=self.params.length,
                                    isChunk=1, chunkNum=chunkno,
                                    overhead=self.overhead,
                                    insertedDate=minDate, nym=self.nym,
-                                   digest=sha1(chunkText))
+                                   digest=digest.digest())
             # Queue the chunk.
-            h2 = store.queueMessageAndMetadata(chunkText, fm2)
-            del chunkText
+            store.setMetadata(h2, fm2)
+            store.finishMessage(f, h2)
             # Remove superceded fragments.
             for h, fm in ch:
                 store.removeMessage(h)
+                removed.append(h)
             # Update this MessageState object.
             self.fragmentsByChunk[chunkno] = {}
             del self.readyChunks[chunkno]
             self.addChunk(h2, fm2)
+            added.append((h2, fm2))
+        return added, removed
 
     def getUnneededFragmentHandles(self):
         """Returns any handles for fragments that have been superceded by
@@ -674,6 +914,13 @@ class FragmentDB(mixminion.Filestore.DBBase):
         tm = int(v[2:])
         return status, tm
 
+# ======================================================================
+def _removeSorted(lst, item):
+    """Helper: remove 'item' from the sorted list 'lst', if it is there."""
+    i = bisect.bisect_left(lst, item)
+    if i < len(lst) and lst[i] == item:
+        del lst[i]
+
 # ======================================================================
 # Internal lazy-generated cache from (k,n) to _minionlib.FEC object.
 # Note that we only use k,n for a limited set of k,n.
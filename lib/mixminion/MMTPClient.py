@@ -12,7 +12,8 @@
    easy-to-verify reference implementation of the protocol.)
    """
 
-__all__ = [ "MMTPClientConnection", "sendPackets", "DeliverableMessage" ]
+__all__ = [ "MMTPClientConnection", "sendPackets", "sendPacketsToServers",
+            "DeliverableMessage" ]
 
 import logging
 import socket
@@ -399,6 +400,108 @@ def sendPackets(routing, packetList, timeout=300, callback=None):
        callback -- None, or a function to call with a index into packetList
            after each successful packet delivery.
     """
+    err, = sendPacketsToServers([(routing, packetList, callback)], timeout)
+    if err is not None:
+        raise err
+
+def sendPacketsToServers(batches, timeout=300, totalTimeout=None,
+                         idleHook=None):
+    """Sends lists of packets to several servers at once.  All the
+       connections are opened together, and driven by a single select loop,
+       so that a slow server doesn't hold up delivery to the others.
+
+       batches -- a list of (routing, packetList, callback) tuples, as for
+           sendPackets.
+       timeout -- the number of seconds to wait for data on any single
+           connection before giving up on it.
+       totalTimeout -- None, or a number of seconds after which to give up
+           on every connection that is still open.
+       idleHook -- None, or a function to call whenever we're waiting for
+           the network.  It should return quickly; once it returns false,
+           we stop calling it.
+
+       Returns a list containing, for each batch, None if every packet in
+       the batch was delivered, or a MixProtocolError describing what went
+       wrong.
+    """
+    if totalTimeout is not None:
+        deadline = time.time() + totalTimeout
+    else:
+        deadline = None
+    context = _ml.TLSContext_new()
+    certCache = PeerCertificateCache()
+
+    results = [ None ] * len(batches)
+    # List of (batch index, connection, server name, deliverables).
+    connections = []
+    for batchIdx in xrange(len(batches)):
+        routing, packetList, callback = batches[batchIdx]
+        try:
+            con, serverName = _openConnection(routing, context, certCache)
+        except MixProtocolError, e:
+            results[batchIdx] = e
+            continue
+        deliverables = _addPackets(con, packetList, callback)
+        connections.append((batchIdx, con, serverName, deliverables))
+
+    # Use select to run the connections until they're all done.
+    import select
+    live = {}
+    for _, con, _, _ in connections:
+        live[con.fileno()] = (con, con.getStatus())
+    while live:
+        rfds, wfds, xfds = [], [], []
+        for fd, (con, (wr, ww, isopen)) in live.items():
+            if wr: rfds.append(fd)
+            if ww: wfds.append(fd)
+            if ww==2: xfds.append(fd)
+
+        if idleHook is not None:
+            rfds,wfds,xfds=select.select(rfds,wfds,xfds,0)
+            if not (rfds or wfds or xfds) and not idleHook():
+                idleHook = None
+        else:
+            rfds,wfds,xfds=select.select(rfds,wfds,xfds,3)
+        now = time.time()
+        expired = deadline is not None and now >= deadline
+        for fd, (con, _) in live.items():
+            wr,ww,isopen,_=con.process(fd in rfds, fd in wfds, 0)
+            if isopen:
+                if expired:
+                    log.warn("Giving up on connection to %s after %s seconds",
+                             con.address, totalTimeout)
+                    # process() may have just recorded activity after
+                    # 'now', so use a cutoff in the future to make sure
+                    # the connection is closed and its packets failed.
+                    con.tryTimeout(now+timeout+totalTimeout)
+                    isopen = 0
+                elif con.tryTimeout(now-timeout):
+                    isopen = 0
+            if isopen:
+                live[fd] = (con, (wr,ww,isopen))
+            else:
+                del live[fd]
+
+    for batchIdx, con, serverName, deliverables in connections:
+        # If anything wasn't delivered, or if the connection failed,
+        # report MixProtocolError.
+        for d in deliverables:
+            if d._failed:
+                results[batchIdx] = MixProtocolError(
+                    "Error occurred while delivering packets to %s"%
+                    serverName)
+                break
+        else:
+            if con._isFailed:
+                results[batchIdx] = MixProtocolError(
+                    "Error occurred on connection to %s"%serverName)
+
+    return results
+
+def _openConnection(routing, context=None, certCache=None):
+    """Helper: start connecting to the server described by 'routing'.
+       Return a tuple of the new MMTPClientConnection and the name of the
+       server.  Raise MixProtocolError on failure."""
     # Find out where we're connecting to.
     serverName = mixminion.ServerInfo.displayServerByRouting(routing)
     if isinstance(routing, IPV4Info):
@@ -414,11 +517,16 @@ def sendPackets(routing, packetList, timeout=300, callback=None):
     # Create an MMTPClientConnection
     try:
         con = MMTPClientConnection(
-            family, addr, routing.port, routing.keyinfo, serverName=serverName)
+            family, addr, routing.port, routing.keyinfo, serverName=serverName,
+            context=context, certCache=certCache)
     except socket.error, e:
         raise MixProtocolError(str(e))
 
-    # Queue the items on the list.
+    return con, serverName
+
+def _addPackets(con, packetList, callback):
+    """Helper: queue every item in packetList (as for sendPackets) on the
+       connection 'con'.  Return a list of the DeliverableStrings queued."""
     deliverables = []
     for idx in xrange(len(packetList)):
         p = packetList[idx]
@@ -434,41 +542,7 @@ def sendPackets(routing, packetList, timeout=300, callback=None):
             pkt = DeliverableString(s=p,callback=cb)
         deliverables.append(pkt)
         con.addPacket(pkt)
-
-    # Use select to run the connection until it's done.
-    import select
-    fd = con.fileno()
-    wr,ww,isopen = con.getStatus()
-    while isopen:
-        if wr:
-            rfds = [fd]
-        else:
-            rfds = []
-        if ww:
-            wfds = [fd]
-        else:
-            wfds = []
-        if ww==2:
-            xfds = [fd]
-        else:
-            xfds = []
-
-        rfds,wfds,xfds=select.select(rfds,wfds,xfds,3)
-        now = time.time()
-        wr,ww,isopen,_=con.process(fd in rfds, fd in wfds, 0)
-        if isopen:
-            if con.tryTimeout(now-timeout):
-                isopen = 0
-
-    # If anything wasn't delivered, raise MixProtocolError.
-    for d in deliverables:
-        if d._failed:
-            raise MixProtocolError("Error occurred while delivering packets to %s"%
-                                   serverName)
-
-    # If the connection failed, raise MixProtocolError.
-    if con._isFailed:
-        raise MixProtocolError("Error occurred on connection to %s"%serverName)
+    return deliverables
 
 def pingServer(routing, timeout=60):
     """Try to connect to a server and send a junk packet.
@@ -146,6 +146,7 @@ _COMMANDS = {
     "server-republish": ('mixminion.server.ServerMain', 'runRepublish'),
     "server-upgrade":   ('mixminion.server.ServerMain', 'runUpgrade'),
     "server-stats":     ('mixminion.server.ServerMain', 'printServerStats'),
+    "server-profile":   ('mixminion.server.ServerMain', 'profileServer'),
     "server-DELKEYS":   ('mixminion.server.ServerMain', 'runDELKEYS'),
 
     "dir":              ('mixminion.directory.DirMain', 'main'),
@@ -181,6 +182,7 @@ _USAGE = (
     "   server-republish    [Re-send all keys to directory server]\n" +
     "   server-DELKEYS [Remove generated keys for a Mixminion server]\n" +
     "   server-stats   [List as-yet-unlogged statistics for this server]\n" +
+    "   server-profile [Make a running Mixminion server profile itself]\n" +
     "   server-upgrade [Upgrade a pre-0.0.4 server homedir]\n"
     "                         (For Developers)\n" +
     "   dir            [Administration for server directories]\n" +
@@ -199,6 +201,7 @@ _SERVER_USAGE = (
     "       republish [Re-send all keys to directory server]\n" +
     "       DELKEYS   [Remove generated keys for a Mixminion server]\n" +
     "       stats     [List as-yet-unlogged statistics for this server]\n" +
+    "       profile   [Make a running Mixminion server profile itself]\n" +
     "       upgrade   [Upgrade a pre-0.0.4 server homedir]\n"
     )
 
@@ -22,12 +22,13 @@ __all__ = [ 'compressData', 'CompressedDataTooLong', 'DROP_TYPE',
             'SMTPInfo', 'SMTP_TYPE', 'SWAP_FWD_IPV4_TYPE',
             'SWAP_FWD_HOST_TYPE', 'SingletonPayload',
             'Subheader', 'TAG_LEN', 'TextEncodedMessage',
+            'TextEncodedMessageReader',
             'parseHeader', 'parseIPV4Info', 'parseMMTPHostInfo',
             'parseMBOXInfo', 'parsePacket', 'parseMessageAndHeaders',
             'parsePayload', 'parseRelayInfoByType', 'parseReplyBlock',
             'parseReplyBlocks', 'parseSMTPInfo', 'parseSubheader',
             'parseTextEncodedMessages', 'parseTextReplyBlocks',
-            'uncompressData'
+            'uncompressData', 'uncompressFile'
             ]
 
 import binascii
@@ -40,7 +41,7 @@ import zlib
 from socket import inet_ntoa, inet_aton
 from mixminion.Common import MixError, MixFatalError, encodeBase64, \
      floorDiv, formatBase64, formatTime, isSMTPMailbox, armorText, \
-     unarmorText, isPlausibleHostname
+     unarmorText, isPlausibleHostname, ArmoredTextReader
 from mixminion.Crypto import sha1
 
 if sys.version_info[:3] < (2,2,0):
@@ -423,6 +424,25 @@ def parseServerSideFragmentedMessage(s):
     comp = s[SSF_PREFIX_LEN+rl:]
     return ServerSideFragmentedMessage(rt, ri, comp)
 
+def readServerSideFragmentedMessage(f, length, maxCompressedLength=None):
+    """As parseServerSideFragmentedMessage, but read the message from the
+       file-like object 'f', which holds 'length' bytes.  If the
+       compressed contents would be longer than maxCompressedLength, raise
+       CompressedDataTooLong without reading them."""
+    if length < SSF_PREFIX_LEN:
+        raise ParseError("Server-side fragmented message too short")
+    rt, rl = struct.unpack(SSF_UNPACK_PATTERN, f.read(SSF_PREFIX_LEN))
+    compLen = length - SSF_PREFIX_LEN - rl
+    if compLen < 0:
+        raise ParseError("Server-side fragmented message too short")
+    if maxCompressedLength is not None and compLen > maxCompressedLength:
+        raise CompressedDataTooLong()
+    ri = f.read(rl)
+    comp = f.read(compLen)
+    if len(ri) != rl or len(comp) != compLen:
+        raise ParseError("Server-side fragmented message truncated")
+    return ServerSideFragmentedMessage(rt, ri, comp)
+
 class ServerSideFragmentedMessage:
     def __init__(self, routingtype, routinginfo, compressedContents):
         self.routingtype = routingtype
@@ -521,6 +541,12 @@ def _parseReplyBlock(s):
 class ReplyBlock:
     """A mixminion reply block, including the address of the first hop
        on the path, and the RoutingType and RoutingInfo for the server."""
+    ## Fields:
+    # header, timestamp, routingType, routingInfo, encryptionKey: as
+    #    given to the constructor.  These must not change once the reply
+    #    block is constructed.
+    # _digest: the SHA1 digest of this reply block's packed form, or None
+    #    if we haven't computed it yet.
     def __init__(self, header, useBy, rt, ri, key):
         """Construct a new Reply Block."""
         assert len(header) == HEADER_LEN
@@ -529,6 +555,7 @@ class ReplyBlock:
         self.routingType = rt
         self.routingInfo = ri
         self.encryptionKey = key
+        self._digest = None
 
     def format(self):
         """DOCDOC"""
@@ -546,9 +573,16 @@ class ReplyBlock:
 Expires at: %s GMT
 First server is: %s""" % (digest, expiry, server)
 
+    def getDigest(self):
+        """Return the SHA1 digest of this reply block's packed form.  The
+           digest is computed once and cached."""
+        if self._digest is None:
+            self._digest = sha1(self.pack())
+        return self._digest
+
     def getHexDigest(self):
-        """DOCDOC"""
-        return binascii.b2a_hex(sha1(self.pack()))
+        """Return the digest of this reply block, in hex."""
+        return binascii.b2a_hex(self.getDigest())
 
     def pack(self):
         """Returns the external representation of this reply block"""
@@ -745,59 +779,92 @@ class MBOXInfo:
 
 MESSAGE_ARMOR_NAME = "TYPE III ANONYMOUS MESSAGE"
 
+def _isBase64Message(t,f):
+    """Helper: tell unarmorText whether a message with headers 'f' is
+       base64-encoded."""
+    for k,v in f:
+        if k == "Message-type":
+            if v != 'plaintext':
+                return 1
+    return 0
+
 def parseTextEncodedMessages(msg,force=0):
     """Given a text-encoded Type III packet, return a list of
        TextEncodedMessage objects or raise ParseError.
 
           force -- uncompress the message even if it's overcompressed.
     """
+    unarmored = unarmorText(msg, (MESSAGE_ARMOR_NAME,),
+                            base64fn=_isBase64Message)
+    return [ _parseTextEncodedMessage(fields, val, force)
+             for _, fields, val in unarmored ]
+
+class TextEncodedMessageReader:
+    """A TextEncodedMessageReader reads text-encoded Type III packets from
+       a file object, and yields a TextEncodedMessage for each one as soon
+       as it has been read.  Unlike parseTextEncodedMessages, it never
+       holds more than one message in memory, so it's suitable for
+       decoding large mailboxes.
+    """
+    ## Fields:
+    # _reader: an ArmoredTextReader for the underlying file.
+    # _force: as for parseTextEncodedMessages.
+    def __init__(self, f, force=0):
+        """Create a new TextEncodedMessageReader to read from the file
+           object 'f'.
+
+              force -- uncompress messages even if they're overcompressed.
+        """
+        self._reader = ArmoredTextReader(f, (MESSAGE_ARMOR_NAME,),
+                                         base64fn=_isBase64Message)
+        self._force = force
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the next TextEncodedMessage, raise StopIteration if there
+           are no more, or raise ParseError."""
+        _, fields, val = self._reader.next()
+        return _parseTextEncodedMessage(fields, val, self._force)
+
+def _parseTextEncodedMessage(fields, val, force):
+    """Helper: given the headers and body of a single text-encoded Type
+       III packet, return a TextEncodedMessage or raise ParseError."""
+    d = {}
+    for k,v in fields:
+        d[k] = v
+    if d.get("Message-type", "plaintext") == "plaintext":
+        msgType = 'TXT'
+    elif d['Message-type'] == 'overcompressed':
+        msgType = "LONG"
+    elif d['Message-type'] == 'binary':
+        msgType = "BIN"
+    elif d['Message-type'] == 'encrypted':
+        msgType = "ENC"
+    elif d['Message-type'] == 'fragment':
+        msgType = "FRAG"
+    else:
+        raise ParseError("Unknown message type: %r"%d["Message-type"])
 
-    def isBase64(t,f):
-        for k,v in f:
-            if k == "Message-type":
-                if v != 'plaintext':
-                    return 1
-        return 0
-
-    unarmored = unarmorText(msg, (MESSAGE_ARMOR_NAME,), base64fn=isBase64)
-    res = []
-    for tp,fields,val in unarmored:
-        d = {}
-        for k,v in fields:
-            d[k] = v
-        if d.get("Message-type", "plaintext") == "plaintext":
-            msgType = 'TXT'
-        elif d['Message-type'] == 'overcompressed':
-            msgType = "LONG"
-        elif d['Message-type'] == 'binary':
-            msgType = "BIN"
-        elif d['Message-type'] == 'encrypted':
-            msgType = "ENC"
-        elif d['Message-type'] == 'fragment':
-            msgType = "FRAG"
-        else:
-            raise ParseError("Unknown message type: %r"%d["Message-type"])
-
-        ascTag = d.get("Decoding-handle")
-        if ascTag:
-            msgType = "ENC"
-
-        if msgType == 'LONG' and force:
-            val = uncompressData(val)
+    ascTag = d.get("Decoding-handle")
+    if ascTag:
+        msgType = "ENC"
 
-        if msgType in ('TXT','BIN','LONG','FRAG'):
-            res.append(TextEncodedMessage(val, msgType))
-        else:
-            assert msgType == 'ENC'
-            try:
-                tag = binascii.a2b_base64(ascTag)
-            except (TypeError, binascii.Incomplete, binascii.Error), e:
-                raise ParseError("Error in base64 encoding: %s"%e)
-            if len(tag) != TAG_LEN:
-                raise ParseError("Impossible tag length: %s"%len(tag))
-            res.append(TextEncodedMessage(val, 'ENC', tag))
+    if msgType == 'LONG' and force:
+        val = uncompressData(val)
 
-    return res
+    if msgType in ('TXT','BIN','LONG','FRAG'):
+        return TextEncodedMessage(val, msgType)
+    else:
+        assert msgType == 'ENC'
+        try:
+            tag = binascii.a2b_base64(ascTag)
+        except (TypeError, binascii.Incomplete, binascii.Error), e:
+            raise ParseError("Error in base64 encoding: %s"%e)
+        if len(tag) != TAG_LEN:
+            raise ParseError("Impossible tag length: %s"%len(tag))
+        return TextEncodedMessage(val, 'ENC', tag)
 
 class TextEncodedMessage:
     """A TextEncodedMessage object holds a Type III message as delivered
@@ -1006,6 +1073,54 @@ def uncompressData(payload, maxLength=None):
     except (IOError, ValueError), e:
         raise ParseError("Error in compressed data: %s"%e)
 
+# How much compressed data do we read at a time in uncompressFile?
+UNCOMPRESS_BLOCK_LEN = 64*1024
+
+def uncompressFile(f, maxLength=None):
+    """As uncompressData, but read the compressed data from the file-like
+       object 'f' a block at a time, so that we never hold all of the
+       compressed data in memory along with its expansion, and stop reading
+       as soon as the output grows longer than maxLength."""
+    if sys.version_info[:3] < (2,2,0):
+        return uncompressData(f.read(), maxLength)
+
+    data = f.read(UNCOMPRESS_BLOCK_LEN)
+    if len(data) < 6 or data[0:2] != '\x78\xDA':
+        raise ParseError("Invalid zlib header")
+    zobj = zlib.decompressobj(zlib.MAX_WBITS)
+    out = []
+    nOut = 0
+    try:
+        while data:
+            if maxLength is None:
+                d = zobj.decompress(data)
+                data = ""
+            elif nOut < maxLength:
+                d = zobj.decompress(data, maxLength-nOut)
+                data = zobj.unconsumed_tail
+            else:
+                # We've produced all we're willing to; any more output
+                # means the data is too long.
+                d = zobj.decompress(data, 1)
+                if d:
+                    raise CompressedDataTooLong()
+                data = zobj.unconsumed_tail
+            out.append(d)
+            nOut += len(d)
+            if not data:
+                data = f.read(UNCOMPRESS_BLOCK_LEN)
+        # Get any leftovers, which shouldn't exist unless we stopped at
+        # maxLength with output still pending.
+        if zobj.flush() != '':
+            if maxLength is not None and nOut >= maxLength:
+                raise CompressedDataTooLong()
+            raise ParseError("Error in compressed data")
+        return "".join(out)
+    except zlib.error:
+        raise ParseError("Error in compressed data")
+    except (IOError, ValueError), e:
+        raise ParseError("Error in compressed data: %s"%e)
+
 def _validateZlib():
     """Internal function:  Make sure that zlib is a recognized version, and
        that it compresses things as expected.  (This check is important,
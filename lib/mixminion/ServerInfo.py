@@ -8,8 +8,11 @@
    """
 
 __all__ = [ 'ServerInfo', 'ServerDirectory', 'displayServerByRouting',
-            'getNicknameByKeyID', 'SignedDirectory', 'parseDirectory' ]
+            'getNicknameByKeyID', 'SignedDirectory', 'parseDirectory',
+            'applyDirectoryDiff', 'generateDirectoryDiff',
+            'getDirectoryDiffLocation' ]
 
+import binascii
 import logging
 import re
 import time
@@ -464,6 +467,14 @@ class ServerInfo(mixminion.Config._ConfigFile):
         return IntervalSet([(self['Server']['Valid-After'],
                              self['Server']['Valid-Until'])])
 
+    def getValidAfter(self):
+        """Return the time at which this ServerInfo becomes valid."""
+        return self['Server']['Valid-After']
+
+    def getValidUntil(self):
+        """Return the time at which this ServerInfo stops being valid."""
+        return self['Server']['Valid-Until']
+
     def isExpiredAt(self, when):
         """Return true iff this ServerInfo expires before time 'when'."""
         return self['Server']['Valid-Until'] < when
@@ -544,7 +555,8 @@ class ServerDirectory:
     #    servers in this directory.
     # header: a _DirectoryHeader object for the non-serverinfo part of this
     #    directory.
-    def __init__(self, string=None, fname=None, validatedDigests=None):
+    def __init__(self, string=None, fname=None, validatedDigests=None,
+                 knownServers=None):
         """Create a new ServerDirectory object, either from a literal <string>
            (if specified) or a filename [possibly gzipped].
 
@@ -552,6 +564,12 @@ class ServerDirectory:
            are the digests of already-validated descriptors.  Any descriptor
            whose (calculated) digest matches doesn't need to be validated
            again.
+
+           If knownServers is provided, it must be a dict mapping declared
+           descriptor digests to ServerInfo objects parsed from exactly the
+           same text.  Any descriptor whose declared digest is a key is not
+           parsed again.  (Use this only when the text is known to match,
+           as when applying a directory diff.)
         """
         if string:
             contents = string
@@ -575,9 +593,14 @@ class ServerDirectory:
         self.header = _DirectoryHeader(headercontents, digest)
         self.goodServerNames = [name.lower() for name in
                    self.header['Directory']['Recommended-Servers'] ]
-        servers = [ ServerInfo(string=s,
-                               validatedDigests=validatedDigests)
-                    for s in servercontents ]
+        servers = []
+        for s in servercontents:
+            si = None
+            if knownServers:
+                si = knownServers.get(_getDeclaredDigest(s))
+            if si is None:
+                si = ServerInfo(string=s, validatedDigests=validatedDigests)
+            servers.append(si)
         self.allServers = servers[:]
         goodServers = [ s for s in servers
                         if s.getNickname().lower() in self.goodServerNames ]
@@ -713,6 +736,136 @@ def parseDirectory(fname, validatedDigests=None):
         tp = SignedDirectory
     return tp(fname=fname, string=s, validatedDigests=validatedDigests)
 
+#----------------------------------------------------------------------
+# Directory diffs
+#
+# A directory diff lets a client that holds one [Directory]-format directory
+# reconstruct a newer one without downloading the descriptors it already
+# has.  Its format is:
+#
+#      [Directory-Diff]
+#      Version: 0.1
+#      Base-Digest: <hex digest of the old directory>
+#      <the header of the new directory, signature and all>
+#      <for each descriptor in the new directory, in order, either:>
+#         <the descriptor itself, starting with [Server]>
+#         Unchanged-Server: <declared digest of a descriptor in the old one>
+#
+# The client rebuilds the complete text of the new directory, so the
+# directory signature is checked exactly as if it had been downloaded.
+
+# Regex to match the start of a directory diff.
+_diff_preamble_re = re.compile(r'\A\[Directory-Diff\]\nVersion: 0\.1\n'
+                               r'Base-Digest: ([0-9A-Fa-f]{40})\n')
+# Regex to match the start of an entry in the body of a directory diff.
+_diff_entry_re = re.compile(r'^(?:\[Server\]\n|Unchanged-Server: (\S+)\n)',
+                            re.M)
+# Regex to find the declared digest of a server descriptor.
+_declared_digest_re = re.compile(r'^Digest:\s*(\S+)\s*$', re.M)
+
+def _getDeclaredDigest(descriptor):
+    """Helper: return the digest declared in the Digest line of the
+       server descriptor 'descriptor', or None if there is no such line."""
+    m = _declared_digest_re.search(descriptor)
+    if not m:
+        return None
+    try:
+        return binascii.a2b_base64(m.group(1))
+    except binascii.Error:
+        return None
+
+def _getDirectoryDescriptors(directory):
+    """Helper: given the cleaned text of a [Directory]-format directory,
+       return a 2-tuple of its header, and a list of (declared digest,
+       descriptor text) tuples."""
+    sections = _server_header_re.split(directory)
+    descs = []
+    for s in sections[1:]:
+        s = "[Server]\n%s"%s
+        descs.append((_getDeclaredDigest(s), s))
+    return sections[0], descs
+
+def getDirectoryDiffLocation(location, digest):
+    """Given the location (filename or URL) where a directory is
+       published, and the 20-byte digest of an older directory, return
+       the location where we publish the diff from that directory to the
+       current one."""
+    if location.endswith(".gz"):
+        return "%s.diff/%s.gz" % (location[:-3], binascii.b2a_hex(digest))
+    else:
+        return "%s.diff/%s" % (location, binascii.b2a_hex(digest))
+
+def generateDirectoryDiff(oldDirectory, newDirectory):
+    """Given the text of two [Directory]-format directories, return a
+       directory diff that can be applied to 'oldDirectory' to yield
+       'newDirectory'."""
+    oldDirectory = _cleanForDigest(oldDirectory)
+    newDirectory = _cleanForDigest(newDirectory)
+    _, oldDescs = _getDirectoryDescriptors(oldDirectory)
+    known = {}
+    for digest, _ in oldDescs:
+        if digest:
+            known[digest] = 1
+    header, newDescs = _getDirectoryDescriptors(newDirectory)
+    result = [ "[Directory-Diff]\nVersion: 0.1\nBase-Digest: %s\n" %
+               binascii.b2a_hex(_getDirectoryDigestImpl(oldDirectory)),
+               header ]
+    for digest, text in newDescs:
+        if digest and known.has_key(digest):
+            result.append("Unchanged-Server: %s\n" %
+                          binascii.b2a_base64(digest).strip())
+        else:
+            result.append(text)
+    return "".join(result)
+
+def applyDirectoryDiff(oldDirectory, diff):
+    """Given the text of a [Directory]-format directory and a directory
+       diff generated from it, return the text of the new directory.  Raise
+       ConfigError if the diff is malformed or doesn't apply to
+       'oldDirectory'.
+
+       The result has not been checked: the caller must still parse and
+       validate it.
+    """
+    oldDirectory = _cleanForDigest(oldDirectory)
+    m = _diff_preamble_re.match(diff)
+    if not m:
+        raise ConfigError("Not a directory diff")
+    if (binascii.a2b_hex(m.group(1)) !=
+        _getDirectoryDigestImpl(oldDirectory)):
+        raise ConfigError("Directory diff is for a different directory")
+    _, oldDescs = _getDirectoryDescriptors(oldDirectory)
+    known = {}
+    for digest, text in oldDescs:
+        if digest:
+            known[digest] = text
+
+    body = diff[m.end():]
+    entries = list(_diff_entry_re.finditer(body))
+    if not entries:
+        return body
+    result = [ body[:entries[0].start()] ]
+    for i in xrange(len(entries)):
+        e = entries[i]
+        if i+1 < len(entries):
+            end = entries[i+1].start()
+        else:
+            end = len(body)
+        if e.group(1) is None:
+            result.append(body[e.start():end])
+            continue
+        if e.end() != end:
+            raise ConfigError("Unexpected text after Unchanged-Server line")
+        try:
+            digest = binascii.a2b_base64(e.group(1))
+        except binascii.Error:
+            raise ConfigError("Invalid digest in directory diff")
+        try:
+            result.append(known[digest])
+        except KeyError:
+            raise ConfigError("Directory diff refers to an unknown server")
+    return "".join(result)
+
 class _DirectoryHeader(mixminion.Config._ConfigFile):
     """Internal object: used to parse, validate, and store fields in a
        directory's header sections.
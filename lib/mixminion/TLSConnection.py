@@ -47,6 +47,8 @@ class TLSConnection:
     #   events on self.sock?  (As a special case, if wantWrite is 2, we're
     #   currently waiting for socket.connect.)
     # lastActivity -- When did this connection last get any activity?
+    # totalBytes -- How many raw bytes did this connection read and write?
+    #   (Only set once the connection is closed.)
     #
     # inbuf -- a list of strings received from self.tls
     # inbuflen -- the total length of the strings in self.inbuf
@@ -75,6 +77,7 @@ class TLSConnection:
         self.address = address
         self.wantRead = self.wantWrite = 0
         self.lastActivity = time.time()
+        self.totalBytes = 0
 
         self.__stateFn = None
         self.__setup = 0
@@ -261,6 +264,7 @@ class TLSConnection:
             else:
                 log.warn("Unexpectedly closed connection to %s", self.address)
             self.onTLSError()
+        self.totalBytes = self.tls.get_num_bytes_raw()
         self.sock.close()
         self.sock = None
         self.tls = None
@@ -8,11 +8,15 @@
    >>> import mixminion.benchmark
    >>> mixminion.benchmark.timeAll()
 
+   To time only a running server under load, and record the results:
+      mixminion benchmarks --server-load --output=load.txt
+
    """
 __pychecker__ = 'no-funcdoc no-reimport'
 __all__ = [ 'timeAll', 'testLeaks1', 'testLeaks2' ]
 
 import gc
+import getopt
 import os
 import stat
 import cPickle
@@ -22,10 +26,11 @@ from time import time
 import mixminion._minionlib as _ml
 import mixminion.server.ServerQueue
 
-from mixminion.BuildMessage import _buildHeader, buildForwardPacket, \
-     compressData, uncompressData, encodeMessage, decodePayload
+from mixminion.BuildMessage import _buildHeader, HeaderBuilder, \
+     buildForwardPacket, compressData, uncompressData, encodeMessage, \
+     decodePayload
 from mixminion.Common import secureDelete, installSIGCHLDHandler, \
-     waitForChildren, formatBase64, Lockfile
+     waitForChildren, formatBase64, Lockfile, UIError, UsageError
 from mixminion.Crypto import *
 from mixminion.Crypto import OAEP_PARAMETER
 from mixminion.Crypto import _add_oaep_padding, _check_oaep_padding
@@ -93,6 +98,13 @@ def spacestr(n):
     else:
         return "%d GB" % (n >> 30)
 
+def ratestr(nBytes, t):
+    """Given a number of bytes processed in t seconds, returns a readable
+       representation of the throughput."""
+    if t <= 0:
+        return "(too fast to measure)"
+    return "%.1f MB/s" % (nBytes / t / 1048576.0)
+
 #----------------------------------------------------------------------
 
 short = "Hello, Dali!"
@@ -147,6 +159,17 @@ def cryptoTiming():
     print "aes (32K,pre-key,unoptimized)", timeit(
         (lambda key=key: _ml.strxor(prng(key,32768),s32K)), 100)
 
+    # Inputs shorter than a few blocks are encrypted one AES_encrypt call at
+    # a time; longer ones go through OpenSSL's EVP counter mode when it's
+    # available.  Comparing the per-byte rates shows what EVP buys us.
+    print "aes throughput (32b, block-at-a-time)", ratestr(32, timeit_(
+        (lambda key=key: ctr_crypt(s64b[:32],key)), 100000))
+    for name, s in (("1K", s1K), ("28K", s28K), ("32K", s32K)):
+        print "aes throughput (%s, EVP if available)"%name, ratestr(len(s),
+            timeit_((lambda key=key,s=s: ctr_crypt(s,key)), 1000))
+    print "aes throughput (32K, unoptimized)", ratestr(32768, timeit_(
+        (lambda key=key: _ml.strxor(prng(key,32768),s32K)), 100))
+
     print "prng (short)", timeit((lambda key=key: prng(key,8)), 100000)
     print "prng (128b)", timeit((
         lambda key=key: prng(key,18)), 10000)
@@ -412,6 +435,47 @@ IP: 1.1.1.1
     print "Unpickle text-pickled descriptor (%s/%s)"%(len(dtxt),len(desc)), \
           timeit(lambda dtxt=dtxt: cPickle.loads(dtxt), 400)
 
+def _tlsHandshake(serverContext, clientContext):
+    """Helper: run a full TLS handshake between two contexts over a
+       nonblocking socketpair.  Return the negotiated (cipher, version)."""
+    import socket
+    s1, s2 = socket.socketpair()
+    s1.setblocking(0)
+    s2.setblocking(0)
+    server = serverContext.sock(s1, serverMode=1)
+    client = clientContext.sock(s2)
+    pending = [server.accept, client.connect]
+    while pending:
+        for fn in pending[:]:
+            try:
+                fn()
+                pending.remove(fn)
+            except (_ml.TLSWantRead, _ml.TLSWantWrite):
+                pass
+    result = client.get_cipher()
+    s1.close()
+    s2.close()
+    return result
+
+def tlsTiming():
+    print "#==================== TLS ======================="
+    identity = pk_generate(2048)
+    key = pk_generate(1024)
+    cert = mix_mktemp()
+    dh = mix_mktemp()
+    _ml.generate_cert(cert, key, identity, "A", "B", 100, 10000)
+    dh_fname = os.environ.get("MM_TEST_DHPARAMS")
+    if dh_fname and os.path.exists(dh_fname):
+        dh = dh_fname
+    else:
+        _ml.generate_dh_parameters(dh, 0)
+    serverContext = _ml.TLSContext_new(cert, key, dh)
+    clientContext = _ml.TLSContext_new()
+    print "TLS handshake (%s, %s)" % _tlsHandshake(serverContext,
+                                                  clientContext),
+    print timeit((lambda s=serverContext,c=clientContext: _tlsHandshake(s,c)),
+                 100)
+
 #----------------------------------------------------------------------
 
 def buildMessageTiming():
@@ -456,6 +520,25 @@ def buildMessageTiming():
     bh(8,20)
     bh(16,10)
 
+    def bhb(np,n,it,serverinfo=serverinfo):
+        ctr = AESCounterPRNG()
+        secrets = [ ["Z"*16]*np ] * n
+
+        tm = timeit_(
+              lambda np=np,serverinfo=serverinfo,secrets=secrets,ctr=ctr:
+                  [ _buildHeader(serverinfo[:np], s, 99, "Hello", ctr)
+                    for s in secrets ], it)
+        print "Build %s headers, one at a time (%s)" %(n,np), timestr(tm)
+
+        tm = timeit_(
+              lambda np=np,serverinfo=serverinfo,secrets=secrets,ctr=ctr:
+                  HeaderBuilder(serverinfo[:np], 99, "Hello").buildHeaders(
+                      secrets, ctr), it)
+        print "Build %s headers, in a batch (%s)" %(n,np), timestr(tm)
+
+    bhb(4,16,5)
+    bhb(8,16,3)
+
     payload = encodeMessage(payload, 0)[0]
 
     def bm(np1,np2,it,serverinfo=serverinfo,payload=payload):
@@ -564,6 +647,173 @@ def serverProcessTiming():
     print "Server process (swap, no log)", timeit(
         lambda sp=sp, m_swap=m_swap: sp.processPacket(m_swap), 100)
 
+#----------------------------------------------------------------------
+# Configuration for the server started by serverLoadTiming.
+LOAD_SERVER_CONF = """
+[Server]
+Homedir: %(home)s
+Mode: relay
+EncryptIdentityKey: no
+IdentityKeyBits: 2048
+EncryptPrivateKey: no
+PublicKeyLifetime: 10 days
+Nickname: %(nickname)s
+Contact-Email: a@b.c
+LogStats: no
+TracePackets: yes
+[Incoming/MMTP]
+Enabled: yes
+Hostname: localhost
+IP: 127.0.0.1
+Port: %(port)s
+[Outgoing/MMTP]
+Enabled: yes
+[Pinging]
+Enabled: no
+"""
+
+def _getMaxRSS():
+    """Helper: return the largest resident set size this process has had,
+       in bytes, or None if we can't tell."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Linux and most BSDs report ru_maxrss in kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def serverLoadTiming(nPackets=200, nClients=4, nHops=2, mixInterval=0.5,
+                     outFile=None, timeout=600):
+    """Start two MixminionServers in this process, and time how fast they
+       relay nPackets packets, sent over nClients concurrent MMTP
+       connections.
+
+       Each packet's path alternates between the two servers, so every hop
+       but the last is relayed to the other server over MMTP; the packet
+       passes through a mix pool after every hop but the last, where it is
+       dropped.  We mix every mixInterval seconds instead of using the
+       configured mix algorithm.
+
+       Prints packets/sec, CPU per packet, the process's memory high-water
+       mark, and per-stage latencies.  If outFile is provided, also writes
+       the results there in the format of a metrics snapshot (see
+       mixminion.server.Metrics.readSnapshot), so that runs can be
+       compared over time."""
+    print "#================= SERVER LOAD ======================="
+    import mixminion.ClientDirectory
+    import mixminion.MMTPClient
+    import mixminion.server.Metrics as Metrics
+    import mixminion.server.ServerMain
+    from mixminion.Packet import DROP_TYPE
+    from mixminion.test import TEST_PORT
+
+    assert nHops >= 2
+    # Our servers only need each other's descriptors, which are in the
+    # packets' routing info: don't go looking for the real directory.
+    ClientDirectory = mixminion.ClientDirectory.ClientDirectory
+    oldUpdate = ClientDirectory.update
+    ClientDirectory.update = lambda *args, **kwargs: None
+    servers = []
+    try:
+        t = time()
+        for i in 0, 1:
+            config = ServerConfig(string=LOAD_SERVER_CONF % {
+                'home' : mix_mktemp(), 'port' : TEST_PORT+2+i,
+                'nickname' : "loadtest%s"%(i+1) })
+            servers.append(
+                mixminion.server.ServerMain.MixminionServer(config))
+        print "Start 2 servers (with key generation):", timestr(time()-t)
+    finally:
+        ClientDirectory.update = oldUpdate
+
+    try:
+        infos = [ s.keyring.getCurrentDescriptor() for s in servers ]
+        path = [ infos[i%2] for i in xrange(nHops) ]
+        path1 = path[:(nHops+1)//2]
+        path2 = path[(nHops+1)//2:]
+        payload = encodeMessage("Hello world",0)[0]
+        t = time()
+        packets = [ buildForwardPacket(payload, DROP_TYPE, "", path1, path2)
+                    for _ in xrange(nPackets) ]
+        print "Build %s-hop packet:"%nHops, timestr((time()-t)/nPackets)
+
+        # Deal the packets out among the clients.
+        routing = infos[0].getRoutingInfo()
+        batches = [ (routing, packets[i::nClients], None)
+                    for i in xrange(nClients) ]
+        results = []
+        def sendAll(batches=batches, results=results):
+            results.extend(
+                mixminion.MMTPClient.sendPacketsToServers(batches))
+        clientThread = threading.Thread(target=sendAll)
+
+        # We're done when every hop of every packet has been processed.
+        # The last hop drops the packet, so nothing is left in the queues.
+        processed = Metrics.registry.histogram("packet.process_seconds")
+        expected = processed.n + nPackets*nHops
+        connections = Metrics.registry.counter("mmtp.connections_opened")
+        connections0 = connections.value
+        cpu0 = os.times()
+        t0 = time()
+        clientThread.start()
+        nextMix = t0 + mixInterval
+        deadline = t0 + timeout
+        while 1:
+            for s in servers:
+                s.mmtpServer.process(0.025)
+            now = time()
+            if now >= nextMix:
+                for s in servers:
+                    s.doMix()
+                nextMix = now + mixInterval
+            if processed.n >= expected:
+                break
+            if now > deadline:
+                print "Timed out with %s of %s hops processed" % (
+                    nPackets*nHops-(expected-processed.n), nPackets*nHops)
+                break
+        elapsed = time() - t0
+        cpu1 = os.times()
+        clientThread.join()
+        for err in results:
+            if err is not None:
+                print "Client error:", err
+        nConnections = connections.value - connections0
+    finally:
+        for s in servers:
+            s.close()
+
+    cpu = (cpu1[0]+cpu1[1]) - (cpu0[0]+cpu0[1])
+    maxRSS = _getMaxRSS()
+    print "Relay %s packets over %s connections: %.1f packets/sec" % (
+        nPackets, nClients, nPackets/elapsed)
+    print "CPU per packet (servers and clients):", timestr(cpu/nPackets)
+    print "Server-to-server connections opened:", nConnections
+    if maxRSS is not None:
+        print "Memory high-water mark:", spacestr(maxRSS)
+    for stage in Metrics.PIPELINE_STAGES:
+        for kind in "wait", "service":
+            h = Metrics.registry.histogram("stage.%s.%s_seconds"%(stage,kind))
+            if h.n:
+                print "%s %s: p50 %s, p90 %s, p99 %s" % (
+                    stage, kind, timestr(h.getPercentile(50)),
+                    timestr(h.getPercentile(90)),
+                    timestr(h.getPercentile(99)))
+
+    if outFile:
+        reg = Metrics.registry
+        reg.gauge("bench.packets").set(nPackets)
+        reg.gauge("bench.clients").set(nClients)
+        reg.gauge("bench.hops").set(nHops)
+        reg.gauge("bench.elapsed_seconds").set(elapsed)
+        reg.gauge("bench.packets_per_second").set(nPackets/elapsed)
+        reg.gauge("bench.cpu_seconds_per_packet").set(cpu/nPackets)
+        reg.gauge("bench.server_connections").set(nConnections)
+        if maxRSS is not None:
+            reg.gauge("bench.max_rss_bytes").set(maxRSS)
+        reg.writeSnapshot(outFile)
+        print "Wrote results to", outFile
+
 def encodingTiming():
     print "#=============== END-TO-END ENCODING =================="
     shortP = "hello world"
@@ -745,6 +995,10 @@ def fecTiming():
         tm = timeit_(lambda f=fec, m=msg,k=k: f.encode(k+1,m), it)
         print "Encode a single 28KB check block:", timestr(tm)
         print "                (time/(k*28KB)) =", timestr(tm/(k*28)), "/ KB"
+        tm = timeit_(lambda f=fec, m=msg: f.encodeAll(m), max(it/(n-k),1))
+        print "  Encode all %2d blocks (encodeAll):"%n, timestr(tm)
+        print "            (time/(k*28KB*(n-k))) =", \
+              timestr(tm/(k*28*(n-k))), "/ KB"
         missing_1 = [ (i, fec.encode(i,msg)) for i in xrange(1,k+1) ]
         missing_max = [ (i, fec.encode(i,msg)) for i in xrange(n-k,n) ]
         tm = timeit_(lambda f=fec, m=missing_1: f.decode(m), it)
@@ -1007,7 +1261,50 @@ def testLeaks_FEC():
         fec.decode([(i, chunks[i]) for i in xrange(2,5) ])
 
 #----------------------------------------------------------------------
+_TIME_ALL_USAGE = """\
+Usage: %s [options]
+Options:
+  -h, --help                 Print this usage message and exit.
+  --server-load              Only time a running server under load.
+  -n <n>, --packets=<n>      Number of packets to relay.  (Default: 200)
+  -c <n>, --clients=<n>      Number of concurrent client connections.
+                               (Default: 4)
+  --hops=<n>                 Number of hops in each packet's path.
+                               (Default: 2)
+  -o <file>, --output=<file> Write the server load results to <file>.
+""".strip()
+
 def timeAll(name, args):
+    try:
+        options, args = getopt.getopt(args, "hn:c:o:",
+                                      ["help", "server-load", "packets=",
+                                       "clients=", "hops=", "output="])
+    except getopt.GetoptError, e:
+        raise UsageError("%s (try '%s --help')" % (e, name))
+    serverLoad = 0
+    loadArgs = {}
+    for o, v in options:
+        if o in ('-h', '--help'):
+            print _TIME_ALL_USAGE % name
+            return
+        elif o == '--server-load':
+            serverLoad = 1
+        elif o == '-o' or o == '--output':
+            loadArgs['outFile'] = v
+        else:
+            key = { '-n' : 'nPackets', '--packets' : 'nPackets',
+                    '-c' : 'nClients', '--clients' : 'nClients',
+                    '--hops' : 'nHops' }[o]
+            try:
+                loadArgs[key] = int(v)
+            except ValueError:
+                raise UIError("%s expects an integer" % o)
+    if loadArgs.get('nHops', 2) < 2:
+        raise UIError("--hops must be at least 2")
+    if serverLoad:
+        serverLoadTiming(**loadArgs)
+        return
+
     if 0:
         timeEfficiency()
         return
@@ -1015,6 +1312,7 @@ def timeAll(name, args):
     fecTiming()
     cryptoTiming()
     rsaTiming()
+    tlsTiming()
     buildMessageTiming()
     directoryTiming()
     fileOpsTiming()
@@ -1023,5 +1321,6 @@ def timeAll(name, args):
     serverProcessTiming()
     hashlogTiming()
     timeEfficiency()
+    serverLoadTiming(**loadArgs)
     #import profile
     #profile.run("import mixminion.benchmark; mixminion.benchmark.directoryTiming()")
@@ -17,6 +17,7 @@ from mixminion.Config import ConfigError
 from mixminion.Crypto import init_crypto, pk_fingerprint, pk_generate, \
      pk_PEM_load, pk_PEM_save
 from mixminion.directory.Directory import Directory, DirectoryConfig
+from mixminion.ServerInfo import getDirectoryDiffLocation
 
 USAGE = """\
 Usage: mixminion dir <command>
@@ -167,7 +168,24 @@ def cmd_generate(args):
     print "Directory generated; publishing."
 
     fname = serverList.getDirectoryFilename()
+    publishFile(fname, location)
+
+    # Replace the published diffs: any diff we published before leads to
+    # an out-of-date directory.
+    diffDir = os.path.split(getDirectoryDiffLocation(location, "\0"*20))[0]
+    if os.path.exists(diffDir):
+        for fn in os.listdir(diffDir):
+            os.unlink(os.path.join(diffDir, fn))
+    else:
+        os.mkdir(diffDir, 0755)
+    for digest, fname in serverList.getDirectoryDiffFilenames():
+        publishFile(fname, getDirectoryDiffLocation(location, digest))
+
+    print "Published."
 
+def publishFile(fname, location):
+    """Copy the file 'fname' to 'location', compressing it with gzip if
+       'location' ends with .gz"""
     if location.endswith(".gz"):
         fIn = open(fname)
         fOut = gzip.GzipFile(location, 'wb')
@@ -177,8 +195,6 @@ def cmd_generate(args):
     else:
         shutil.copy(fname, location)
 
-    print "Published."
-
 def cmd_fingerprint(args):
     """[Entry point] Print the fingerprint for this directory's key."""
 
@@ -15,6 +15,7 @@
 
 __all__ = [ 'ServerList' ]
 
+import binascii
 import os
 import time
 import threading
@@ -32,7 +33,7 @@ from mixminion.Common import IntervalSet, LOG, MixError, MixFatalError, \
      writePickled
 from mixminion.Config import ConfigError
 from mixminion.ServerInfo import ServerDirectory, ServerInfo, \
-     _getDirectoryDigestImpl
+     _getDirectoryDigestImpl, generateDirectoryDiff
 
 class ServerList:
     """A ServerList holds a set of server descriptors for use in generating
@@ -48,6 +49,8 @@ class ServerList:
        This implementation isn't terribly optimized, but there's no need to
        optimize it until we have far more descriptors to worry about.
     """
+    # How many previous directories do we generate diffs from?
+    DIFF_HISTORY = 24
     ##Fields:
     #  baseDir: Base directory of this list
     #  serverDir: Directory where we store active descriptors.
@@ -57,6 +60,7 @@ class ServerList:
     #  serversByNickname: A map from lowercased server nickname to
     #       lists of filenames within <serverDir>
     #  idCache: an instance of Directory.IDCache
+    #  diffDir: Directory where we store diffs to the current directory.
     ##Layout:
     #  basedir
     #     server-ids/
@@ -75,6 +79,9 @@ class ServerList:
     #     directory
     #     dirArchive/
     #          dir-dategenerated.N ...
+    #     diffs/
+    #          hex digest of an archived directory
+    #               (Diff from that directory to the current one.)
     #     identity
     #     .lock
 
@@ -94,6 +101,7 @@ class ServerList:
         self.rejectDir = os.path.join(self.baseDir, "reject")
         self.archiveDir = os.path.join(self.baseDir, "archive")
         self.dirArchiveDir = os.path.join(self.baseDir, "dirArchive")
+        self.diffDir = os.path.join(self.baseDir, "diffs")
         self.lockfile = Lockfile(os.path.join(self.baseDir, ".lock"))
         self.rlock = threading.RLock()
         self.servers = {}
@@ -103,6 +111,7 @@ class ServerList:
         createPrivateDir(self.rejectDir)
         createPrivateDir(self.archiveDir)
         createPrivateDir(self.dirArchiveDir)
+        createPrivateDir(self.diffDir)
         self.rescan()
 
     def isServerKnown(self, server):
@@ -350,6 +359,7 @@ class ServerList:
             writeFile(os.path.join(self.baseDir, "directory"),
                       directory,
                       mode=0644)
+            self._generateDiffs(directory)
 
             f, _ = openUnique(os.path.join(self.dirArchiveDir,
                                             "dir-"+formatFnameTime()))
@@ -358,10 +368,33 @@ class ServerList:
         finally:
             self._unlock()
 
+    def _generateDiffs(self, directory):
+        """Helper: replace the contents of self.diffDir with diffs from
+           the DIFF_HISTORY most recently archived directories to
+           'directory'."""
+        for fn in os.listdir(self.diffDir):
+            os.unlink(os.path.join(self.diffDir, fn))
+        archived = [ fn for fn in os.listdir(self.dirArchiveDir)
+                     if fn.startswith("dir-") ]
+        archived.sort()
+        for fn in archived[-self.DIFF_HISTORY:]:
+            old = readFile(os.path.join(self.dirArchiveDir, fn))
+            digest = binascii.b2a_hex(_getDirectoryDigestImpl(old))
+            writeFile(os.path.join(self.diffDir, digest),
+                      generateDirectoryDiff(old, directory),
+                      mode=0644)
+
     def getDirectoryFilename(self):
         """Return the filename of the most recently generated directory"""
         return os.path.join(self.baseDir, "directory")
 
+    def getDirectoryDiffFilenames(self):
+        """Return a list of (digest, filename) tuples for all the diffs
+           to the most recently generated directory.  Each digest is that
+           of the directory the diff applies to."""
+        return [ (binascii.a2b_hex(fn), os.path.join(self.diffDir, fn))
+                 for fn in os.listdir(self.diffDir) ]
+
     def clean(self, now=None):
         """Remove all expired or superseded servers from the active directory.
         """
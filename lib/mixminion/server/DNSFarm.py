@@ -9,6 +9,7 @@ import threading
 import time
 import sys
 import mixminion.NetUtils
+import mixminion.server.Metrics
 from mixminion.ThreadUtils import TimeoutQueue, QueueEmpty
 
 __all__ = [ 'DNSCache' ]
@@ -39,6 +40,10 @@ MAX_ENTRY_TTL = 30*60
 # ...and entries from the reverse cache after MAX_RENTRY_TTL seconds.
 MAX_RENTRY_TTL = 24*60*60
 
+# Histogram of how long the resolver takes to answer, in seconds.
+_lookupTime = mixminion.server.Metrics.registry.histogram(
+    "dns.lookup_seconds")
+
 class DNSCache:
     """Class to cache answers to DNS requests and manager DNS threads."""
     ## Fields:
@@ -259,7 +264,9 @@ class DNSThread(threading.Thread):
                         return
                     # Else, resolve the IP and send the answer to the dnscache
                     _adjBusyThreads(1)
+                    start = time.time()
                     result = mixminion.NetUtils.getIP(hostname)
+                    _lookupTime.observe(time.time()-start)
                     _lookupDone(hostname, result)
                     _adjBusyThreads(-1)
             except QueueEmpty:
@@ -8,7 +8,9 @@
 import logging
 import os
 import threading
+import time
 import mixminion.Filestore
+import mixminion.server.Metrics
 from mixminion.Common import MixFatalError, secureDelete
 from mixminion.Packet import DIGEST_LEN
 
@@ -23,6 +25,10 @@ log = logging.getLogger(__name__)
 # FFFF Two-copy journaling to protect against catastrophic failure that
 # FFFF underlying DB code can't handle.
 
+# Histogram of how long seenHash takes, in seconds.
+_lookupTime = mixminion.server.Metrics.registry.histogram(
+    "hashlog.lookup_seconds")
+
 # Lock to protect _OPEN_HASHLOGS
 _HASHLOG_DICT_LOCK = threading.RLock()
 # Map from (filename) to (keyid,open HashLog). Needed to implement getHashLog.
@@ -104,7 +110,10 @@ class HashLog(mixminion.Filestore.BooleanJournaledDBBase):
             self._syncLog()
 
     def seenHash(self, hash):
-        return self.has_key(hash)
+        start = time.time()
+        r = self.has_key(hash)
+        _lookupTime.observe(time.time()-start)
+        return r
 
     def logHash(self, hash):
         assert len(hash) == DIGEST_LEN
@@ -38,6 +38,7 @@ from mixminion.Packet import PACKET_LEN, DIGEST_LEN, IPV4Info, MMTPHostInfo
 from mixminion.MMTPClient import PeerCertificateCache, MMTPClientConnection
 from mixminion.NetUtils import getProtocolSupport, AF_INET, AF_INET6
 import mixminion.server.EventStats as EventStats
+import mixminion.server.Metrics as Metrics
 from mixminion.Filestore import CorruptedFile
 from mixminion.ThreadUtils import MessageQueue, QueueEmpty
 
@@ -46,6 +47,14 @@ __all__ = [ 'AsyncServer', 'ListenConnection', 'MMTPServerConnection' ]
 
 log = logging.getLogger(__name__)
 
+# Live metrics for MMTP connections.
+_acceptTime = Metrics.registry.histogram("mmtp.accept_handshake_seconds")
+_connectTime = Metrics.registry.histogram("mmtp.connect_handshake_seconds")
+_connectionBytes = Metrics.registry.histogram("mmtp.connection_bytes",
+                                              Metrics.SIZE_BUCKETS)
+_connectionsAccepted = Metrics.registry.counter("mmtp.connections_accepted")
+_connectionsOpened = Metrics.registry.counter("mmtp.connections_opened")
+
 
 class SelectAsyncServer:
     """AsyncServer is the core of a general-purpose asynchronous
@@ -353,6 +362,7 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
     #   rejectCallback -- a callback to invoke whenever we've rejected a packet
     #   protocol -- the negotiated MMTP version
     #   rejectPackets -- flag: do we reject the packets we've received?
+    #   _startTime -- when did we begin accepting this connection?
     MESSAGE_LEN = 6 + (1<<15) + 20
     PROTOCOL_VERSIONS = ['0.3']
     def __init__(self, sock, tls, consumer, rejectPackets=0, serverName=None):
@@ -364,6 +374,8 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
         mixminion.TLSConnection.TLSConnection.__init__(
             self, tls, sock, serverName)
         EventStats.elog.receivedConnection()
+        _connectionsAccepted.inc()
+        self._startTime = time.time()
         self.packetConsumer = consumer
         self.junkCallback = lambda : None
         self.rejectCallback = lambda : None
@@ -372,6 +384,7 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
         self.beginAccepting()
 
     def onConnected(self):
+        _acceptTime.observe(time.time()-self._startTime)
         self.onRead = self.readProtocol
         self.beginReading()
 
@@ -464,7 +477,8 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
     def onDataWritten(self, n): pass
     def onTLSError(self): pass
     def onTimeout(self): pass
-    def onClosed(self): pass
+    def onClosed(self):
+        _connectionBytes.observe(self.totalBytes)
     def doneWriting(self): pass
     def receivedShutdown(self): pass
     def shutdownFinished(self): pass
@@ -491,14 +505,19 @@ class DeliverablePacket(mixminion.MMTPClient.DeliverableMessage):
     """Implementation of DeliverableMessage.
 
        Wraps a ServerQueue.PendingMessage object for a queue holding
-       PacketHandler.RelayPacket objects."""
-    def __init__(self, pending):
+       PacketHandler.RelayPacket objects.  If 'started' is provided, it is
+       the time at which we began trying to deliver this packet, as returned
+       by Metrics.tracer.dequeued."""
+    def __init__(self, pending, started=None):
         assert hasattr(pending, 'succeeded')
         assert hasattr(pending, 'failed')
         assert hasattr(pending, 'getMessage')
         self.pending = pending
+        self.started = started
     def succeeded(self):
         self.pending.succeeded()
+        if self.started is not None:
+            Metrics.tracer.serviced("outgoing", self.started)
     def failed(self,retriable=0):
         self.pending.failed(retriable=retriable)
     def getContents(self):
@@ -527,12 +546,17 @@ class _ClientCon(MMTPClientConnection):
     #    connect to.
     # _wasOnceConnected: True iff we have successfully negotiated a protocol
     #    version with the other server.
+    # _startTime: When did we start connecting?
+    # _onFinished: A function to call when this connection closes, or None.
     def __init__(self, *args, **kwargs):
         MMTPClientConnection.__init__(self, *args, **kwargs)
+        _connectionsOpened.inc()
 
         self._wasOnceConnected = 0
         self._pingLog = None
         self._identity = None
+        self._startTime = time.time()
+        self._onFinished = None
 
     def configurePingLog(self, pingLog, identity):
         """Must be called after construction: set this _ClientCon to
@@ -541,6 +565,13 @@ class _ClientCon(MMTPClientConnection):
         self._pingLog = pingLog
         self._identity = identity
         self._wasOnceConnected = 0
+    def onConnected(self):
+        _connectTime.observe(time.time()-self._startTime)
+        MMTPClientConnection.onConnected(self)
+    def onClosed(self):
+        _connectionBytes.observe(self.totalBytes)
+        if self._onFinished is not None:
+            self._onFinished()
     def onProtocolRead(self):
         MMTPClientConnection.onProtocolRead(self)
         if self._isConnected:
@@ -790,7 +821,7 @@ class MMTPAsyncServer(AsyncServer):
                 # the ping log what happens to our connection attempt.
                 con.configurePingLog(self.pingLog, keyID)
             #con.allPacketsSent = finished #XXXX007 wrong!
-            con.onClosed = finished
+            con._onFinished = finished
         except (socket.error, MixProtocolError), e:
             log.error("Unexpected socket error connecting to %s: %s",
                       serverName, e)
@@ -0,0 +1,424 @@
+# Copyright 2002-2011 Nick Mathewson.  See LICENSE for licensing information.
+
+"""mixminion.server.Metrics
+
+   Live counters, gauges, and histograms describing a running server, and
+   the snapshot file through which 'mixminiond server-stats' reads them.
+
+   Unlike EventStats, nothing here is kept across restarts or written to a
+   long-term history: these values are meant for watching a server's
+   current load, not for publishing."""
+
+__all__ = [ 'Counter', 'Gauge', 'Histogram', 'MetricsRegistry',
+            'NilPacketTracer', 'PacketTracer', 'configureTracing',
+            'readSnapshot', 'formatSnapshot', 'registry', 'tracer',
+            'LATENCY_BUCKETS', 'MIX_BUCKETS', 'SIZE_BUCKETS' ]
+
+import bisect
+import logging
+import os
+import threading
+from time import time
+
+from mixminion.Common import MixError, formatTime, readFile, writeFile
+
+
+log = logging.getLogger(__name__)
+
+
+# Default bucket upper bounds, in seconds, for timing histograms.
+LATENCY_BUCKETS = [ .0001, .00025, .0005, .001, .0025, .005, .01, .025,
+                    .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60 ]
+# Bucket upper bounds, in seconds, for time spent in the mix pool.  These are
+# deliberately coarse: see PacketTracer.
+MIX_BUCKETS = [ 1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200,
+                14400, 28800, 86400 ]
+# Default bucket upper bounds, in bytes, for size histograms.
+SIZE_BUCKETS = [ 1<<10, 1<<12, 1<<14, 1<<15, 1<<16, 1<<17, 1<<18, 1<<19,
+                 1<<20, 1<<22, 1<<24, 1<<26 ]
+
+# The stages of the server's packet pipeline that PacketTracer knows about:
+#    incoming: from MMTP receipt until the packet is decrypted and placed
+#       in the mix pool.
+#    mix: from entering the mix pool until being moved to an outgoing
+#       queue or an exit module.
+#    outgoing: from entering the outgoing queue until the next hop
+#       acknowledges it.
+PIPELINE_STAGES = [ 'incoming', 'mix', 'outgoing' ]
+# How long, in seconds, do we remember when a packet was queued?
+MAX_TRACE_AGE = 7*24*60*60
+
+# How often, in seconds, does the server write its metrics snapshot?
+SNAPSHOT_INTERVAL = 60
+
+class Counter:
+    """A Counter is a value that only goes up: a number of packets or
+       connections seen since the server started."""
+    ## Fields:
+    # name: this counter's name in the registry.
+    # value: the current total.
+    # _lock: a threading.Lock to protect value.
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        """Add n to this counter."""
+        self._lock.acquire()
+        self.value += n
+        self._lock.release()
+
+    def getSnapshotLine(self):
+        """Return a line describing this counter in a snapshot file."""
+        return "counter %s %s" % (self.name, self.value)
+
+class Gauge:
+    """A Gauge is a value that can go up or down, like the length of a queue.
+       Its value is either set explicitly, or computed on demand by calling
+       a function.  Since most of our gauges are cheap to compute but
+       change constantly, computing them only when we write a snapshot
+       is far cheaper than updating them as they change."""
+    ## Fields:
+    # name: this gauge's name in the registry.
+    # value: the last value set, if we have no function.
+    # fn: a function to compute the current value, or None.
+    def __init__(self, name, fn=None):
+        self.name = name
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        """Set the current value of this gauge."""
+        self.value = value
+
+    def get(self):
+        """Return the current value of this gauge."""
+        if self.fn is not None:
+            return self.fn()
+        return self.value
+
+    def getSnapshotLine(self):
+        """Return a line describing this gauge in a snapshot file."""
+        try:
+            v = self.get()
+        except Exception, e:
+            log.warn("Couldn't compute gauge %s: %s", self.name, e)
+            v = 0
+        return "gauge %s %s" % (self.name, v)
+
+class Histogram:
+    """A Histogram counts observed values in a fixed set of buckets, so that
+       we can recover approximate percentiles without storing every value.
+       Recording a value costs one binary search and one locked increment."""
+    ## Fields:
+    # name: this histogram's name in the registry.
+    # bounds: a sorted list of bucket upper bounds.  The last bucket
+    #    (index len(bounds)) holds all values greater than bounds[-1].
+    # counts: a list of len(bounds)+1 counts, one per bucket.
+    # total: the sum of all values observed.
+    # n: the number of values observed.
+    # _lock: a threading.Lock to protect counts, total, and n.
+    def __init__(self, name, bounds=None):
+        if bounds is None:
+            bounds = LATENCY_BUCKETS
+        self.name = name
+        self.bounds = list(bounds)
+        self.bounds.sort()
+        self.counts = [0] * (len(self.bounds)+1)
+        self.total = 0
+        self.n = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record a single value in this histogram."""
+        idx = bisect.bisect_left(self.bounds, value)
+        self._lock.acquire()
+        self.counts[idx] += 1
+        self.total += value
+        self.n += 1
+        self._lock.release()
+
+    def getPercentile(self, pct):
+        """Return an estimate of the pct'th percentile of the values
+           observed so far, or None if we have seen no values."""
+        return _getPercentile(self.bounds, self.counts, pct)
+
+    def getSnapshotLine(self):
+        """Return a line describing this histogram in a snapshot file."""
+        self._lock.acquire()
+        try:
+            counts = self.counts[:]
+            total, n = self.total, self.n
+        finally:
+            self._lock.release()
+        buckets = [ "%r:%s" % (b, c) for b, c in zip(self.bounds, counts) ]
+        buckets.append("inf:%s" % counts[-1])
+        return "histogram %s %s %r %s" % (self.name, n, total,
+                                          " ".join(buckets))
+
+def _getPercentile(bounds, counts, pct):
+    """Helper: given a list of bucket upper bounds and a list of counts
+       as in Histogram, estimate the pct'th percentile by interpolating
+       within the bucket that contains it."""
+    n = 0
+    for c in counts:
+        n += c
+    if n == 0:
+        return None
+    target = n * pct / 100.0
+    seen = 0
+    for i in xrange(len(counts)):
+        if counts[i] == 0:
+            continue
+        if seen + counts[i] >= target:
+            if i == len(bounds):
+                # No upper bound for the last bucket; report its floor.
+                return bounds[-1]
+            if i == 0:
+                lo = 0
+            else:
+                lo = bounds[i-1]
+            frac = (target - seen) / float(counts[i])
+            return lo + (bounds[i]-lo)*frac
+        seen += counts[i]
+    return bounds[-1]
+
+class MetricsRegistry:
+    """A MetricsRegistry holds all the counters, gauges, and histograms for a
+       server, and knows how to write them to a snapshot file.
+
+       Subsystems ask for their metrics by name when they're loaded, and
+       update them directly; asking for the same name twice returns the
+       same object."""
+    ## Fields:
+    # metrics: a map from name to Counter, Gauge, or Histogram.
+    # _lock: a threading.Lock to protect 'metrics'.
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, cls, *args):
+        """Helper: return the metric called 'name', creating it as
+           cls(name, *args) if it doesn't exist."""
+        self._lock.acquire()
+        try:
+            m = self.metrics.get(name)
+            if m is None:
+                m = self.metrics[name] = cls(name, *args)
+            elif not isinstance(m, cls):
+                raise MixError("Metric %s is not a %s"%(name, cls.__name__))
+            return m
+        finally:
+            self._lock.release()
+
+    def counter(self, name):
+        """Return the Counter called 'name'."""
+        return self._get(name, Counter)
+
+    def gauge(self, name, fn=None):
+        """Return the Gauge called 'name'.  If 'fn' is provided, the gauge
+           will call it to learn its current value."""
+        g = self._get(name, Gauge)
+        if fn is not None:
+            g.fn = fn
+        return g
+
+    def histogram(self, name, bounds=None):
+        """Return the Histogram called 'name', using the bucket bounds in
+           'bounds' (default LATENCY_BUCKETS) if it is newly created."""
+        return self._get(name, Histogram, bounds)
+
+    def getSnapshot(self, now=None):
+        """Return a string holding the current value of every metric."""
+        if now is None:
+            now = time()
+        self._lock.acquire()
+        try:
+            items = self.metrics.items()
+        finally:
+            self._lock.release()
+        items.sort()
+        lines = [ "# Mixminion server metrics",
+                  "time %d" % now ]
+        for _, m in items:
+            lines.append(m.getSnapshotLine())
+        lines.append("")
+        return "\n".join(lines)
+
+    def writeSnapshot(self, fname, now=None):
+        """Atomically replace the file 'fname' with a current snapshot."""
+        parent = os.path.split(fname)[0]
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent, 0700)
+        writeFile(fname, self.getSnapshot(now), mode=0600)
+
+def readSnapshot(fname):
+    """Parse a snapshot file as written by MetricsRegistry.writeSnapshot.
+       Return a tuple of (time written, list of metrics), where each
+       metric is one of:
+            ("counter", name, value)
+            ("gauge", name, value)
+            ("histogram", name, n, total, bounds, counts)
+       and bounds, counts are as in Histogram.  Raise MixError if the file
+       is malformed."""
+    when = None
+    result = []
+    for line in readFile(fname).split("\n"):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split()
+        try:
+            if fields[0] == 'time':
+                when = int(fields[1])
+            elif fields[0] in ('counter', 'gauge'):
+                result.append((fields[0], fields[1], float(fields[2])))
+            elif fields[0] == 'histogram':
+                bounds = []
+                counts = []
+                for b in fields[4:]:
+                    bound, count = b.split(":")
+                    if bound != 'inf':
+                        bounds.append(float(bound))
+                    counts.append(int(count))
+                if len(counts) != len(bounds)+1:
+                    raise ValueError()
+                result.append(('histogram', fields[1], int(fields[2]),
+                               float(fields[3]), bounds, counts))
+            else:
+                raise MixError("Unrecognized metric type %r"%fields[0])
+        except (IndexError, ValueError):
+            raise MixError("Malformed line in metrics snapshot: %r"%line)
+    if when is None:
+        raise MixError("Metrics snapshot has no timestamp")
+    return when, result
+
+def formatSnapshot(when, metrics):
+    """Given the return value of readSnapshot, return a human-readable
+       summary of the metrics it describes."""
+    lines = [ "========== Live metrics as of %s:" % formatTime(when, 1) ]
+    if not metrics:
+        return lines[0] + "\n  (none)\n"
+    width = max([ len(m[1]) for m in metrics ])
+    for m in metrics:
+        if m[0] == 'histogram':
+            _, name, n, total, bounds, counts = m
+            if n == 0:
+                lines.append("  %-*s  (no samples)" % (width, name))
+                continue
+            lines.append("  %-*s  n=%d mean=%.6g p50=%.6g p90=%.6g p99=%.6g"
+                         % (width, name, n, total/n,
+                            _getPercentile(bounds, counts, 50),
+                            _getPercentile(bounds, counts, 90),
+                            _getPercentile(bounds, counts, 99)))
+        else:
+            lines.append("  %-*s  %.15g" % (width, m[1], m[2]))
+    lines.append("")
+    return "\n".join(lines)
+
+class NilPacketTracer:
+    """Null implementation of the PacketTracer interface: records
+       nothing."""
+    def enqueued(self, stage, handle, now=None):
+        """Note that the packet 'handle' has just been queued for 'stage'."""
+        pass
+    def dequeued(self, stage, handle, now=None):
+        """Note that 'stage' has just started work on the packet 'handle'.
+           Return the time at which work started; pass it to serviced()
+           when the work is done."""
+        return now
+    def serviced(self, stage, start, now=None):
+        """Note that 'stage' has finished working on a packet, having begun
+           at 'start' (as returned by dequeued)."""
+        pass
+    def expire(self, cutoff):
+        """Forget every packet queued before 'cutoff'.  (Packets can leave
+           a queue without being dequeued, if they expire or are deleted.)"""
+        pass
+
+class PacketTracer(NilPacketTracer):
+    """A PacketTracer records how long packets spend in each stage of the
+       server's pipeline: both waiting in the stage's queue, and being worked
+       on once they leave it.  For a stage named S, these go into the
+       histograms 'stage.S.wait_seconds' and 'stage.S.service_seconds'.
+
+       Queue entry times are kept in memory only, keyed by queue handle,
+       and are forgotten as soon as a packet leaves the queue.  Nothing
+       about an individual packet is ever logged or written to disk: in
+       particular, how long a given packet sat in the mix pool is exactly
+       what the pool exists to hide.  The mix stage also uses the coarse
+       MIX_BUCKETS, so the histogram says no more than the configured mix
+       interval already does.
+
+       Packets that were queued before the server started have no entry
+       time, and aren't counted in their first stage's wait histogram."""
+    ## Fields:
+    # _queued: a map from stage name to a map from handle to the time
+    #    that the handle was queued.
+    # _wait, _service: maps from stage name to Histogram.
+    def __init__(self, registry, stages=None):
+        """Create a new PacketTracer that keeps its histograms in 'registry',
+           for the stages named in 'stages' (default PIPELINE_STAGES)."""
+        if stages is None:
+            stages = PIPELINE_STAGES
+        self._queued = {}
+        self._wait = {}
+        self._service = {}
+        for stage in stages:
+            if stage == 'mix':
+                bounds = MIX_BUCKETS
+            else:
+                bounds = LATENCY_BUCKETS
+            self._wait[stage] = registry.histogram(
+                "stage.%s.wait_seconds"%stage, bounds)
+            self._service[stage] = registry.histogram(
+                "stage.%s.service_seconds"%stage)
+            self._queued[stage] = {}
+
+    # (We don't lock _queued: we only touch it with single dict operations,
+    # which the interpreter makes atomic.)
+    def enqueued(self, stage, handle, now=None):
+        if now is None:
+            now = time()
+        self._queued[stage][handle] = now
+
+    def dequeued(self, stage, handle, now=None):
+        if now is None:
+            now = time()
+        queuedAt = self._queued[stage].pop(handle, None)
+        if queuedAt is not None:
+            self._wait[stage].observe(now-queuedAt)
+        return now
+
+    def serviced(self, stage, start, now=None):
+        if start is None:
+            # Work began before tracing was enabled.
+            return
+        if now is None:
+            now = time()
+        self._service[stage].observe(now-start)
+
+    def expire(self, cutoff):
+        for queued in self._queued.values():
+            for handle, when in queued.items():
+                if when < cutoff:
+                    try:
+                        del queued[handle]
+                    except KeyError:
+                        pass
+
+def configureTracing(config):
+    """Given a server configuration, enable or disable packet tracing.
+       May replace the tracer global variable."""
+    global tracer
+    if config['Server'].get('TracePackets', 1):
+        log.info("Enabling packet latency tracing")
+        tracer = PacketTracer(registry)
+    else:
+        tracer = NilPacketTracer()
+
+# Global variable: the server's metrics registry.
+registry = MetricsRegistry()
+# Global variable: the currently configured packet tracer.
+tracer = NilPacketTracer()
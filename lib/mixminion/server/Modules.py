@@ -185,6 +185,10 @@ class ImmediateDeliveryQueue:
         # There is no underlying queue to worry about here; do nothing.
         pass
 
+    def count(self):
+        # Nothing ever waits here.
+        return 0
+
     def getPriority(self):
         """Return the order at which this queue should be flushed.  Queues
            are flushed from lowest-valued priority to highest.  Most modules
@@ -433,6 +437,14 @@ class ModuleManager:
         self.queues[module.getName()] = queue
         self.enabled[module.getName()] = 1
 
+    def count(self):
+        """Return the number of messages waiting in all exit module
+           queues."""
+        n = 0
+        for queue in self.queues.values():
+            n += queue.count()
+        return n
+
     def cleanQueues(self, deleteFn=None):
         """Remove trash messages from all internal queues."""
         for queue in self.queues.values():
@@ -738,17 +750,22 @@ class FragmentDeliveryQueue:
             self.pool.unchunkMessages()
             ready = self.pool.listReadyMessages()
             for msgid in ready:
-                msg = self.pool.getReadyMessage(msgid)
+                # Read the message from the pool's scratch file, so that
+                # we can reject an over-long message without reading it.
+                f = self.pool.openReadyMessage(msgid)
                 try:
-                    ssfm = mixminion.Packet.parseServerSideFragmentedMessage(
-                        msg)
-                    del msg
+                    try:
+                        ssfm = mixminion.Packet.\
+                               readServerSideFragmentedMessage(
+                                   f, f.length, self.module.maxMessageSize)
+                    finally:
+                        f.close()
                 except ParseError:
                     log.warn("Dropping malformed server-side fragmented "
                              "message")
                     self.pool.markMessageCompleted(msgid, rejected=1)
                     continue
-                if len(ssfm.compressedContents) > self.module.maxMessageSize:
+                except CompressedDataTooLong:
                     log.warn("Dropping over-long fragmented message")
                     self.pool.markMessageCompleted(msgid, rejected=1)
                     continue
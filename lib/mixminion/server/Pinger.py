@@ -26,6 +26,7 @@ import binascii
 import bisect
 import calendar
 import cPickle
+import cStringIO
 import logging
 import os
 import struct
@@ -44,7 +45,7 @@ import mixminion.server.MMTPServer
 from mixminion.Common import MixError, AtomicFile, ceilDiv, createPrivateDir, \
      floorDiv, formatBase64, formatFnameDate, formatTime, IntervalSet, \
      parseFnameDate, previousMidnight, readPickled, secureDelete, \
-     succeedingMidnight, UIError, writePickled
+     stringContains, succeedingMidnight, UIError, writePickled
 
 log = logging.getLogger(__name__)
 
@@ -55,6 +56,8 @@ except ImportError:
 
 # How often should the server store the fact that it is still alive (seconds).
 HEARTBEAT_INTERVAL = 30*60
+# How often should the server write buffered ping events to disk (seconds).
+FLUSH_INTERVAL = 60
 # Number of seconds in a day.
 ONE_DAY = 24*60*60
 
@@ -113,8 +116,21 @@ class SQLiteDatabase:
         """Create a SQLite database storing its data in the file 'location'."""
         parent = os.path.split(location)[0]
         createPrivateDir(parent)
+        self.location = location
         self._theConnection = sqlite3.connect(location, isolation_level=None)
         self._theCursor = self._theConnection.cursor()
+        # Write-ahead logging lets the statistics thread read while we're
+        # writing, and makes each commit a lot cheaper.  Older versions of
+        # SQLite just ignore these.
+        self._theCursor.execute("PRAGMA journal_mode=WAL")
+        self._theCursor.fetchall()
+        self._theCursor.execute("PRAGMA synchronous=NORMAL")
+
+    def openNewConnection(self):
+        """Return a new database object for the same underlying database,
+           with its own connection.  The new object must only be used from
+           the thread that called this method."""
+        return self.__class__(self.location)
 
     def close(self):
         """Release resources held by this database."""
@@ -258,6 +274,24 @@ class SQLiteDatabase:
             assert len(hexid) == mixminion.Crypto.DIGEST_LEN*2
             return binascii.a2b_hex(hexid)
 
+def _isBusyError(e):
+    """Return true iff the sqlite3.Error 'e' means that another connection
+       had the database locked, so that trying again later may work."""
+    if not isinstance(e, sqlite3.OperationalError):
+        return 0
+    msg = str(e).lower()
+    return stringContains(msg, "locked") or stringContains(msg, "busy")
+
+def _encodeTimes(lst):
+    """Helper: encode a list of integers for storage in a varchar column."""
+    return ",".join([ str(t) for t in lst ])
+
+def _decodeTimes(s):
+    """Helper: decode a list of integers encoded with _encodeTimes."""
+    if not s:
+        return []
+    return [ long(t) for t in s.split(",") ]
+
 class PingLog:
     """A PingLog stores a series of pinging-related events to a
        persistant relational database, and calculates server statistics based
@@ -281,8 +315,22 @@ class PingLog:
     # _startTime: The 'startup' time for the current myLifespan row.
     # _lastRecalculation: The last time this process recomputed all
     #   the stats, or 0 for 'never'.
-    # _set{Uptime|OneHop|CurOneHop|TwoHop}: Functions generated by
-    #   getInsertOrUpdateFn.
+    # _set{Uptime|UptimeHighWater|OneHop|OneHopSummary|OneHopHighWater|
+    #   CurOneHop|TwoHop}: Functions generated by getInsertOrUpdateFn.
+    # _pendingEvents: A list of (SQL statement, list of argument tuples) for
+    #   events that we have not yet written to the database, in the order
+    #   they happened.
+    # _nPendingEvents: The total number of argument tuples in _pendingEvents.
+    # _flushCount, _flushedEvents, _flushTime, _maxFlushTime: The number of
+    #   times we have written pending events to the database, the number of
+    #   events written, and the total and longest time spent doing so.
+    # _droppedEvents: The number of pending events we threw away because
+    #   the database gave an error when we tried to write them.
+
+    # How many events do we buffer before writing them to the database?
+    MAX_PENDING_EVENTS = 256
+    # How many events will we hold on to while the database is busy?
+    MAX_RETRY_EVENTS = 16*MAX_PENDING_EVENTS
 
     # FFFF Maybe refactor this into data storage and stats computation.
     def __init__(self, db):
@@ -297,6 +345,11 @@ class PingLog:
         self._interestingChains = {}
         self._startTime = None
         self._lastRecalculation = 0
+        self._pendingEvents = []
+        self._nPendingEvents = 0
+        self._flushCount = self._flushedEvents = 0
+        self._flushTime = self._maxFlushTime = 0.0
+        self._droppedEvents = 0
         self._createAllTables()
         self._loadServers()
 
@@ -427,6 +480,46 @@ class PingLog:
                  ("interesting", "bool",      "not null")],
                 ["PRIMARY KEY (server1, server2)"])
 
+            #### Tables holding partial results.
+
+            # Records how much raw data we have already taken into account.
+            # A row in uptimeHighWater means: the uptimes we have stored for
+            # 'server' reflect every connection attempt up to 'at'.  (For
+            # <self>, they reflect our own lifespan up to 'at'.)
+            self._db.createTable(
+                "uptimeHighWater",
+                [("server", "integer",   "primary key REFERENCES server(id)"),
+                 ("at",     "timestamp", "not null")])
+
+            # Holds a summary of the probes sent to a single server during
+            # a single interval, so that we don't need to rescan the ping
+            # table for intervals where nothing has changed.  Each row in
+            # echolotOneHopSummary means: during 'interval', we sent
+            # 'nSent' one-hop probes to 'server', and have received
+            # 'nReceived' of them.  'latencies' holds the latencies of the
+            # received probes, and 'pending' holds the times when we sent
+            # the others, each as a sorted, comma-separated list of
+            # integers.
+            self._db.createTable(
+                "echolotOneHopSummary",
+                  [("server",   "integer", "not null REFERENCES server(id)"),
+                   ("interval", "integer", "not null REFERENCES statsInterval(id)"),
+                   ("nSent",    "integer", "not null"),
+                   ("nReceived","integer", "not null"),
+                   ("latencies","varchar", "not null"),
+                   ("pending",  "varchar", "not null")],
+                ["PRIMARY KEY (server, interval)"])
+
+            # A row in echolotOneHopHighWater means: the rows in
+            # echolotOneHopSummary for 'server' reflect every probe sent
+            # before 'sentAt', and every probe received before 'receivedAt'.
+            self._db.createTable(
+                "echolotOneHopHighWater",
+                [("server",     "integer",
+                  "primary key REFERENCES server(id)"),
+                 ("sentAt",     "timestamp", "not null"),
+                 ("receivedAt", "timestamp", "not null")])
+
             #### Indices.
 
             self._db.createIndex("serverIdentity", "server",
@@ -437,6 +530,7 @@ class PingLog:
             self._db.createIndex("pingHash",   "ping", ["hash"], unique=1)
             self._db.createIndex("pingPathSR", "ping",
                                  ["path", "sentat", "received"])
+            self._db.createIndex("pingPathR", "ping", ["path", "received"])
             self._db.createIndex("connectionAttemptServerAt",
                                  "connectionAttempt", ["server","at"])
             self._db.createIndex("echolotOneHopResultSI",
@@ -453,6 +547,16 @@ class PingLog:
                 ["server", "interval"],
                 ["nSent", "nReceived", "latency", "wsent", "wreceived",
                  "reliability"])
+            self._setUptimeHighWater = self._db.getInsertOrUpdateFn(
+                "uptimeHighWater", ["server"], ["at"])
+            self._setOneHopSummary = self._db.getInsertOrUpdateFn(
+                "echolotOneHopSummary",
+                ["server", "interval"],
+                ["nSent", "nReceived", "latencies", "pending"])
+            self._setOneHopHighWater = self._db.getInsertOrUpdateFn(
+                "echolotOneHopHighWater",
+                ["server"],
+                ["sentAt", "receivedAt"])
             self._setCurOneHop = self._db.getInsertOrUpdateFn(
                 "echolotCurrentOneHopResult",
                 ["server"],
@@ -571,6 +675,7 @@ class PingLog:
         #dataCutoff = self._db.time(now - sec['RetainPingData'])
         #resultsCutoff = self._db.time(now - sec['RetainPingResults'])
 
+        self.flush()
         cur = self._db.getCursor()
         cur.execute("DELETE FROM myLifespan WHERE stillup < ?", [dataCutoff])
         cur.execute("DELETE FROM ping WHERE sentat < ?", [dataCutoff])
@@ -582,17 +687,126 @@ class PingLog:
         cur.execute("DELETE FROM echolotOneHopResult WHERE interval IN "
                     "( SELECT id FROM statsInterval WHERE endAt < ? )",
                     [resultsCutoff])
+        cur.execute("DELETE FROM echolotOneHopSummary WHERE interval IN "
+                    "( SELECT id FROM statsInterval WHERE endAt < ? )",
+                    [resultsCutoff])
         cur.execute("DELETE FROM statsInterval WHERE endAt < ?", [resultsCutoff])
 
         self._db.getConnection().commit()
 
+    def _queueEvent(self, stmt, args):
+        """Helper: remember to execute the SQL statement 'stmt' with the
+           arguments 'args' on the next flush().  Flushes if too many
+           events are pending."""
+        self._lock.acquire()
+        try:
+            if self._pendingEvents and self._pendingEvents[-1][0] is stmt:
+                self._pendingEvents[-1][1].append(args)
+            else:
+                self._pendingEvents.append((stmt, [args]))
+            self._nPendingEvents += 1
+            full = self._nPendingEvents >= self.MAX_PENDING_EVENTS
+        finally:
+            self._lock.release()
+        if full:
+            self.flush()
+
     def flush(self):
         """Write any pending information to disk."""
-        self._db.getConnection().commit()
+        self._lock.acquire()
+        try:
+            events = self._pendingEvents
+            nEvents = self._nPendingEvents
+            self._pendingEvents = []
+            self._nPendingEvents = 0
+        finally:
+            self._lock.release()
+        if not events:
+            return
+
+        start = time.time()
+        cur = self._db.getCursor()
+        try:
+            cur.execute("BEGIN")
+            try:
+                for stmt, argList in events:
+                    if stmt is self._GOT_PING:
+                        # We want to know about each ping we can't match.
+                        for args in argList:
+                            cur.execute(stmt, args)
+                            self._checkGotPing(cur.rowcount)
+                    else:
+                        cur.executemany(stmt, argList)
+                cur.execute("COMMIT")
+            except:
+                # Even if COMMIT failed, we're still in the transaction;
+                # leave it, or every later BEGIN will fail.
+                try:
+                    cur.execute("ROLLBACK")
+                except sqlite3.Error, e:
+                    log.debug("Couldn't roll back ping events: %s", e)
+                raise
+        except sqlite3.Error, e:
+            # We get here from connected(), gotPing(), and friends: a
+            # broken database shouldn't take down whoever was telling us
+            # about a ping.
+            self._lock.acquire()
+            try:
+                if (_isBusyError(e) and self._nPendingEvents + nEvents <=
+                    self.MAX_RETRY_EVENTS):
+                    # Somebody else has the database; try again next time.
+                    self._pendingEvents[:0] = events
+                    self._nPendingEvents += nEvents
+                    retry = 1
+                else:
+                    self._droppedEvents += nEvents
+                    retry = 0
+            finally:
+                self._lock.release()
+            if retry:
+                log.info("Database busy; will retry writing %s ping events",
+                         nEvents)
+            else:
+                log.warn("Error writing %s ping events to disk; dropping "
+                         "them: %s", nEvents, e)
+            return
+        elapsed = time.time() - start
+
+        self._lock.acquire()
+        try:
+            self._flushCount += 1
+            self._flushedEvents += nEvents
+            self._flushTime += elapsed
+            self._maxFlushTime = max(self._maxFlushTime, elapsed)
+        finally:
+            self._lock.release()
+        log.debug("Wrote %s ping events to disk in %.3f seconds",
+                  nEvents, elapsed)
+
+    def getFlushStats(self):
+        """Return a dict containing the number of times we have written
+           pending events to the database, the number of events written,
+           the average and maximum time in seconds spent doing so, and the
+           number of events we dropped because the database gave an
+           error."""
+        self._lock.acquire()
+        try:
+            if self._flushCount:
+                avg = self._flushTime / self._flushCount
+            else:
+                avg = 0.0
+            return { 'flushes' : self._flushCount,
+                     'events' : self._flushedEvents,
+                     'avgFlushTime' : avg,
+                     'maxFlushTime' : self._maxFlushTime,
+                     'dropped' : self._droppedEvents }
+        finally:
+            self._lock.release()
 
     def close(self):
         """Release all resources held by this PingLog and the underlying
            database."""
+        self.flush()
         self._db.close()
 
     _STARTUP = "INSERT INTO myLifespan (startup, stillup, shutdown) VALUES (?,?, 0)"
@@ -602,8 +816,8 @@ class PingLog:
         self._lock.acquire()
         self._startTime = now = self._db.time(now)
         self._lock.release()
-        self._db.getCursor().execute(self._STARTUP, (now,now))
-        self._db.getConnection().commit()
+        self._queueEvent(self._STARTUP, (now,now))
+        self.flush()
 
     _SHUTDOWN = "UPDATE myLifespan SET stillup = ?, shutdown = ? WHERE startup = ?"
     def shutdown(self, now=None):
@@ -611,8 +825,8 @@ class PingLog:
            interval of this server's lifetime."""
         if self._startTime is None: self.startup()
         now = self._db.time(now)
-        self._db.getCursor().execute(self._SHUTDOWN, (now, now, self._startTime))
-        self._db.getConnection().commit()
+        self._queueEvent(self._SHUTDOWN, (now, now, self._startTime))
+        self.flush()
 
     _HEARTBEAT = "UPDATE myLifespan SET stillup = ? WHERE startup = ? AND stillup < ?"
     def heartbeat(self, now=None):
@@ -620,8 +834,7 @@ class PingLog:
            the time 'now'."""
         if self._startTime is None: self.startup()
         now = self._db.time(now)
-        self._db.getCursor().execute(self._HEARTBEAT, (now, self._startTime, now))
-        self._db.getConnection().commit()
+        self._queueEvent(self._HEARTBEAT, (now, self._startTime, now))
 
     _CONNECTED = ("INSERT INTO connectionAttempt (at, server, success) "
                   "VALUES (?,?,?)")
@@ -630,9 +843,8 @@ class PingLog:
            We successfully negotiated a protocol iff success is true.
         """
         serverID = self._getServerID(identity)
-        self._db.getCursor().execute(self._CONNECTED,
+        self._queueEvent(self._CONNECTED,
                         (self._db.time(now), serverID, self._db.bool(success)))
-        self._db.getConnection().commit()
 
     def connectFailed(self, identity, now=None):
         """Note that we attempted to connect to the server named 'nickname',
@@ -650,9 +862,8 @@ class PingLog:
         """
         assert len(hash) == mixminion.Crypto.DIGEST_LEN
         ids = ",".join([ str(self._getServerID(s)) for s in path ])
-        self._db.getCursor().execute(self._QUEUED_PING,
-                             (formatBase64(hash), ids, self._db.time(now), 0))
-        self._db.getConnection().commit()
+        self._queueEvent(self._QUEUED_PING,
+                         (formatBase64(hash), ids, self._db.time(now), 0))
 
     _GOT_PING = "UPDATE ping SET received = ? WHERE hash = ?"
     def gotPing(self, hash, now=None):
@@ -660,8 +871,12 @@ class PingLog:
            as its digest.
         """
         assert len(hash) == mixminion.Crypto.DIGEST_LEN
-        self._db.getCursor().execute(self._GOT_PING, (self._db.time(now), formatBase64(hash)))
-        n = self._db.getCursor().rowcount
+        self._queueEvent(self._GOT_PING,
+                         (self._db.time(now), formatBase64(hash)))
+
+    def _checkGotPing(self, n):
+        """Helper: warn if recording a received ping changed 'n' rows,
+           rather than exactly one."""
         if n == 0:
             log.warn("Received ping with no record of its hash")
         elif n > 1:
@@ -670,7 +885,9 @@ class PingLog:
     def _calculateUptimes(self, serverIdentities, startTime, endTime, now=None):
         """Helper: calculate the uptime results for a set of servers, named in
            serverIdentities, for all intervals between startTime and endTime
-           inclusive.  Does not commit the current transaction.
+           inclusive.  Only recalculates the intervals that have changed
+           since the last time we calculated uptimes.  Does not commit the
+           current transaction.
         """
         cur = self._db.getCursor()
         serverIdentities.sort()
@@ -678,10 +895,15 @@ class PingLog:
         # First, calculate my own uptime.
         if now is None: now = time.time()
         self.heartbeat(now)
+        self.flush()
+
+        cur.execute("SELECT server, at FROM uptimeHighWater")
+        highWater = {}
+        for serverID, at in cur.fetchall():
+            highWater[serverID] = at
 
         timespan = IntervalSet( [(startTime, endTime)] )
-        calcIntervals = [ (s,e,self._getIntervalID(s,e)) for s,e in
-                          self._intervals.getIntervals(startTime,endTime)]
+        calcIntervals = self._intervals.getIntervals(startTime,endTime)
 
         cur.execute("SELECT startup, stillup, shutdown FROM myLifespan WHERE "
                     "startup <= ? AND stillup >= ?",
@@ -689,23 +911,52 @@ class PingLog:
         myIntervals = IntervalSet([ (start, max(end,shutdown))
                                     for start,end,shutdown in cur ])
         myIntervals *= timespan
-        for s, e, i in calcIntervals:
+        selfID = self._getServerID("<self>")
+        dirtyStart = self._getDirtyStart(highWater.get(selfID, 0), startTime)
+        for s, e in calcIntervals:
+            if e <= dirtyStart: continue
             uptime = (myIntervals * IntervalSet([(s,e)])).spanLength()
             fracUptime = float(uptime)/(e-s)
-            self._setUptime((i, self._getServerID("<self>")), (fracUptime,))
+            self._setUptime((self._getIntervalID(s,e), selfID), (fracUptime,))
+        self._setUptimeHighWater((selfID,),
+                                 (self._db.time(min(now, endTime)),))
 
-        # Okay, now everybody else.
+        # Okay, now everybody else.  We only look at servers that we've tried
+        # to connect to since we last calculated their uptimes, and only
+        # recalculate the intervals that those attempts could affect.
         for (identity, serverID) in self._serverIDs.items():
-            if s in ('<self>','<unknown>'): continue
+            if identity in ('<self>','<unknown>'): continue
+            lastAt = highWater.get(serverID, 0)
+            # Attempts logged after we last ran can share a timestamp with
+            # the high-water mark, so look at 'lastAt' again.  Recomputing
+            # the interval that holds it is harmless.
+            cur.execute("SELECT MAX(at) FROM connectionAttempt"
+                        " WHERE server = ? AND at >= ? AND at <= ?",
+                        (serverID, max(lastAt, startTime), endTime))
+            newestAt, = cur.fetchone()
+            if newestAt is None:
+                continue
+            dirtyStart = self._getDirtyStart(lastAt, startTime)
+            firstAt = max(dirtyStart, startTime)
+
+            # We need the last attempt before the first changed interval, if
+            # any, so we know what state the server was in at the start of
+            # that interval.
+            cur.execute("SELECT at, success FROM connectionAttempt"
+                        " WHERE server = ? AND at >= ? AND at < ?"
+                        " ORDER BY at DESC LIMIT 1",
+                        (serverID, startTime, firstAt))
+            attempts = cur.fetchall()
             cur.execute("SELECT at, success FROM connectionAttempt"
                         " WHERE server = ? AND at >= ? AND at <= ?"
                         " ORDER BY at",
-                        (serverID, startTime, endTime))
+                        (serverID, firstAt, endTime))
+            attempts.extend(cur.fetchall())
 
             intervals = [[], []] #uptimes, downtimes
             lastStatus = None
             lastTime = None
-            for at, success in cur:
+            for at, success in attempts:
                 assert success in (0,1)
                 upAt, downAt = myIntervals.getIntervalContaining(at)
                 #if upAt == None:
@@ -727,13 +978,26 @@ class PingLog:
             downIntervals *= myIntervals
             upIntervals *= myIntervals
 
-            for s,e,intervalID in calcIntervals:
+            for s,e in calcIntervals:
+                if e <= dirtyStart: continue
                 uptime = (upIntervals*IntervalSet([(s,e)])).spanLength()
                 downtime = (downIntervals*IntervalSet([(s,e)])).spanLength()
                 if uptime < 1 and downtime < 1:
                     continue
                 fraction = float(uptime)/(uptime+downtime)
-                self._setUptime((intervalID, serverID), (fraction,))
+                self._setUptime((self._getIntervalID(s,e), serverID),
+                                (fraction,))
+            self._setUptimeHighWater((serverID,), (newestAt,))
+
+    def _getDirtyStart(self, lastAt, startTime):
+        """Helper: given the high-water mark 'lastAt' for some server (or 0
+           if we have never calculated its results), return the start of
+           the earliest interval, no earlier than the interval containing
+           'startTime', whose results we need to recalculate.
+        """
+        if lastAt < startTime:
+            lastAt = startTime
+        return self._intervals.getIntervalContaining(lastAt)[0]
 
     def calculateUptimes(self, startAt, endAt, now=None):
         """Calculate the uptimes for all servers for all intervals between
@@ -752,6 +1016,7 @@ class PingLog:
         """Return uptimes for all servers overlapping [startAt, endAt],
            as mapping from (start,end) to identity to fraction.
         """
+        self.flush()
         result = {}
         cur = self._db.getCursor()
         cur.execute("SELECT startat, endat, identity, uptime "
@@ -806,61 +1071,53 @@ class PingLog:
         endTime = intervals[-1][1]
         serverID = self._getServerID(serverIdentity)
 
-        # 1. Compute latencies and number of pings sent in each period.
-        #    We need to learn these first so we can tell the percentile
-        #    of each ping's latency.
-        dailyLatencies = [[] for _ in xrange(nPeriods)]
-        nSent = [0]*nPeriods
-        nPings = 0
-        cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
-                    " AND sentat >= ? AND sentat <= ?",
+        # 1. Bring the per-interval summaries up to date, and load them.
+        #    We need to learn the latencies and number of pings sent in
+        #    each period first so we can tell the percentile of each ping's
+        #    latency.
+        self._updateOneHopSummaries(serverID, intervals)
+        summaries = {}
+        cur.execute("SELECT startAt, nSent, nReceived, latencies, pending "
+                    "FROM echolotOneHopSummary, statsInterval "
+                    "WHERE echolotOneHopSummary.server = ? "
+                    "AND echolotOneHopSummary.interval = statsInterval.id "
+                    "AND startAt >= ? AND startAt < ?",
                     (serverID, startTime, endTime))
-        for sent,received in cur:
-            pIdx = floorDiv(sent-startTime, self._PING_GRANULARITY)
-            nSent[pIdx] += 1
-            nPings += 1
-            if received:
-                dailyLatencies[pIdx].append(received-sent)
-
-        dailyMedianLatency = []
+        for s, sent, rcvd, latencies, pending in cur:
+            summaries[s] = (sent, rcvd, _decodeTimes(latencies),
+                            _decodeTimes(pending))
+
+        nSent = [0]*nPeriods
+        nReceived = [0]*nPeriods
+        pendingSent = [[] for _ in xrange(nPeriods)]
+        dailyMedianLatency = [0]*nPeriods
         allLatencies = []
-        for d in dailyLatencies:
-            d.sort()
+        for pIdx in xrange(nPeriods):
+            try:
+                sent, rcvd, d, pending = summaries[intervals[pIdx][0]]
+            except KeyError:
+                continue
+            nSent[pIdx] = sent
+            nReceived[pIdx] = rcvd
+            pendingSent[pIdx] = pending
             if d:
-                dailyMedianLatency.append(d[floorDiv(len(d), 2)])
-            else:
-                dailyMedianLatency.append(0)
+                dailyMedianLatency[pIdx] = d[floorDiv(len(d), 2)]
             allLatencies.extend(d)
-            del d
-        del dailyLatencies
+        del summaries
         allLatencies.sort()
-        #if allLatencies:
-        #    log.warn("%s pings in %s intervals. Median latency is %s seconds",
-        #             nPings, nPeriods,
-        #             allLatencies[floorDiv(len(allLatencies),2)])
+        nPings = sum(nSent)
 
-        # 2. Compute the number of pings actually received each day,
-        #    and the number of pings received each day weighted by
+        # 2. Compute the number of pings received each day weighted by
         #    apparent-latency percentile.
-        nReceived = [0]*nPeriods
         perTotalWeights = [0]*nPeriods
         perTotalWeighted = [0]*nPeriods
-        cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
-                    " AND sentat >= ? AND sentat <= ?",
-                    (serverID, startTime, endTime))
-        for sent,received in cur:
-            pIdx = floorDiv(sent-startTime, self._PING_GRANULARITY)
-            if received:
-                nReceived[pIdx] += 1
-                w = 1.0
-            else:
+        for pIdx in xrange(nPeriods):
+            w = float(nReceived[pIdx])
+            perTotalWeighted[pIdx] = w
+            for sent in pendingSent[pIdx]:
                 mod_age = (now-sent-15*60)*0.8
-                w = bisect.bisect_left(allLatencies, mod_age)/float(nPings)
-                #log.warn("Percentile is %s.", w)
-
-            perTotalWeights[pIdx] += w
-            if received:
-                perTotalWeighted[pIdx] += w
+                w += bisect.bisect_left(allLatencies, mod_age)/float(nPings)
+            perTotalWeights[pIdx] = w
 
         # 2b. Write per-day results into the DB.
         for pIdx in xrange(len(intervals)):
@@ -875,10 +1132,6 @@ class PingLog:
                 rel = wrcvd / wsent
             else:
                 rel = 0.0
-            #if sent:
-            #    log.warn("Of pings sent on day %s, %s/%s were received. "
-            #             "rel=%s/%s=%s",
-            #             pIdx, rcvd, sent, wrcvd, wsent, rel)
             self._setOneHop(
                 (serverID, intervalID),
                 (sent, rcvd, latent, wsent, wrcvd, rel))
@@ -905,9 +1158,69 @@ class PingLog:
         self._setCurOneHop((serverID,), (self._db.time(now), latent, rel))
         return rel
 
+    def _updateOneHopSummaries(self, serverID, intervals):
+        """Helper: recompute the echolotOneHopSummary rows for the server
+           whose ID is 'serverID', for every interval in 'intervals' during
+           which we have sent or received any probes since we last did so.
+           Does not commit the current transaction.
+        """
+        cur = self._db.getCursor()
+        startTime = intervals[0][0]
+        endTime = intervals[-1][1]
+        cur.execute("SELECT sentAt, receivedAt FROM echolotOneHopHighWater "
+                    "WHERE server = ?", (serverID,))
+        r = cur.fetchall()
+        if r:
+            sentMark, receivedMark = r[0]
+        else:
+            sentMark = receivedMark = 0
+
+        # Which intervals have changed?
+        cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
+                    " AND sentat >= ? AND sentat >= ? AND sentat < ?",
+                    (serverID, sentMark, startTime, endTime))
+        changed = cur.fetchall()
+        cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
+                    " AND received >= ? AND received > 0"
+                    " AND sentat >= ? AND sentat < ?",
+                    (serverID, receivedMark, startTime, endTime))
+        changed.extend(cur.fetchall())
+        if not changed:
+            return
+        dirty = {}
+        for sent, received in changed:
+            dirty[self._intervals.getIntervalContaining(sent)] = 1
+            sentMark = max(sentMark, sent)
+            receivedMark = max(receivedMark, received)
+
+        # Recompute the summaries for those intervals from scratch.
+        for s, e in intervals:
+            if not dirty.has_key((s,e)):
+                continue
+            cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
+                        " AND sentat >= ? AND sentat < ?",
+                        (serverID, s, e))
+            nSent = 0
+            latencies = []
+            pending = []
+            for sent, received in cur.fetchall():
+                nSent += 1
+                if received:
+                    latencies.append(received-sent)
+                else:
+                    pending.append(sent)
+            latencies.sort()
+            pending.sort()
+            self._setOneHopSummary(
+                (serverID, self._getIntervalID(s,e)),
+                (nSent, len(latencies), _encodeTimes(latencies),
+                 _encodeTimes(pending)))
+        self._setOneHopHighWater((serverID,), (sentMark, receivedMark))
+
     def calculateOneHopResult(self, now=None):
         """Calculate latency and reliability for all servers.
         """
+        self.flush()
         self._lock.acquire()
         try:
             serverIdentities = self._serverIDs.keys()
@@ -983,6 +1296,7 @@ class PingLog:
     _CHAIN_PING_HORIZON = 12*ONE_DAY
     def calculateChainStatus(self, now=None):
         """Calculate the status of all two-hop chains."""
+        self.flush()
         self._lock.acquire()
         try:
             serverIdentities = self._serverIDs.keys()
@@ -1025,6 +1339,7 @@ class PingLog:
     def dumpAllStatus(self,f,since,now=None):
         """Write statistics into the file object 'f' for all intervals since
            'since', inclusive."""
+        self.flush()
         self._lock.acquire()
         try:
             serverIdentities = self._serverIDs.keys()
@@ -1117,6 +1432,17 @@ class PingLog:
            database.
         """
         if now is None: now=time.time()
+        self._calculateAll(now)
+        if outFname:
+            log.info("Writing ping results to disk")
+            f = AtomicFile(outFname, 'w')
+            self.dumpAllStatus(f, now-24*60*60*12, now)
+            f.close()
+        log.info("Done computing ping results")
+        self.lastCalculation = now
+
+    def _calculateAll(self, now):
+        """Helper: recalculate all statistics into the database."""
         log.info("Computing ping results.")
         log.info("Starting to compute server uptimes.")
         self.calculateUptimes(now-24*60*60*12, now)
@@ -1124,13 +1450,159 @@ class PingLog:
         self.calculateOneHopResult(now)
         log.info("Starting to compute two-hop chain status")
         self.calculateChainStatus(now)
-        if outFname:
-            log.info("Writing ping results to disk")
-            f = AtomicFile(outFname, 'w')
-            self.dumpAllStatus(f, now-24*60*60*12, now)
-            f.close()
+
+    def getCalculatedResults(self):
+        """Return a 3-tuple of copies of the most recently computed server
+           reliabilities, broken chains, and interesting chains."""
+        self._lock.acquire()
+        try:
+            return (self._serverReliability.copy(),
+                    self._brokenChains.copy(),
+                    self._interestingChains.copy())
+        finally:
+            self._lock.release()
+
+    def setCalculatedResults(self, reliability, brokenChains,
+                             interestingChains):
+        """Replace the in-memory server reliabilities, broken chains, and
+           interesting chains with ones computed elsewhere (probably by a
+           PingStatsCalculator)."""
+        self._lock.acquire()
+        try:
+            self._serverReliability.update(reliability)
+            self._brokenChains = brokenChains
+            self._interestingChains = interestingChains
+        finally:
+            self._lock.release()
+
+class PingStatsCalculator:
+    """A PingStatsCalculator recomputes the statistics for a PingLog in a
+       thread of its own, with its own connection to the ping database, so
+       that the many queries involved don't hold up the main loop or the
+       database thread.  The results are handed back to the main thread,
+       which publishes them by calling publish().
+    """
+    ## Fields:
+    # pingLog: the PingLog (or BackgroundingDecorator around a PingLog)
+    #    used by the rest of the server.
+    # thread: a ProcessingThread to run the calculations.
+    # _calcLog: a PingLog with its own database connection.  Only used
+    #    from 'thread'.
+    # _lock: a threading.Lock to protect _results and _inProgress.
+    # _results: None, or a tuple of (time calculated, status file contents,
+    #    reliability, broken chains, interesting chains) for results that
+    #    have not yet been published.
+    # _inProgress: true iff a calculation is queued or running.
+    def __init__(self, pingLog):
+        """Create a new PingStatsCalculator to compute statistics for
+           'pingLog'."""
+        self.pingLog = pingLog
+        self.thread = mixminion.ThreadUtils.ProcessingThread(
+            "ping statistics thread")
+        self._calcLog = None
+        self._lock = threading.Lock()
+        self._results = None
+        self._inProgress = 0
+
+    def start(self):
+        """Start the calculation thread."""
+        self.thread.start()
+
+    def shutdown(self):
+        """Tell the calculation thread to stop, abandoning any pending
+           calculation."""
+        # The database connection must be closed from the thread that
+        # opened it.
+        self.thread.mqueue.clear()
+        self.thread.addJob(self._closeCalcLog)
+        self.thread.shutdown(flush=0)
+
+    def join(self):
+        """Wait for the calculation thread to stop."""
+        self.thread.join()
+
+    def _closeCalcLog(self):
+        """Helper: run in the calculation thread.  Release our database
+           connection."""
+        if self._calcLog is not None:
+            self._calcLog.close()
+            self._calcLog = None
+
+    def isAlive(self):
+        """Return true iff the calculation thread is still running."""
+        return self.thread.isAlive()
+
+    def scheduleCalculation(self, now=None):
+        """Queue a recalculation of all the statistics.  Does nothing if a
+           calculation is already queued or running."""
+        self._lock.acquire()
+        try:
+            if self._inProgress:
+                log.info("Ping results are still being computed; "
+                         "not starting another computation.")
+                return
+            self._inProgress = 1
+        finally:
+            self._lock.release()
+        def job(self=self, now=now):
+            try:
+                self._calculate(now)
+            finally:
+                self._lock.acquire()
+                self._inProgress = 0
+                self._lock.release()
+        self.thread.addJob(job)
+
+    def _calculate(self, now=None):
+        """Helper: run in the calculation thread.  Compute all statistics,
+           and remember the results for publish()."""
+        startTime = self.pingLog._startTime
+        if startTime is None:
+            log.info("Ping log not yet started; delaying ping results.")
+            return
+        if self._calcLog is None:
+            self._calcLog = PingLog(self.pingLog._db.openNewConnection())
+        calcLog = self._calcLog
+        # Pick up any servers that the server has learned about.
+        calcLog._lock.acquire()
+        try:
+            calcLog._loadServers()
+        finally:
+            calcLog._lock.release()
+        calcLog._startTime = startTime
+
+        if now is None: now = time.time()
+        calcLog._calculateAll(now)
+        f = cStringIO.StringIO()
+        calcLog.dumpAllStatus(f, now-24*60*60*12, now)
+        reliability, broken, interesting = calcLog.getCalculatedResults()
+        self._lock.acquire()
+        try:
+            self._results = (now, f.getvalue(), reliability, broken,
+                             interesting)
+        finally:
+            self._lock.release()
         log.info("Done computing ping results")
-        self.lastCalculation = now
+
+    def publish(self, outFname):
+        """Called from the main thread.  If a calculation has finished since
+           the last call, write its results to 'outFname' and tell our
+           PingLog about them.  Return true iff we published anything."""
+        self._lock.acquire()
+        try:
+            results = self._results
+            self._results = None
+        finally:
+            self._lock.release()
+        if results is None:
+            return 0
+        now, status, reliability, broken, interesting = results
+        log.info("Writing ping results to disk")
+        f = AtomicFile(outFname, 'w')
+        f.write(status)
+        f.close()
+        self.pingLog.setCalculatedResults(reliability, broken, interesting)
+        return 1
 
 class PingGenerator:
     """Abstract class: A PingGenerator periodically sends traffic into the
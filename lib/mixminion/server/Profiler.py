@@ -0,0 +1,133 @@
+# Copyright 2002-2011 Nick Mathewson.  See LICENSE for licensing information.
+
+"""mixminion.server.Profiler
+
+   A sampling profiler for a running server.  When asked, it periodically
+   records the stack of every thread in the process for a fixed window,
+   and writes the results in 'collapsed stack' format: one line for each
+   distinct stack, with the thread name and the frames from outermost to
+   innermost separated by semicolons, followed by the number of samples
+   that saw that stack.  Tools like flamegraph.pl read this format
+   directly.
+
+   Unlike the 'profile' module, sampling costs nothing when it isn't
+   running, and little when it is, so it's safe to use on a server that
+   is carrying real traffic."""
+
+__all__ = [ 'SamplingProfiler', 'canProfile', 'SAMPLE_INTERVAL' ]
+
+import logging
+import sys
+import thread
+import threading
+import time
+
+from mixminion.Common import writeFile
+
+
+log = logging.getLogger(__name__)
+
+
+# How long, in seconds, do we wait between samples?
+SAMPLE_INTERVAL = 0.01
+
+def canProfile():
+    """Return true iff this Python can inspect the stacks of other
+       threads.  (Python 2.5 and later.)"""
+    return hasattr(sys, "_current_frames")
+
+def _getThreadNames():
+    """Helper: return a map from thread ID to a readable name for every
+       live thread we know about."""
+    names = {}
+    for t in threading.enumerate():
+        ident = getattr(t, "ident", None)
+        if ident is None:
+            continue
+        # ProcessingThread keeps a better name than threading does.
+        name = getattr(t, "threadName", None) or t.getName()
+        if name.startswith("Thread-"):
+            name = t.__class__.__name__
+        names[ident] = name.replace(" ", "_").replace(";", ":")
+    return names
+
+def _frameName(frame):
+    """Helper: return a string to identify the function running in 'frame',
+       in the form module:function."""
+    code = frame.f_code
+    module = frame.f_globals.get("__name__") or code.co_filename
+    return "%s:%s" % (module, code.co_name)
+
+class SamplingProfiler(threading.Thread):
+    """Thread that samples the stacks of all the other threads every
+       'interval' seconds for 'duration' seconds, and then writes what it
+       saw to a file.
+
+       Since every thread is sampled whether or not it's running, this is a
+       wall-clock profile: a thread blocked in select or waiting on a queue
+       shows up as often as one that's busy.  Look at the innermost frames
+       to tell them apart."""
+    ## Fields:
+    # fname: the file to write our results to.
+    # duration: how long, in seconds, to sample for.
+    # interval: how long, in seconds, to wait between samples.
+    # samples: a map from stack (a tuple of thread name and frame names,
+    #    outermost first) to the number of times we've seen it.
+    # nSamples: the number of times we've sampled all the threads.
+    # _stopping: flag: has someone asked us to stop early?
+    def __init__(self, fname, duration, interval=SAMPLE_INTERVAL):
+        """Create a new SamplingProfiler to write its results to 'fname'.
+           Call start() to begin sampling."""
+        threading.Thread.__init__(self)
+        # Don't keep the process alive just to finish a profile.
+        self.setDaemon(1)
+        self.fname = fname
+        self.duration = duration
+        self.interval = interval
+        self.samples = {}
+        self.nSamples = 0
+        self._stopping = 0
+
+    def stop(self):
+        """Tell this profiler to stop sampling and write its results now.
+           Blocks until the results are written."""
+        self._stopping = 1
+        self.join()
+
+    def sample(self):
+        """Record the current stack of every thread except this one."""
+        names = _getThreadNames()
+        me = thread.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frameName(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread-%s"%ident))
+            stack.reverse()
+            stack = tuple(stack)
+            self.samples[stack] = self.samples.get(stack, 0) + 1
+        self.nSamples += 1
+
+    def getCollapsedStacks(self):
+        """Return a string holding our samples in collapsed stack format."""
+        items = self.samples.items()
+        items.sort()
+        lines = [ "%s %s" % (";".join(stack), n) for stack, n in items ]
+        lines.append("")
+        return "\n".join(lines)
+
+    def run(self):
+        try:
+            log.info("Profiling all threads for %s seconds", self.duration)
+            end = time.time() + self.duration
+            while not self._stopping and time.time() < end:
+                self.sample()
+                time.sleep(self.interval)
+            writeFile(self.fname, self.getCollapsedStacks(), mode=0600)
+            log.info("Wrote %s profile samples to %s", self.nSamples,
+                     self.fname)
+        except:
+            log.exception("Exception while profiling; giving up.")
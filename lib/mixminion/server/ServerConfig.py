@@ -225,6 +225,9 @@ class ServerConfig(mixminion.Config._ConfigFile):
     def getStatsFile(self):
         """Return the configured stats file location."""
         return self._get_fname("Server", "StatsFile", "stats")
+    def getMetricsFile(self):
+        """Return the location of the live metrics snapshot."""
+        return os.path.join(self.getWorkDir(), "metrics")
     def getKeyDir(self):
         """Return the configured key directory"""
         return self._get_fname("Server", "KeyDir", "keys")
@@ -339,6 +342,8 @@ SERVER_SYNTAX =  {
                      'LogStats' : ('ALLOW', "boolean", 'yes'),
                      'StatsInterval' : ('ALLOW', "interval",
                                         "1 day"),
+                     'TracePackets' : ('ALLOW', "boolean", "yes"),
+                     'ProfileWindow' : ('ALLOW', "interval", "30 sec"),
                      'EncryptIdentityKey' :('ALLOW', "boolean", "no"),
                      'IdentityKeyBits': ('ALLOW', "int", "2048"),
                      'PublicKeyLifetime' : ('ALLOW', "interval",
@@ -45,6 +45,7 @@ __all__ = [ 'MixminionServer' ]
 
 import errno
 import getopt
+import logging
 import os
 import sys
 import signal
@@ -70,15 +71,20 @@ import mixminion.server.ServerQueue
 import mixminion.server.ServerConfig
 import mixminion.server.ServerKeys
 import mixminion.server.EventStats as EventStats
+import mixminion.server.Metrics as Metrics
+import mixminion.server.Profiler as Profiler
 from mixminion.ScheduleUtils import OneTimeEvent, RecurringEvent, \
      RecurringComplexEvent, RecurringBackgroundEvent, \
      RecurringComplexBackgroundEvent, Scheduler
 
 from bisect import insort
 from mixminion.Common import initLogging, LogStream, MixError, MixFatalError,\
-     UIError, ceilDiv, createPrivateDir, disp64, formatTime, \
-     installSIGCHLDHandler, Lockfile, LockfileLocked, readFile, secureDelete, \
-     succeedingMidnight, tryUnlink, waitForChildren, writeFile
+     UIError, ceilDiv, createPrivateDir, disp64, flushLogs, formatFnameTime, \
+     formatTime, installSIGCHLDHandler, Lockfile, LockfileLocked, readFile, \
+     secureDelete, succeedingMidnight, tryUnlink, waitForChildren, writeFile
+
+
+log = logging.getLogger(__name__)
 
 # Version number for server home-directory.
 #
@@ -146,6 +152,9 @@ is too old to recognize."""
 
     return 1
 
+# Histogram of how long PacketHandler takes to process a packet, in seconds.
+_processTime = Metrics.registry.histogram("packet.process_seconds")
+
 class IncomingQueue(mixminion.Filestore.StringStore):
     """A Queue to accept packets from incoming MMTP connections,
        and hold them until they can be processed.  As packets arrive, and
@@ -184,6 +193,7 @@ class IncomingQueue(mixminion.Filestore.StringStore):
         h = mixminion.Filestore.StringStore.queueMessage(self, pkt)
         log.trace("Inserting packet IN:%s into incoming queue", h)
         assert h is not None
+        Metrics.tracer.enqueued("incoming", h)
         self.processingThread.addJob(
             lambda self=self, h=h: self.__deliverPacket(h))
 
@@ -196,9 +206,12 @@ class IncomingQueue(mixminion.Filestore.StringStore):
            the Mix pool.  This function is called from within the processing
            thread."""
         ph = self.packetHandler
+        started = Metrics.tracer.dequeued("incoming", handle)
         packet = self.messageContents(handle)
         try:
+            start = time.time()
             res = ph.processPacket(packet)
+            _processTime.observe(time.time()-start)
             if res is None:
                 # Drop padding before it gets to the mix.
                 log.debug("Padding packet IN:%s dropped", handle)
@@ -218,8 +231,10 @@ class IncomingQueue(mixminion.Filestore.StringStore):
                         #XXXX008 defer decoding to module; don't do it here.
                         res.decode()
 
-                self.mixPool.queueObject(res)
+                h2 = self.mixPool.queueObject(res)
                 self.removeMessage(handle)
+                Metrics.tracer.serviced("incoming", started)
+                Metrics.tracer.enqueued("mix", h2)
                 log.debug("Processed packet IN:%s; inserting into mix pool",
                           handle)
         except mixminion.Crypto.CryptoError, e:
@@ -306,6 +321,7 @@ class MixPool:
                   self.queue.count(), len(handles))
 
         for h in handles:
+            started = Metrics.tracer.dequeued("mix", h)
             try:
                 packet = self.queue.getObject(h)
             except mixminion.Filestore.CorruptedFile:
@@ -320,10 +336,12 @@ class MixPool:
             else:
                 address = packet.getAddress()
                 h2 = self.outgoingQueue.queueDeliveryMessage(packet, address)
+                Metrics.tracer.enqueued("outgoing", h2)
                 log.debug("  (sending packet MIX:%s to MMTP server as OUT:%s)"
                           , h, h2)
             # In any case, we're through with this packet now.
             self.queue.removeMessage(h)
+            Metrics.tracer.serviced("mix", started)
 
     def getNextMixTime(self, now):
         """Given the current time, return the time at which we should next
@@ -385,13 +403,18 @@ class OutgoingQueue(mixminion.server.ServerQueue.PerAddressDeliveryQueue):
                 for pending in packets:
                     log.trace("Delivering packet OUT:%s to myself.",
                               pending.getHandle())
+                    started = Metrics.tracer.dequeued("outgoing",
+                                                      pending.getHandle())
                     self.incomingQueue.queuePacket(
                         pending.getMessage().getPacket())
                     pending.succeeded()
+                    Metrics.tracer.serviced("outgoing", started)
                 continue
 
             deliverable[routing] = [
-                mixminion.server.MMTPServer.DeliverablePacket(pending)
+                mixminion.server.MMTPServer.DeliverablePacket(
+                    pending, Metrics.tracer.dequeued("outgoing",
+                                                     pending.getHandle()))
                 for pending in packets ]
             log.trace("Delivering packets OUT:[%s] to %s",
                       " ".join([p.getHandle() for p in packets]),
@@ -507,10 +530,19 @@ def _sigHupHandler(signal_num, _):
     global GOT_HUP
     GOT_HUP = 1
 
+GOT_USR1 = 0 # Set to one if we get SIGUSR1.
+def _sigUsr1Handler(signal_num, _):
+    '''(Signal handler for SIGUSR1)'''
+    signal.signal(signal_num, _sigUsr1Handler)
+    global GOT_USR1
+    GOT_USR1 = 1
+
 def installSignalHandlers():
-    """Install signal handlers for sigterm and sighup."""
+    """Install signal handlers for sigterm, sighup, and sigusr1."""
     if hasattr(signal, 'SIGHUP'):
         signal.signal(signal.SIGHUP, _sigHupHandler)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, _sigUsr1Handler)
     signal.signal(signal.SIGTERM, _sigTermHandler)
 
 class MixminionServer(Scheduler):
@@ -549,6 +581,10 @@ class MixminionServer(Scheduler):
     #    about network probing activity.
     # pingGenerator: None, or an instance of PingGenerator that will decide
     #    when to generate probe traffic.
+    # pingStatsCalculator: None, or an instance of PingStatsCalculator to
+    #    recompute pinger statistics in the background.
+    # profiler: None, or the Profiler.SamplingProfiler we started most
+    #    recently.
     def __init__(self, config):
         """Create a new server from a ServerConfig."""
         Scheduler.__init__(self)
@@ -669,6 +705,8 @@ class MixminionServer(Scheduler):
             log.debug("Initializing ping log")
             self.pingLog = mixminion.server.Pinger.openPingLog(
                 config, databaseThread=self.databaseThread)
+            self.pingStatsCalculator = \
+                mixminion.server.Pinger.PingStatsCalculator(self.pingLog)
 
             log.debug("Initializing ping generator")
             self.pingGenerator=mixminion.server.Pinger.getPingGenerator(config)
@@ -677,13 +715,23 @@ class MixminionServer(Scheduler):
                 log.warn("Running a pinger requires Python 2.2 or later, and the pysqlite module")
             self.pingLog = None
             self.pingGenerator = None
+            self.pingStatsCalculator = None
             self.databaseThread = None
 
         self.cleaningThread = CleaningThread()
         self.processingThread = ProcessingThread()
+        self.profiler = None
 
         self.dnsCache = mixminion.server.DNSFarm.DNSCache()
 
+        log.debug("Initializing metrics")
+        Metrics.configureTracing(config)
+        self.metricsFile = config.getMetricsFile()
+        Metrics.registry.gauge("queue.incoming", self.incomingQueue.count)
+        Metrics.registry.gauge("queue.mix", self.mixPool.count)
+        Metrics.registry.gauge("queue.outgoing", self.outgoingQueue.count)
+        Metrics.registry.gauge("queue.modules", self.moduleManager.count)
+
         log.debug("Connecting queues")
         self.incomingQueue.connectQueues(mixPool=self.mixPool,
                                        processingThread=self.processingThread)
@@ -705,7 +753,10 @@ class MixminionServer(Scheduler):
 
         if self.databaseThread is not None:
             self.databaseThread.start()
+        if self.pingStatsCalculator is not None:
+            self.pingStatsCalculator.start()
         if self.pingLog is not None:
+            self.pingLog.startup()
             self.incomingQueue.setPingLog(self.pingLog)
             self.mmtpServer.connectPingLog(self.pingLog)
 
@@ -781,6 +832,7 @@ class MixminionServer(Scheduler):
     def run(self):
         """Run the server; don't return unless we hit an exception."""
         global GOT_HUP
+        global GOT_USR1
         # See the win32 comment in replacecontents to learn why this is
         # left-justified. :P
         self.lockFile.replaceContents("%-10s\n"%os.getpid())
@@ -792,6 +844,12 @@ class MixminionServer(Scheduler):
         self.scheduleEvent(RecurringEvent(now+180,
                                      lambda: waitForChildren(blocking=0),
                                      180))
+        self.scheduleEvent(RecurringEvent(
+            now+mixminion.Common.LOG_FLUSH_INTERVAL, flushLogs,
+            mixminion.Common.LOG_FLUSH_INTERVAL))
+        self.scheduleEvent(RecurringEvent(now+Metrics.SNAPSHOT_INTERVAL,
+                                          self.writeMetrics,
+                                          Metrics.SNAPSHOT_INTERVAL))
         if EventStats.elog.getNextRotation():
             def _rotateStats():
                 EventStats.elog.rotate()
@@ -838,13 +896,21 @@ class MixminionServer(Scheduler):
                 now+mixminion.server.Pinger.HEARTBEAT_INTERVAL,
                 self.pingLog.heartbeat,
                 mixminion.server.Pinger.HEARTBEAT_INTERVAL))
-            # FFFF if we aren't using a LOCKING_IS_COURSE database, we will
-            # FFFF still want this to happen in another thread.
+            self.scheduleEvent(RecurringEvent(
+                now+mixminion.server.Pinger.FLUSH_INTERVAL,
+                self.pingLog.flush,
+                mixminion.server.Pinger.FLUSH_INTERVAL))
+            # The statistics are computed in the ping statistics thread; we
+            # only write them to disk from here.
             self.scheduleEvent(RecurringEvent(
                 now+60,
-                lambda self=self: self.pingLog.calculateAll(
-                  os.path.join(self.config.getWorkDir(), "pinger", "status")),
+                self.pingStatsCalculator.scheduleCalculation,
                 self.config['Pinging']['RecomputeInterval'].getSeconds()))
+            self.scheduleEvent(RecurringEvent(
+                now+120,
+                lambda self=self: self.pingStatsCalculator.publish(
+                  os.path.join(self.config.getWorkDir(), "pinger", "status")),
+                60))
 
         # Makes next update get scheduled.
         nextUpdate = self.updateDirectoryClient(reschedulePings=0)
@@ -881,10 +947,16 @@ class MixminionServer(Scheduler):
                     log.info("Caught SIGHUP")
                     self.doReset()
                     GOT_HUP = 0
+                elif GOT_USR1:
+                    log.info("Caught SIGUSR1")
+                    self.startProfiling()
+                    GOT_USR1 = 0
                 # Make sure that our worker threads are still running.
                 if not (self.cleaningThread.isAlive() and
                         self.processingThread.isAlive() and
-                        self.moduleManager.thread.isAlive()):
+                        self.moduleManager.thread.isAlive() and
+                        (self.pingStatsCalculator is None or
+                         self.pingStatsCalculator.isAlive())):
                     log.critical("One of our threads has halted; shutting down.")
                     return
 
@@ -903,7 +975,9 @@ class MixminionServer(Scheduler):
            regenerates/republishes descriptors as needed.
         """
         log.info("Resetting logs")
+        flushLogs()
         EventStats.elog.save()
+        self.writeMetrics()
         self.packetHandler.syncLogs()
         log.info("Checking for key rotation")
         self.keyring.checkKeys()
@@ -911,6 +985,32 @@ class MixminionServer(Scheduler):
         self.moduleManager.sync()
         self.outgoingQueue.sync()
 
+    def startProfiling(self):
+        """Called when the server receives SIGUSR1.  Starts sampling the
+           stacks of all our threads for the configured ProfileWindow, and
+           then writes them to a new file under WorkDir/profile.
+        """
+        if not Profiler.canProfile():
+            log.warn("Profiling requires Python 2.5 or later")
+            return
+        if self.profiler is not None and self.profiler.isAlive():
+            log.warn("Already profiling; ignoring request")
+            return
+        profileDir = os.path.join(self.config.getWorkDir(), "profile")
+        createPrivateDir(profileDir)
+        fname = os.path.join(profileDir, "profile-%s.txt"%formatFnameTime())
+        window = self.config['Server']['ProfileWindow'].getSeconds()
+        self.profiler = Profiler.SamplingProfiler(fname, window)
+        self.profiler.start()
+
+    def writeMetrics(self):
+        """Write a snapshot of our live metrics, so that 'mixminiond
+           server-stats' can read them."""
+        try:
+            Metrics.registry.writeSnapshot(self.metricsFile)
+        except (OSError, IOError), e:
+            log.warn("Couldn't write metrics snapshot: %s", e)
+
     def doMix(self):
         """Called when the server's mix is about to fire.  Picks some
            packets to send, and sends them to the appropriate queues.
@@ -952,6 +1052,7 @@ class MixminionServer(Scheduler):
         self.mixPool.queue.cleanQueue(df)
         self.outgoingQueue.cleanQueue(df)
         self.moduleManager.cleanQueues(df)
+        Metrics.tracer.expire(time.time()-Metrics.MAX_TRACE_AGE)
         if self.pingLog:
             now = time.time()
             self.pingLog.rotate(now-self.config['Pinging']['RetainData'].getSeconds(),
@@ -959,17 +1060,21 @@ class MixminionServer(Scheduler):
 
     def close(self):
         """Release all resources; close all files."""
+        if self.profiler is not None and self.profiler.isAlive():
+            self.profiler.stop()
         if self.pingLog is not None:
             self.pingLog.shutdown()
         self.cleaningThread.shutdown()
         self.processingThread.shutdown()
         self.moduleManager.shutdown()
         if self.databaseThread: self.databaseThread.shutdown(flush=0)
+        if self.pingStatsCalculator: self.pingStatsCalculator.shutdown()
 
         self.cleaningThread.join()
         self.processingThread.join()
         self.moduleManager.join()
         if self.databaseThread: self.databaseThread.join()
+        if self.pingStatsCalculator: self.pingStatsCalculator.join()
 
         self.packetHandler.close()
         self.moduleManager.close()
@@ -981,6 +1086,8 @@ class MixminionServer(Scheduler):
                 self.pingLog.close()
 
         EventStats.elog.save()
+        self.writeMetrics()
+        flushLogs()
 
         self.lockFile.release()
 
@@ -1331,7 +1438,8 @@ def runDELKEYS(cmd, args):
 #----------------------------------------------------------------------
 _PRINT_STATS_USAGE = """\
 Usage: mixminiond stats [options]
-Print server statistics for the current statistics interval.
+Print server statistics for the current statistics interval, and the
+server's live metrics (queue sizes, latencies, and so on).
 Options:
   -h, --help:                Print this usage message and exit.
   -f <file>, --config=<file> Use a configuration file other than the default.
@@ -1339,12 +1447,21 @@ Options:
 
 def printServerStats(cmd, args):
     """[Entry point]  Print server statistics for the current statistics
-       interval."""
+       interval, followed by the latest snapshot of live metrics."""
     config = configFromServerArgs(cmd, args, _PRINT_STATS_USAGE)
     checkHomedirVersion(config)
     _signalServer(config, 1)
     EventStats.configureLog(config)
     EventStats.elog.dump(sys.stdout)
+    metricsFile = config.getMetricsFile()
+    if not os.path.exists(metricsFile):
+        print "No live metrics found; has the server been running long?"
+        return
+    try:
+        when, metrics = Metrics.readSnapshot(metricsFile)
+    except MixError, e:
+        raise UIError("Couldn't read live metrics: %s" % e)
+    sys.stdout.write(Metrics.formatSnapshot(when, metrics))
 
 #----------------------------------------------------------------------
 _SIGNAL_SERVER_USAGE = """\
@@ -1378,6 +1495,14 @@ def _signalServer(config, reload):
        server if it's running.  If 'reload', the signal is HUP.  Else,
        the signal is TERM.
     """
+    if reload:
+        _sendSignal(config, signal.SIGHUP, "SIGHUP")
+    else:
+        _sendSignal(config, signal.SIGTERM, "SIGTERM")
+
+def _sendSignal(config, signal_num, signal_name):
+    """Given a configuration file, sends the signal 'signal_num' to the
+       corresponding server if it's running."""
     pidFile = config.getPidFile()
     if not os.path.exists(pidFile):
         raise UIError("No server seems to be running.")
@@ -1387,13 +1512,6 @@ def _signalServer(config, reload):
     except (IOError, ValueError), e:
         raise UIError("Couldn't read pid file: %s"%e)
 
-    if reload:
-        signal_num = signal.SIGHUP
-        signal_name = "SIGHUP"
-    else:
-        signal_num = signal.SIGTERM
-        signal_name = "SIGTERM"
-
     try:
         print "Sending %s to server (pid=%s)"%(signal_name, pid)
         os.kill(pid, signal_num)
@@ -1401,6 +1519,29 @@ def _signalServer(config, reload):
     except OSError, e:
         print UIError("Couldn't send signal: %s"%e)
 
+#----------------------------------------------------------------------
+_PROFILE_USAGE = """\
+Usage: mixminiond profile [options]
+Tell a mixminion server to sample what all of its threads are doing for
+a while (see ProfileWindow in mixminiond.conf), and write the results to
+a new file in WorkDir/profile.
+Options:
+  -h, --help:                Print this usage message and exit.
+  -f <file>, --config=<file> Use a configuration file other than the default.
+""".strip()
+
+def profileServer(cmd, args):
+    """[Entry point] Send a SIGUSR1 to a running mixminion server, to
+       make it profile itself."""
+    config = configFromServerArgs(cmd, args, usage=_PROFILE_USAGE)
+
+    checkHomedirVersion(config)
+
+    if not hasattr(signal, 'SIGUSR1'):
+        raise UIError("Profiling a server isn't supported on this platform")
+
+    _sendSignal(config, signal.SIGUSR1, "SIGUSR1")
+
 #----------------------------------------------------------------------
 _REPUBLISH_USAGE = """\
 Usage: mixminiond republish [options]
@@ -11,20 +11,25 @@
 
 __pychecker__ = 'no-funcdoc maxlocals=100'
 
+import array
 import base64
+import binascii
 import cPickle
 import cStringIO
 import gzip
+import logging
 import operator
 import os
 import re
 import socket
+import ssl
 import stat
 import struct
 import sys
 import threading
 import time
 import types
+import zlib
 from string import atoi
 
 # Not every post-2.0 version of Python has a working 'unittest' module, so
@@ -761,6 +766,20 @@ World!
         dec2 = unarmorText(enc1+enc3+enc2, ["THIS THAT"], base64fn=base64fn)
         self.assertEquals(dec2, dec)
 
+        # Reading from a file gives the same answers, one at a time.
+        def readAll(s, types, base64=1, base64fn=None):
+            r = ArmoredTextReader(cStringIO.StringIO(s), types, base64,
+                                  base64fn)
+            return [ item for item in r ]
+        self.assertEquals(readAll(enc1+enc3+enc2, ["THIS THAT"],
+                                  base64fn=base64fn), dec)
+        self.assertEquals(readAll("Hi\n"+enc3, ["THIS THAT"]), [])
+        enc = armorText(inp2*50, "MUNGED", [], base64=1)
+        self.assertEquals(readAll(enc.replace("\n","\r\n"), ["MUNGED"]),
+                          unarmorText(enc, ["MUNGED"], 1))
+        self.assertRaises(ValueError, readAll, "-----BEGIN X-----\n\n",
+                          ["Y"], 1)
+
         # Test skipping broken armor.
         self.assertRaises(ValueError,
                           unarmorText,"-----BEGIN X-----\n\n", ["Y"], 1)
@@ -839,6 +858,34 @@ World!
 
 #----------------------------------------------------------------------
 
+# Reference implementations of LIONESS and BEAR, in Python, to check the
+# versions in _minionlib against.
+def _lioness_encrypt_py(s, (key1, key2, key3, key4)):
+    left, right = s[:20], s[20:]
+    right = ctr_crypt(right, sha1(key1+left+key1)[:16])
+    left = strxor(left, sha1(key2+right+key2))
+    right = ctr_crypt(right, sha1(key3+left+key3)[:16])
+    left = strxor(left, sha1(key4+right+key4))
+    return left + right
+
+def _lioness_decrypt_py(s, (key1, key2, key3, key4)):
+    left, right = s[:20], s[20:]
+    left = strxor(left, sha1(key4+right+key4))
+    right = ctr_crypt(right, sha1(key3+left+key3)[:16])
+    left = strxor(left, sha1(key2+right+key2))
+    right = ctr_crypt(right, sha1(key1+left+key1)[:16])
+    return left + right
+
+def _bear_encrypt_py(s, (key1, key2)):
+    left, right = s[:20], s[20:]
+    left = strxor(left, sha1(key1+right+key1))
+    right = ctr_crypt(right, sha1(left)[:16])
+    left = strxor(left, sha1(key2+right+key2))
+    return left + right
+
+def _bear_decrypt_py(s, (key1, key2)):
+    return _bear_encrypt_py(s, (key2, key1))
+
 class MinionlibCryptoTests(TestCase):
     """Tests for cryptographic C extensions."""
     def test_sha1(self):
@@ -923,6 +970,42 @@ class MinionlibCryptoTests(TestCase):
         # ...or a long string.
         self.failUnlessRaises(TypeError, _ml.aes_key, "a"*17)
 
+    def test_lioness_and_bear(self):
+        eq = self.assertEquals
+        prng = AESCounterPRNG("lioness and bear")
+        lkeys = tuple([ prng.getBytes(20) for _ in range(4) ])
+        bkeys = lkeys[:2]
+        for fn, ref, keys in ((_ml.lioness_encrypt, _lioness_encrypt_py, lkeys),
+                              (_ml.lioness_decrypt, _lioness_decrypt_py, lkeys),
+                              (_ml.bear_encrypt, _bear_encrypt_py, bkeys),
+                              (_ml.bear_decrypt, _bear_decrypt_py, bkeys)):
+            # Short blocks take a different AES path from long ones; try
+            # both, and lengths that aren't a multiple of the block size.
+            for n in 21, 36, 67, 1024, 2048+7, 28*1024:
+                s = prng.getBytes(n)
+                orig = s[:]
+                res = fn(s, keys)
+                eq(res, ref(s, keys))
+                eq(s, orig)
+                # Writable buffers are changed in place.
+                buf = array.array('c', s)
+                self.assert_(fn(buf, keys) is None)
+                eq(buf.tostring(), res)
+            # A list of keys is fine too.
+            eq(fn("x"*30, list(keys)), ref("x"*30, keys))
+
+            # Bad buffers and bad keys.
+            self.failUnlessRaises(TypeError, fn, "x"*20, keys)
+            self.failUnlessRaises(TypeError, fn, buffer("x"*30), keys)
+            self.failUnlessRaises(TypeError, fn, "x"*30, keys[:-1])
+            self.failUnlessRaises(TypeError, fn, "x"*30, keys[:-1]+("k",))
+            self.failUnlessRaises(TypeError, fn, "x"*30, None)
+
+        # Decryption inverts encryption.
+        s = prng.getBytes(100)
+        eq(s, _ml.lioness_decrypt(_ml.lioness_encrypt(s, lkeys), lkeys))
+        eq(s, _ml.bear_decrypt(_ml.bear_encrypt(s, bkeys), bkeys))
+
     def test_openssl_seed(self):
         # Just try seeding openssl a couple of times, and make sure it
         # doesn't crash.
@@ -1076,6 +1159,7 @@ class MinionlibFECTests(TestCase):
             if i < k:
                 eq(outChunks[i], inpChunks[i])
             eq(len(outChunks[i]), sz)
+        eq(outChunks, fec.encodeAll(inpChunks))
 
         numberedChunks = [ (i, outChunks[i]) for i in xrange(n) ]
 
@@ -1093,6 +1177,15 @@ class MinionlibFECTests(TestCase):
         self.do_fec_test(30,40,1)
         self.do_fec_test(3,4,128)
         self.do_fec_test(3,3,2048)
+        # Lengths that aren't a multiple of the vector size.
+        self.do_fec_test(5,10,28*1024+17)
+
+        # Known-answer test, so that every multiply routine agrees.
+        s = _ml.aes_ctr128_crypt(_ml.aes_key("FEC test vector!"), "", 0, 500)
+        blocks = [ s[i*100:(i+1)*100] for i in xrange(5) ]
+        fec = _ml.FEC_generate(5,10)
+        self.assertEquals(sha1("".join(fec.encodeAll(blocks))),
+                   hexread("01cb4703042cd7824f31a826c6e10cb24731666e"))
 
     def test_bad_fec(self):
 
@@ -1109,6 +1202,9 @@ class MinionlibFECTests(TestCase):
         self.assertRaises(_ml.FECError,fec.encode, 1, inp*2)
         self.assertRaises(_ml.FECError,fec.encode, 1, inp[0:2]+[3])
         self.assertRaises(_ml.FECError,fec.encode, 1, 5)
+        self.assertRaises(_ml.FECError,fec.encodeAll, inp[0:2])
+        self.assertRaises(_ml.FECError,fec.encodeAll, inp[0:2]+[3])
+        self.assertRaises(_ml.FECError,fec.encodeAll, 5)
 
         cInp = [ (i, fec.encode(i, inp)) for i in xrange(5) ]
         fec.decode(cInp[2:5])
@@ -1240,6 +1336,25 @@ class CryptoTests(TestCase):
         self.assertNotEquals(w, u)
         self.assertEquals(unwhiten(w), u)
 
+        # Check the file-based versions, across several read chunks.
+        u = getCommonPRNG().getBytes(Crypto.FILE_CHUNK_LEN*2+101)
+        w = whiten(u)
+        fn = mix_mktemp()
+        writeFile(fn, w+"trailing junk", binary=1)
+        f = open(fn, 'r+b')
+        unwhiten_file(f, len(w))
+        f.close()
+        self.assertLongStringEq(readFile(fn, 1), u+"trailing junk")
+
+        f = open(fn, 'r+b')
+        Crypto.lioness_decrypt_file(f, len(plain), key)
+        f.close()
+        self.assertEquals(readFile(fn, 1)[:len(plain)], dec(u[:len(plain)],key))
+
+        d = new_sha1("abc")
+        d.update(u)
+        self.assertEquals(d.digest(), sha1("abc"+u))
+
     def test_bear(self):
         enc = bear_encrypt
         dec = bear_decrypt
@@ -1648,6 +1763,15 @@ ANHlD+0fHOUA0eUP7R8c5QDR5Q/tHxzlANHlD+0fHOUA0eUP7R8c5QDR5Q/tHxzl
         self.assert_(p.isEncrypted())
         eq(p.getTag(), "9"*20)
 
+        # Reading messages from a file
+        s = "From: x\n\n" + mt1.pack() + "\n\n" + ml1.pack() + menc1.pack()
+        r = TextEncodedMessageReader(cStringIO.StringIO(s))
+        eq([ m.pack() for m in r ], [ m.pack() for m in ptem(s) ])
+        eq([ m.pack() for m in r ], [])
+        r = TextEncodedMessageReader(cStringIO.StringIO(
+            start+"Message-type: bogus\n\n"+v64+end))
+        self.assertRaises(ParseError, r.next)
+
     def testHeaders(self):
         emh = encodeMessageHeaders
         eMh = encodeMailHeaders
@@ -1874,6 +1998,8 @@ class FakeServerInfo:
         self.key = key
         self.keyid = keyid
         self.ip4 = ip4
+        self.validAfter = 0
+        self.validUntil = 0x7fffffff
 
     def getNickname(self): return "N(%s:%s)"%(self.addr,self.port)
     def getIP(self): return self.addr
@@ -1881,6 +2007,8 @@ class FakeServerInfo:
     def getPacketKey(self): return self.key
     def getKeyDigest(self): return self.keyid
     def supportsPacketVersion(self): return 1
+    def getValidAfter(self): return self.validAfter
+    def getValidUntil(self): return self.validUntil
 
     def getRoutingInfo(self):
         if self.ip4:
@@ -1923,6 +2051,58 @@ class BuildMessageTests(TestCase):
 
         self.failUnlessRaises(ParseError, uncompressData, "3")
 
+        # Streaming decompression from a file gives the same results.
+        uncompressFile = mixminion.Packet.uncompressFile
+        c = BuildMessage.compressData(longMsg*300)
+        self.assertEquals(longMsg*300, uncompressFile(cStringIO.StringIO(c)))
+        self.assertEquals(longMsg*300,
+                          uncompressFile(cStringIO.StringIO(c),
+                                         len(longMsg)*300))
+        self.failUnlessRaises(CompressedDataTooLong, uncompressFile,
+                              cStringIO.StringIO(c), len(longMsg)*300-1)
+        self.failUnlessRaises(ParseError, uncompressFile,
+                              cStringIO.StringIO("3"))
+        # Output that zlib only gives us on flush() still counts against
+        # maxLength.
+        realDecompressobj = zlib.decompressobj
+        class HoldingDecompressor:
+            def __init__(self, wbits):
+                self.z = realDecompressobj(wbits)
+                self.held = ""
+                self.unconsumed_tail = ""
+            def decompress(self, data, maxLen=0):
+                d = self.held + self.z.decompress(data)
+                if maxLen:
+                    d, self.held = d[:maxLen], d[maxLen:]
+                else:
+                    self.held = ""
+                return d
+            def flush(self):
+                return self.held + self.z.flush()
+        replaceAttribute(zlib, "decompressobj", HoldingDecompressor)
+        try:
+            c = BuildMessage.compressData(longMsg)
+            self.assertEquals(longMsg, uncompressFile(cStringIO.StringIO(c),
+                                                      len(longMsg)))
+            self.failUnlessRaises(CompressedDataTooLong, uncompressFile,
+                                  cStringIO.StringIO(c), len(longMsg)-10)
+        finally:
+            undoReplacedAttributes()
+
+        # Reading a server-side fragmented message from a file.
+        readSSFM = mixminion.Packet.readServerSideFragmentedMessage
+        ssfm = mixminion.Packet.ServerSideFragmentedMessage(
+            SMTP_TYPE, "a@b.c", "X"*1000).pack()
+        m = readSSFM(cStringIO.StringIO(ssfm), len(ssfm), 1000)
+        self.assertEquals((m.routingtype, m.routinginfo, m.compressedContents),
+                          (SMTP_TYPE, "a@b.c", "X"*1000))
+        self.failUnlessRaises(CompressedDataTooLong, readSSFM,
+                              cStringIO.StringIO(ssfm), len(ssfm), 999)
+        self.failUnlessRaises(ParseError, readSSFM,
+                              cStringIO.StringIO(ssfm[:-1]), len(ssfm))
+        self.failUnlessRaises(ParseError, readSSFM,
+                              cStringIO.StringIO(ssfm[:6]), 6)
+
         for _ in xrange(20):
             for _ in xrange(20):
                 m = p.getBytes(p.getInt(1000))
@@ -2004,6 +2184,29 @@ class BuildMessageTests(TestCase):
                  "Hi mom")
         self.do_header_test(head, pks, secrets, rtypes, rinfo)
 
+    def test_headerbuilder(self):
+        # Build several headers over the same path template in a batch.
+        servers = [self.server1, self.server2, self.server3]
+        builder = BuildMessage.HeaderBuilder(servers, 99, "Hi mom")
+        pks = (self.pk1,self.pk2,self.pk3)
+        rtypes = (FWD_HOST_TYPE, FWD_HOST_TYPE, 99)
+        rinfo = (mixminion.Packet.MMTPHostInfo("127.0.0.2", 3, "Z"*20).pack(),
+                 mixminion.Packet.MMTPHostInfo("127.0.0.3", 5, "Q"*20).pack(),
+                 "Hi mom")
+        secretsList = [ ["9"*16, "1"*16, "z"*16],
+                        ["a"*16, "b"*16, "c"*16],
+                        ["9"*16, "1"*16, "z"*16] ]
+        heads = builder.buildHeaders(secretsList, AESCounterPRNG())
+        self.assertEquals(len(heads), 3)
+        for head, secrets in zip(heads, secretsList):
+            self.do_header_test(head, pks, secrets, rtypes, rinfo)
+        # Same secrets, but different OAEP padding.
+        self.assertNotEquals(heads[0], heads[2])
+
+        # Bad paths are rejected when the builder is created.
+        self.failUnlessRaises(MixError, BuildMessage.HeaderBuilder,
+                              servers, 99, "x"*2048)
+
     def do_header_test(self, head, pks, secrets, rtypes, rinfo):
         """Unwraps and checks the layers of a single header.
                     head: the header to check
@@ -2338,6 +2541,65 @@ class BuildMessageTests(TestCase):
             self.assertEquals(sha1(msg[22:]), msg[2:22])
             self.assertStartsWith(msg[22:], comp)
 
+    def test_header_pool(self):
+        payloadF = BuildMessage.encodeMessage("Hello!!!!",0)[0]
+        hinfo1 = ( (self.pk1,), None, (SWAP_FWD_HOST_TYPE,),
+                   (self.server3.getRoutingInfo().pack(),) )
+        hinfo2 = ( (self.pk3,), None, (500,), ("Goodbye",) )
+
+        # Prebuilt headers make the same packets as buildForwardPacket.
+        h = BuildMessage.prebuildForwardHeaders(500, "Goodbye",
+                                                [self.server1], [self.server3])
+        self.assertEquals(h.path1, [self.server1])
+        self.assertEquals(h.path2, [self.server3])
+        self.do_message_test(h.buildPacket(payloadF), hinfo1, hinfo2,
+                             "Hello!!!!")
+
+        # Validity comes from the servers on the path.
+        self.server1.validAfter = 1000
+        self.server3.validUntil = 5000
+        h = BuildMessage.prebuildForwardHeaders(500, "Goodbye",
+                                                [self.server1], [self.server3])
+        self.assertEquals((h.validAfter, h.validUntil), (1000, 5000))
+        self.assert_(h.isValidFrom(1000, 5000))
+        self.failIf(h.isValidFrom(999, 2000))
+        self.failIf(h.isValidFrom(2000, 5001))
+
+        # Now try a pool.
+        calls = []
+        def generatePaths(n, self=self, calls=calls):
+            calls.append(n)
+            return [ ([self.server1], [self.server3]) ] * n
+        pool = BuildMessage.HeaderPool()
+        pool.addDestination("x", 500, "Goodbye", generatePaths, size=3)
+        self.assertEquals(pool.getHeaders("x", 2000, 3000), None)
+        self.assertEquals(pool.refill(now=2000), 3)
+        self.assertEquals(calls, [3])
+        self.assertEquals(pool.count("x"), 3)
+        self.assertEquals(pool.refill(now=2000), 0)
+        # Each header comes out once, and makes a good packet.
+        h1 = pool.getHeaders("x", 2000, 3000)
+        h2 = pool.getHeaders("x", 2000, 3000)
+        self.failIf(h1 is h2)
+        self.assertEquals(pool.count("x"), 1)
+        self.do_message_test(h1.buildPacket(payloadF), hinfo1, hinfo2,
+                             "Hello!!!!")
+        # We won't hand out headers that expire too soon...
+        self.assertEquals(pool.getHeaders("x", 2000, 6000), None)
+        self.assertEquals(pool.getHeaders("y", 2000, 3000), None)
+        # ...and we drop them once they've expired.
+        self.assertEquals(pool.refill(now=2000), 2)
+        self.assertEquals(pool.count("x"), 3)
+        pool.expire(now=5000)
+        self.assertEquals(pool.count("x"), 0)
+        # A time limit stops refill early.
+        self.assertEquals(pool.refill(now=2000, timeLimit=0), 0)
+        # Removing a destination drops its headers.
+        pool.refill(now=2000)
+        pool.removeDestination("x")
+        self.assertEquals(pool.count("x"), 0)
+        self.assertEquals(pool.refill(now=2000), 0)
+
     def test_buildreply(self):
         brbi = BuildMessage._buildReplyBlockImpl
         brb = BuildMessage.buildReplyBlock
@@ -2586,6 +2848,25 @@ class BuildMessageTests(TestCase):
                                    userKeys={ "Fred":"Bliznerty", "":"z"*20})
                 self.assertPayloadDecodesTo(None, repl2, repl2tag, pk, None)
 
+        # A PayloadDecoder handles a whole batch with the same keys, and
+        # remembers which identity owns a tag.
+        decoder = BuildMessage.PayloadDecoder(rsa1,
+                       [ ("", "z"*20), ("Fred", passwd), ("Joe", "x"*20) ])
+        for _ in xrange(2):
+            nym = []
+            p = decoder.decode(repl2, repl2tag, nym)
+            self.assertEquals(payload, p.getUncompressedContents())
+            self.assertEquals(["Fred"], nym)
+            self.assertEquals(payload, decoder.decode(
+                efwd_p, efwd_t).getUncompressedContents())
+            self.assertEquals(payload, decoder.decode(
+                encoded1, "zzzz"*5).getUncompressedContents())
+        self.assertEquals(decoder._tagOwners, { repl2tag : 1 })
+        self.assertEquals(None, decoder.decode(
+            repl2[:-1] + chr(ord(repl2[-1])^0xaa), repl2tag))
+        self.assertEquals(None, BuildMessage.PayloadDecoder().decode(
+            repl2, repl2tag))
+
         # Try decoding a payload that looks like a zlib bomb.  An easy way to
         # get such a payload is to compress 25K of zeroes.
         nils = "\x00"*(25*1024)
@@ -3105,6 +3386,18 @@ class FilestoreTests(FStoreTestBase):
         self.assertEquals(queue1.count(), 41)
         self.assert_(not os.path.exists(os.path.join(self.d2, "msg_"+h)))
 
+        # cleanQueue removes stale incoming messages, but not fresh ones.
+        f1, h1 = queue1.openNewMessage()
+        f1.close()
+        f2, h2 = queue1.openNewMessage()
+        t = time.time() - mixminion.Filestore.INPUT_TIMEOUT - 10
+        os.utime(os.path.join(self.d2, "inp_"+h1), (t, t))
+        queue1.cleanQueue(self.unlink)
+        self.assert_(not os.path.exists(os.path.join(self.d2, "inp_"+h1)))
+        self.assert_(not os.path.exists(os.path.join(self.d2, "rmv_"+h1)))
+        self.assert_(os.path.exists(os.path.join(self.d2, "inp_"+h2)))
+        queue1.abortMessage(f2, h2)
+
         # Test object functionality
         obj = [ ("A pair of strings", "in a tuple in a list") ]
         h1 = queue1.queueObject(obj)
@@ -3669,6 +3962,78 @@ class LogTests(TestCase):
         self.assertEquals(readFile(t).count("\n") , 1)
         self.assertEquals(readFile(t1).count("\n"), 3)
 
+    def testLogFastPath(self):
+        # Suppressed severities shouldn't format their arguments at all.
+        class Unprintable:
+            def __str__(self):
+                raise AssertionError("Formatted a suppressed message")
+        log = Log("INFO")
+        buf = cStringIO.StringIO()
+        log.handlers = [ _ConsoleLogHandler(buf) ]
+        log.trace("%s", Unprintable())
+        log.debug("%s", Unprintable())
+        log.log("DEBUG", "%s", Unprintable())
+        self.assertEquals(buf.getvalue(), "")
+        log.info("%s", "Visible")
+        self.assertEndsWith(buf.getvalue(), "[INFO] Visible\n")
+        # Lowering the severity restores the real methods.
+        log.setMinSeverity("TRACE")
+        log.trace("Now %s", "visible")
+        self.assertEndsWith(buf.getvalue(), "[TRACE] Now visible\n")
+        log.setMinSeverity("ERROR")
+        log.warn("%s", Unprintable())
+
+    def testBufferedFileLog(self):
+        t = mix_mktemp("log")
+        log = Log("INFO")
+        log.handlers = []
+        h = _FileLogHandler(t)
+        log.addHandler(h)
+        # Info messages wait in the buffer...
+        h.nextFlush = time.time() + 60
+        log.info("Abc")
+        log.info("Def")
+        self.assertEquals(readFile(t), "")
+        # ...until a flush, or a warning.
+        log.flush()
+        self.assertEquals(readFile(t).count("\n"), 2)
+        log.info("Ghi")
+        self.assertEquals(readFile(t).count("\n"), 2)
+        log.warn("Jkl")
+        self.assertEquals(readFile(t).count("\n"), 4)
+        # Once the flush interval has passed, the next write flushes.
+        log.info("Mno")
+        self.assertEquals(readFile(t).count("\n"), 4)
+        h.nextFlush = 0
+        log.info("Pqr")
+        self.assertEquals(readFile(t).count("\n"), 6)
+        log.info("Stu")
+        log.close()
+        self.assertEquals(readFile(t).count("\n"), 7)
+
+        # The handler used with Python's logging module buffers too.
+        t = mix_mktemp("log")
+        h = mixminion.Common._BufferedRotatingFileHandler(
+            t, flushInterval=60, when='midnight')
+        logger = logging.getLogger("mixminion.test.buffered")
+        logger.propagate = 0
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(h)
+        try:
+            logger.info("First message")
+            logger.info("Second message")
+            logger.info("Third message")
+            self.assertEquals(readFile(t), "")
+            logger.warn("A warning")
+            self.assertEquals(readFile(t).count("\n"), 4)
+            logger.info("Fourth message")
+            self.assertEquals(readFile(t).count("\n"), 4)
+            h.flush()
+            self.assertEquals(readFile(t).count("\n"), 5)
+        finally:
+            logger.removeHandler(h)
+            h.close()
+
     def testLogStream(self):
         stream = mixminion.Common.LogStream("STREAM", "WARN")
         suspendLog()
@@ -4072,6 +4437,116 @@ class MMTPTests(TestCase):
             server.process(0.1)
         t.join()
 
+        # Now, to several servers at once; one of them has a bad keyid.
+        del packetsIn[:]
+        goodRouting = IPV4Info("127.0.0.1", TEST_PORT, keyid)
+        sent = []
+        results = []
+        def sendAll(goodRouting=goodRouting, routing=routing,
+                    packets=packets, sent=sent, results=results):
+            results.extend(mixminion.MMTPClient.sendPacketsToServers(
+                [(goodRouting, packets[:1], sent.append),
+                 (routing, packets, None),
+                 (goodRouting, packets[1:], lambda i, sent=sent:
+                                              sent.append(i+1))],
+                totalTimeout=60))
+        t = threading.Thread(None, sendAll)
+        t.start()
+        while t.isAlive():
+            server.process(0.1)
+        t.join()
+        for _ in xrange(3):
+            server.process(0.1)
+        self.assertEquals(3, len(results))
+        self.assertEquals(None, results[0])
+        self.assert_(isinstance(results[1], MixProtocolError))
+        self.assertEquals(None, results[2])
+        self.assertUnorderedEq(sent, [0,1])
+        self.assertUnorderedEq(packetsIn, packets)
+
+    def testTotalTimeout(self):
+        self.doTest(self._testTotalTimeout)
+
+    def _testTotalTimeout(self):
+        server, listener, packetsIn, keyid = _getMMTPServer()
+        self.listener = listener
+        self.server = server
+
+        # Give the client a clock that reaches the deadline right after it
+        # starts, but that is still behind the connection's most recent
+        # activity: the connection looks busy when we give up on it.
+        class FakeTime:
+            def __init__(self):
+                self.calls = 0
+                self.start = time.time()
+            def time(self):
+                self.calls += 1
+                if self.calls == 1:
+                    return self.start - 100
+                return self.start - 50
+        cons = []
+        def openConnection(*args, **kwargs):
+            con, name = realOpen(*args, **kwargs)
+            cons.append(con)
+            return con, name
+        realOpen = mixminion.MMTPClient._openConnection
+        replaceAttribute(mixminion.MMTPClient, "time", FakeTime())
+        replaceAttribute(mixminion.MMTPClient, "_openConnection",
+                         openConnection)
+        routing = IPV4Info("127.0.0.1", TEST_PORT, keyid)
+        suspendLog()
+        try:
+            results = mixminion.MMTPClient.sendPacketsToServers(
+                [(routing, ["helloxxx"*4096], None)], totalTimeout=1)
+        finally:
+            s = resumeLog()
+            undoReplacedAttributes()
+        self.assert_(stringContains(s, "Giving up on connection"))
+        self.assertEquals(1, len(results))
+        self.assert_(isinstance(results[0], MixProtocolError))
+        self.assertEquals(1, len(cons))
+        self.assertEquals(None, cons[0].sock)
+
+    def testCipherNegotiation(self):
+        # Two current peers should agree on an ephemeral-key suite.
+        s1, s2 = socket.socketpair()
+        try:
+            server = _getTLSContext(1).sock(s1, serverMode=1)
+            client = _getTLSContext(0).sock(s2)
+            self.assertEquals(None, client.get_cipher())
+            t = threading.Thread(None, server.accept)
+            t.start()
+            client.connect()
+            t.join()
+            cipher, version = client.get_cipher()
+            self.assertEquals((cipher, version), server.get_cipher())
+            if _ml.OPENSSL_VERSION_NUMBER >= 0x10001000L:
+                self.assert_(cipher.startswith("ECDHE-"))
+            else:
+                self.assertEquals(cipher, "DHE-RSA-AES128-SHA")
+            self.assertNotEquals(version, "TLSv1.3")
+        finally:
+            s1.close()
+            s2.close()
+
+        # A client that only knows the original MMTP suite still gets it.
+        if not hasattr(ssl, "SSLContext"):
+            return
+        s1, s2 = socket.socketpair()
+        try:
+            server = _getTLSContext(1).sock(s1, serverMode=1)
+            ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            ctx.set_ciphers("DHE-RSA-AES128-SHA")
+            t = threading.Thread(None, server.accept)
+            t.start()
+            client = ctx.wrap_socket(socket.socket(_sock=s2))
+            t.join()
+            self.assertEquals(client.cipher()[0], "DHE-RSA-AES128-SHA")
+            self.assertEquals(server.get_cipher()[0], "DHE-RSA-AES128-SHA")
+        finally:
+            s1.close()
+            s2.close()
+
     def testStallingTransmission(self):
         # XXXX I know this works, but there doesn't seem to be a good
         # XXXX way to test it.  It's hard to open a connection that
@@ -5289,6 +5764,79 @@ class DirectoryServerTests(TestCase):
         eq(4, len(lst.servers))
         eq(2, len(os.listdir(archiveDir)))
 
+    def testDirectoryDiffs(self):
+        eq = self.assertEquals
+        SI = mixminion.ServerInfo
+        examples = getExampleServerDescriptors()
+        identity = getRSAKey(0,2048)
+        now = time.time()
+        d1 = getOldFormatDirectory(
+            [examples["Fred"][1], examples["Lola"][0]], identity, now)
+        d2 = getOldFormatDirectory(
+            [examples["Bob"][3], examples["Fred"][1], examples["Lola"][1]],
+            identity, now+10)
+        sd1 = SI.ServerDirectory(string=d1)
+
+        diff = SI.generateDirectoryDiff(d1, d2)
+        self.assertStartsWith(diff, "[Directory-Diff]\n")
+        eq(1, diff.count("\nUnchanged-Server: "))
+        self.assert_(len(diff) < len(d2))
+        self.assert_(stringContains(diff, examples["Bob"][3]))
+        self.assert_(not stringContains(diff, examples["Fred"][1]))
+        eq(SI.applyDirectoryDiff(d1, diff), SI._cleanForDigest(d2))
+        # Messed-up line endings in the base are fine.
+        eq(SI.applyDirectoryDiff(d1.replace("\n", "\r\n"), diff),
+           SI._cleanForDigest(d2))
+
+        # Known servers aren't parsed again.
+        known = {}
+        for s in sd1.getAllServers():
+            known[s.getDigest()] = s
+        sd2 = SI.ServerDirectory(string=SI.applyDirectoryDiff(d1, diff),
+                                 knownServers=known)
+        eq(len(sd2.getAllServers()), 3)
+        fred = [ s for s in sd2.getAllServers() if s.getNickname() == "Fred" ]
+        self.assert_(fred[0] in sd1.getAllServers())
+
+        # Diffs don't apply to the wrong base.
+        self.assertRaises(ConfigError, SI.applyDirectoryDiff, d2, diff)
+        self.assertRaises(ConfigError, SI.applyDirectoryDiff, d1, "xyzzy")
+        missing = re.sub(r"Unchanged-Server: \S+", "Unchanged-Server: " +
+                         "A"*27 + "=", diff)
+        self.assertRaises(ConfigError, SI.applyDirectoryDiff, d1, missing)
+        # Tampering with the new descriptors breaks the signature.
+        self.assertRaises(ConfigError, SI.ServerDirectory,
+            string=SI.applyDirectoryDiff(d1, diff.replace("Bob", "Rob")))
+
+        # The ServerList writes a diff from each archived directory, and
+        # removes diffs that lead to older directories.
+        baseDir = mix_mktemp()
+        lst = mixminion.directory.ServerList.ServerList(baseDir, {})
+        writeFile(os.path.join(baseDir, "dirArchive", "dir-1"), d1)
+        lst._generateDiffs(d2)
+        eq(lst.getDirectoryDiffFilenames(),
+           [(sd1['Signature']['DirectoryDigest'],
+             os.path.join(baseDir, "diffs", binascii.b2a_hex(
+                              sd1['Signature']['DirectoryDigest'])))])
+        writeFile(os.path.join(baseDir, "dirArchive", "dir-2"), d2)
+        d3 = getOldFormatDirectory(
+            [examples["Bob"][3], examples["Lola"][1]], identity, now+20)
+        lst._generateDiffs(d3)
+        diffs = lst.getDirectoryDiffFilenames()
+        eq(len(diffs), 2)
+        bases = {}
+        for d in d1, d2:
+            bases[SI.ServerDirectory(string=d)['Signature'][
+                'DirectoryDigest']] = d
+        for digest, fname in diffs:
+            eq(SI.applyDirectoryDiff(bases[digest], readFile(fname)),
+               SI._cleanForDigest(d3))
+
+        eq(SI.getDirectoryDiffLocation("http://x/Directory.gz", "\x01"*20),
+           "http://x/Directory.diff/%s.gz" % ("01"*20))
+        eq(SI.getDirectoryDiffLocation("/x/Directory", "\x01"*20),
+           "/x/Directory.diff/%s" % ("01"*20))
+
     def testNewDirectoryFormats(self):
         DF = mixminion.directory.DirFormats
         SI = mixminion.ServerInfo
@@ -5566,6 +6114,155 @@ class EventStatsTests(TestCase):
         ES.log._setNextRotation(now=pm+7200)
         eq(ES.log.getNextRotation(), pm+7200)
 
+class MetricsTests(TestCase):
+    def testMetrics(self):
+        import mixminion.server.Metrics as M
+        eq = self.assertEquals
+        reg = M.MetricsRegistry()
+
+        # Counters and gauges
+        c = reg.counter("a.count")
+        self.failUnless(reg.counter("a.count") is c)
+        c.inc()
+        c.inc(4)
+        eq(c.value, 5)
+        g = reg.gauge("a.gauge")
+        g.set(12)
+        eq(g.get(), 12)
+        depth = [3]
+        g2 = reg.gauge("b.gauge", lambda depth=depth: depth[0])
+        eq(g2.get(), 3)
+        depth[0] = 7
+        eq(g2.get(), 7)
+        self.assertRaises(MixError, reg.histogram, "a.count")
+
+        # Histograms
+        h = reg.histogram("c.hist", [1, 2, 4, 8])
+        eq(h.getPercentile(50), None)
+        for v in [0.5, 1.5, 1.5, 3, 3, 3, 3, 5, 6, 100]:
+            h.observe(v)
+        eq(h.counts, [1, 2, 4, 2, 1])
+        eq(h.n, 10)
+        self.assertFloatEq(h.total, 126.5)
+        # Median falls halfway through the (2,4] bucket.
+        self.assertFloatEq(h.getPercentile(50), 3.0)
+        self.assertFloatEq(h.getPercentile(10), 1.0)
+        eq(h.getPercentile(100), 8)
+
+        # Snapshots
+        fn = mix_mktemp()
+        reg.writeSnapshot(fn, now=1000000000)
+        when, metrics = M.readSnapshot(fn)
+        eq(when, 1000000000)
+        eq(metrics[:3], [("counter", "a.count", 5.0),
+                         ("gauge", "a.gauge", 12.0),
+                         ("gauge", "b.gauge", 7.0)])
+        eq(metrics[3][:2], ("histogram", "c.hist"))
+        eq(metrics[3][2], 10)
+        self.assertFloatEq(metrics[3][3], 126.5)
+        eq(metrics[3][4], [1.0, 2.0, 4.0, 8.0])
+        eq(metrics[3][5], [1, 2, 4, 2, 1])
+        s = M.formatSnapshot(when, metrics)
+        self.failUnless(stringContains(s, "a.count  5\n"))
+        self.failUnless(stringContains(s, "c.hist   n=10 mean=12.65 p50=3 "))
+
+        writeFile(fn, "time 1\nhistogram x 1 1 1.0:1\n")
+        self.assertRaises(MixError, M.readSnapshot, fn)
+        writeFile(fn, "counter x 1\n")
+        self.assertRaises(MixError, M.readSnapshot, fn)
+
+    def testPacketTracer(self):
+        import mixminion.server.Metrics as M
+        eq = self.assertEquals
+        reg = M.MetricsRegistry()
+        tr = M.PacketTracer(reg)
+        # Two packets through 'incoming'; one was queued before we started.
+        tr.enqueued("incoming", "h1", now=100)
+        t = tr.dequeued("incoming", "h1", now=100.5)
+        eq(t, 100.5)
+        tr.serviced("incoming", t, now=100.502)
+        t = tr.dequeued("incoming", "h0", now=101)
+        tr.serviced("incoming", t, now=101.001)
+        wait = reg.histogram("stage.incoming.wait_seconds")
+        service = reg.histogram("stage.incoming.service_seconds")
+        eq(wait.n, 1)
+        self.assertFloatEq(wait.total, 0.5)
+        eq(service.n, 2)
+        self.assertFloatEq(service.total, 0.003)
+        # The mix stage uses coarse buckets.
+        eq(reg.histogram("stage.mix.wait_seconds").bounds, M.MIX_BUCKETS)
+        tr.enqueued("mix", "h1", now=100)
+        tr.dequeued("mix", "h1", now=700)
+        eq(reg.histogram("stage.mix.wait_seconds").counts[:8],
+           [0,0,0,0,0,0,0,1])
+        # Expiry forgets old entries only.
+        tr.enqueued("outgoing", "o1", now=100)
+        tr.enqueued("outgoing", "o2", now=200)
+        tr.expire(150)
+        tr.dequeued("outgoing", "o1", now=300)
+        tr.dequeued("outgoing", "o2", now=300)
+        eq(reg.histogram("stage.outgoing.wait_seconds").n, 1)
+        # Work that began before tracing was turned on is ignored.
+        tr.serviced("outgoing", None)
+        eq(reg.histogram("stage.outgoing.service_seconds").n, 0)
+
+        # The Nil tracer does nothing at all.
+        nil = M.NilPacketTracer()
+        nil.enqueued("incoming", "h1")
+        nil.serviced("incoming", nil.dequeued("incoming", "h1"))
+
+class ProfilerTests(TestCase):
+    def testSamplingProfiler(self):
+        import mixminion.server.Profiler as P
+        if not P.canProfile():
+            return
+        eq = self.assertEquals
+        fn = mix_mktemp()
+
+        # Sample a thread that we know is sitting in 'spin'.
+        started = threading.Event()
+        done = threading.Event()
+        def spin(started=started, done=done):
+            started.set()
+            while not done.isSet():
+                time.sleep(0.001)
+        t = threading.Thread(target=spin)
+        t.start()
+        started.wait()
+        try:
+            p = P.SamplingProfiler(fn, 60)
+            p.sample()
+            p.sample()
+        finally:
+            done.set()
+            t.join()
+        eq(p.nSamples, 2)
+        stacks = p.getCollapsedStacks()
+        nSpin = 0
+        for line in stacks.strip().split("\n"):
+            m = re.match(r"^(\S+) (\d+)$", line)
+            self.failUnless(m)
+            frames = m.group(1).split(";")
+            if "mixminion.test:spin" in frames:
+                # Outermost first, starting with the thread's name.
+                eq(frames[0], "Thread")
+                nSpin += int(m.group(2))
+        eq(nSpin, 2)
+        # The sampling thread doesn't sample itself.
+        self.failIf(stringContains(stacks, "testSamplingProfiler"))
+
+        # Run in the background, and stop early.
+        p = P.SamplingProfiler(fn, 60, interval=0.001)
+        p.start()
+        time.sleep(0.05)
+        p.stop()
+        self.failIf(p.isAlive())
+        self.failUnless(p.nSamples > 0)
+        eq(readFile(fn), p.getCollapsedStacks())
+        self.failUnless(re.search(
+            r"^MainThread;\S*mixminion.test:testSamplingProfiler",
+            readFile(fn), re.M))
+
 #----------------------------------------------------------------------
 # Modules and ModuleManager
 
@@ -5654,6 +6351,8 @@ IP: 1.0.0.1
 
         # Make sure the module enables itself.
         self.failUnless(exampleMod is manager.typeToModule[1234])
+        # Nothing is waiting yet, including in the drop module's queue.
+        self.assertEquals(manager.count(), 0)
 
         # Try sending a few messages to the module.
         t = "ZZZZ"*5
@@ -6748,6 +7447,27 @@ def getDirectory(servers, identity):
     writeFile(tmp, val)
     return tmp
 
+def getOldFormatDirectory(servers, identity, published):
+    """Return a [Directory]-format directory, as generated by
+       ServerList.generateDirectory, containing the server descriptors
+       provided as literal strings in <servers>, signed with the RSA key
+       <identity>."""
+    nicknames = [ mixminion.ServerInfo.ServerInfo(string=s, assumeValid=1
+                                                  ).getNickname()
+                  for s in servers ]
+    header = ("[Directory]\nVersion: 0.2\nPublished: %s\n"
+              "Valid-After: %s\nValid-Until: %s\n"
+              "Recommended-Servers: %s\n[Signature]\n"
+              "DirectoryIdentity: %s\nDirectoryDigest:\n"
+              "DirectorySignature:\n[Recommended-Software]\n"
+              "MixminionClient: %s\nMixminionServer: %s\n" % (
+        formatTime(published), formatDate(published),
+        formatDate(published+60*60*24), ", ".join(nicknames),
+        formatBase64(pk_encode_public_key(identity)),
+        mixminion.__version__, mixminion.__version__))
+    return mixminion.ServerInfo._getDirectoryDigestImpl(
+        header+"".join(servers), identity)
+
 # variable to hold the latest instance of FakeBCC.
 BCC_INSTANCE = None
 
@@ -6937,6 +7657,43 @@ class ClientUtilTests(TestCase):
             self.assert_(s.findUnusedSURBs(surbs)[0] is surbs[2])
             s.markSURBUsed(surbs[2])
             self.assert_(s.findUnusedSURBs(surbs) == [])
+
+            # Bulk filtering keeps the order, and handles duplicates.
+            now = time.time()
+            day = 24*60*60
+            fakes = [ ReplyBlock("X"*HEADER_LEN, now+i*day,
+                                 SWAP_FWD_HOST_TYPE, "Z"*30, chr(i+3)*16)
+                      for i in range(-3, 4) ]
+            s.markSURBUsed(fakes[1])
+            s.markSURBUsed(fakes[5])
+            self.assertEquals(s.filterUnused(surbs[1:]+fakes+fakes[:1]),
+                     fakes[:1]+fakes[2:5]+fakes[6:]+fakes[:1])
+            for f in fakes:
+                s.markSURBUsed(f)
+            self.assertEquals(s.filterUnused(fakes), [])
+
+            # Cleaning only drops buckets that have expired entirely.
+            s.clean(now)
+            self.assertEquals(s.filterUnused(fakes), fakes[:3])
+            s.close()
+            s = SURBLog(fname)
+            self.assertEquals(s.filterUnused(fakes), fakes[:3])
+            self.assertEquals(s.filterUnused(surbs), [])
+            s.clean(now+2*day)
+            self.assertEquals(s.filterUnused(fakes), fakes[:5])
+            self.assert_(s.isSURBUsed(fakes[6]))
+
+            # Logs from older versions get sorted into buckets when they're
+            # first opened.
+            for k in s.log.keys():
+                del s.log[k]
+            s.log[fakes[0].getHexDigest()] = str(int(now-3*day))
+            s.log[fakes[6].getHexDigest()] = str(int(now+3*day))
+            s.close()
+            s = SURBLog(fname)
+            self.assertEquals(s.filterUnused(fakes), fakes[:6])
+            s.clean(now+4*day)
+            self.assertEquals(s.filterUnused(fakes), fakes)
         finally:
             s.close()
 
@@ -6988,8 +7745,28 @@ class ClientUtilTests(TestCase):
         v = cq.getPacket(h1)
         self.assertEquals((ipv4,previousMidnight(now)), v[1:])
         self.assertLongStringEq(v[0], p1)
+
+        # Packets are stored raw, and listing uses only the index: it
+        # works even once the metadata is gone.
+        self.assertLongStringEq(readFile(os.path.join(d, "msg_"+h1), 1), p1)
+        os.unlink(os.path.join(d, "meta_"+h1))
+        cq = CQ(d)
+        self.assertEquals({ ipv4 : (1, previousMidnight(now)) },
+                          cq.inspectQueue())
         cq.removePacket(h1)
 
+        # Packets queued by older versions were pickled; the index gets
+        # rebuilt from their metadata.
+        when = previousMidnight(now-24*60*60*3)
+        h3 = cq.store.queueMessageAndMetadata(
+            cPickle.dumps(("PACKET-0", p2, host, when), 1),
+            ("V0", host, when))
+        cq = CQ(d)
+        self.assertEquals({ host : (1, when) }, cq.inspectQueue())
+        self.assertEquals((p2, host, when), cq.getPacket(h3))
+        self.assertEquals([h3], CQ(d)._readIndex().keys())
+        cq.removePacket(h3)
+
 class ClientDirectoryTests(TestCase):
     def testClientDirectory(self):
         eq = self.assertEquals
@@ -7491,6 +8268,216 @@ class ClientDirectoryTests(TestCase):
             "  [1970-01-02 to 1970-01-03]", "    A:a1", "    B:b1",
             "  [1970-01-03 to 1970-01-04]", "    A:a2", "    B:b2" ])
 
+    def testDescriptorIndex(self):
+        CD = mixminion.ClientDirectory
+        eq = self.assertEquals
+        d = self.writeDescriptorsToDisk()
+        dirname = mix_mktemp()
+        config = mixminion.Config.ClientConfig(
+            string="[User]\nUserDir: %s\n"%dirname)
+        direc = CD.ClientDirectory(config)
+        self.loadDirectory(direc, d)
+        direc.importFromFile(os.path.join(d, "Joe0"))
+        edesc = getExampleServerDescriptors()
+        idxFile = os.path.join(config.getDirectoryRoot(), "cache.idx")
+        self.assert_(os.path.exists(idxFile))
+        # A new ClientDirectory answers from the index, without loading the
+        # cache or unpickling any descriptors.
+        direc2 = CD.ClientDirectory(config)
+        self.assert_(direc2.store is None)
+        eq(direc2.getAllNicknames(), direc.getAllNicknames())
+        eq(direc2.getRecommendedNicknames(), direc.getRecommendedNicknames())
+        eq(direc2.clientVersions, direc.clientVersions)
+        joe = direc2.getServerInfo("Joe")
+        self.assert_(isinstance(joe, CD.IndexedServerInfo))
+        self.assert_(isinstance(joe, mixminion.ServerInfo.ServerInfo))
+        self.assertSameSD(edesc["Joe"][0], joe)
+        eq(joe.getKeyDigest(), direc.getServerInfo("Joe").getKeyDigest())
+        eq(joe.getCaps(), direc.getServerInfo("Joe").getCaps())
+        eq(joe.getIncomingMMTPProtocols(),
+           direc.getServerInfo("Joe").getIncomingMMTPProtocols())
+        eq(joe.getOutgoingMMTPProtocols(),
+           direc.getServerInfo("Joe").getOutgoingMMTPProtocols())
+        live = direc2.getLiveServers()
+        eq(len(live), len(direc.getLiveServers()))
+        paths = direc2.generatePaths(1, CD.parsePath(config, "*2:Alice,Joe"),
+                                     CD.ExitAddress(SMTP_TYPE, "a@b.c", "Joe"))
+        eq(len(paths[0][0]), 2)
+        for s in direc2.getAllServers():
+            self.assert_(s._info is None)
+        # Anything else loads just that descriptor from the index, without
+        # reading the cache.
+        replaceFunction(CD, "readPickled")
+        try:
+            eq(joe.getHostname(), direc.getServerInfo("Joe").getHostname())
+            self.assert_(joe._info is not None)
+            eq(joe['Server']['Nickname'], "Joe")
+            self.assertSameSD(edesc["Joe"][0], joe.getServerInfo())
+            eq(getReplacedFunctionCallLog(), [])
+        finally:
+            undoReplacedAttributes()
+            clearReplacedFunctionCallLog()
+        for s in direc2.getAllServers():
+            if s is not joe:
+                self.assert_(s._info is None)
+        # No download is needed today, so update() doesn't load the store.
+        direc2.update()
+        self.assert_(direc2.store is None)
+        # Operations that change the store load it first.
+        direc2.rescan()
+        self.assert_(direc2.store is not None)
+        self.assert_(direc2._index is None)
+        self.assertSameSD(edesc["Joe"][0], direc2.getServerInfo("Joe"))
+
+        # Changes to the store are reflected in the index.
+        direc.expungeByNickname("Joe")
+        direc3 = CD.ClientDirectory(config)
+        self.assert_(direc3.store is None)
+        eq(None, direc3.getServerInfo("Joe"))
+        # An index that doesn't match the cache is ignored...
+        cacheFile = os.path.join(config.getDirectoryRoot(), "cache")
+        t = os.path.getmtime(cacheFile)
+        os.utime(cacheFile, (t+10, t+10))
+        self.assert_(CD.loadDescriptorIndex(config) is None)
+        direc3 = CD.ClientDirectory(config)
+        self.assert_(direc3.store is not None)
+        eq(None, direc3.getServerInfo("Joe"))
+        # ...and rewritten when we load the cache.
+        self.assert_(CD.loadDescriptorIndex(config) is not None)
+        # Truncated and corrupt indices are ignored too.
+        for contents in (readFile(idxFile, 1)[:-10], "xyzzy"):
+            writeFile(idxFile, contents, binary=1)
+            suspendLog("INFO")
+            try:
+                direc4 = CD.ClientDirectory(config)
+            finally:
+                s = resumeLog()
+            self.assert_(direc4.store is not None)
+            self.assert_(stringContains(s, "Couldn't read directory index"))
+
+    def testDirectoryDiffDownload(self):
+        CD = mixminion.ClientDirectory
+        SI = mixminion.ServerInfo
+        eq = self.assertEquals
+        edesc = getExampleServerDescriptors()
+        identity = getRSAKey(0,2048)
+        now = time.time()
+        oneDay = 24*60*60
+        dirname = mix_mktemp()
+        config = mixminion.Config.ClientConfig(
+            string="[User]\nUserDir: %s\n"%dirname)
+        direc = CD.ClientDirectory(config)
+        pubDir = mix_mktemp()
+        createPrivateDir(pubDir)
+        dirFile = os.path.join(pubDir, "Directory")
+        url = fileURL(dirFile)
+        replaceAttribute(CD, "MIXMINION_DIRECTORY_URL", url)
+        replaceAttribute(CD, "MIXMINION_DIRECTORY_FINGERPRINT",
+                         Crypto.pk_fingerprint(identity))
+        try:
+            d1 = getOldFormatDirectory(
+                [edesc["Fred"][1], edesc["Lola"][1]], identity, now-60)
+            writeFile(dirFile, d1)
+            direc.update(force=1)
+            fred = direc.getServerInfo("Fred", now-5*oneDay)
+            eq(direc.getServerInfo("Bob"), None)
+            createPrivateDir(os.path.join(pubDir, "Directory.diff"))
+            digest = SI.ServerDirectory(string=d1)['Signature'][
+                'DirectoryDigest']
+
+            # With a diff available, we use it and reuse the old descriptors.
+            d2 = getOldFormatDirectory(
+                [edesc["Bob"][3], edesc["Fred"][1], edesc["Lola"][1]],
+                identity, now)
+            writeFile(dirFile, d2)
+            writeFile(SI.getDirectoryDiffLocation(dirFile, digest),
+                      SI.generateDirectoryDiff(d1, d2))
+            suspendLog("INFO")
+            try:
+                direc.update(force=1)
+            finally:
+                s = resumeLog()
+            self.assert_(stringContains(s, "Downloading directory diff"))
+            self.assert_(not stringContains(s, "Downloading directory from"))
+            self.assert_(direc.getServerInfo("Fred", now-5*oneDay) is fred)
+            self.assertSameSD(edesc["Bob"][3],
+                              direc.getServerInfo("Bob", now+oneDay*3))
+
+            # A bad diff makes us fall back to the full directory.
+            digest = SI.ServerDirectory(string=d2)['Signature'][
+                'DirectoryDigest']
+            d3 = getOldFormatDirectory(
+                [edesc["Fred"][1], edesc["Lola"][1]], identity, now+10)
+            writeFile(dirFile, d3)
+            writeFile(SI.getDirectoryDiffLocation(dirFile, digest),
+                      SI.generateDirectoryDiff(d2, d3).replace("Fred",
+                                                               "Dref"))
+            suspendLog("INFO")
+            try:
+                direc.update(force=1)
+            finally:
+                s = resumeLog()
+            self.assert_(stringContains(s, "Received an invalid directory "
+                                        "diff"))
+            self.assert_(stringContains(s, "Downloading directory from"))
+            eq(direc.getServerInfo("Bob", now+oneDay*3), None)
+        finally:
+            undoReplacedAttributes()
+
+    def testTimeIndex(self):
+        d = self.writeDescriptorsToDisk()
+        dirname = mix_mktemp()
+        config = mixminion.Config.ClientConfig(
+            string="[User]\nUserDir: %s\n"%dirname)
+        direc = mixminion.ClientDirectory.ClientDirectory(config)
+        self.loadDirectory(direc, d)
+        oneDay = 24*60*60
+        now = time.time()
+
+        def nicknames(lst):
+            r = [ s.getNickname() for s in lst ]
+            r.sort()
+            return r
+        def expected(startAt, endAt, blocked=()):
+            u = {}
+            for s in direc.goodServers:
+                n = s.getNickname()
+                if n in blocked or not s.isValidFrom(startAt, endAt):
+                    continue
+                if not u.has_key(n) or s.isNewerThan(u[n]):
+                    u[n] = s
+            return nicknames(u.values())
+
+        # The day index finds the same servers as a full scan.
+        for offset in (-oneDay, 0, oneDay*3, oneDay*6, oneDay*9, oneDay*40):
+            t = now + offset
+            self.assertEquals(nicknames(direc.getLiveServers(t, t+3600)),
+                              expected(t, t+3600))
+            got = direc.getFeatureMap(["caps"], at=t)
+            want = {}
+            for s in direc.getAllServers():
+                if s.isValidAt(t):
+                    want[s.getNickname()] = 1
+            self.assertUnorderedEq(got.keys(), want.keys())
+        self.assertEquals(direc.getLiveServers(now+oneDay*40), [])
+
+        # Reconfiguring invalidates the cached candidate sets.
+        live = nicknames(direc.getLiveServers(now))
+        self.assert_(len(live) >= 4)
+        blocked, noExit = live[0], live[1]
+        config = mixminion.Config.ClientConfig(string=
+                 "[User]\nUserDir: %s\n[Security]\nBlockServers: %s\n"
+                 "BlockExits: %s\n" % (dirname, blocked, noExit))
+        direc.configure(config)
+        self.assertEquals(nicknames(direc.getLiveServers(now)),
+                          expected(now, now+1, (blocked,)))
+        self.assertEquals(nicknames(direc.getLiveServers(now, isExit=1)),
+                          expected(now, now+1, (blocked,noExit)))
+        for i in xrange(10):
+            p = direc.getPath([None, None, None], now)
+            self.assert_(blocked not in nicknames(p))
+            self.assertNotEquals(p[-1].getNickname(), noExit)
+
     def writeDescriptorsToDisk(self):
         edesc = getExampleServerDescriptors()
         d = mix_mktemp()
@@ -7701,18 +8688,109 @@ class ClientMainTests(TestCase):
             undoReplacedAttributes()
             clearCalls()
 
+        ## Test building packets in several processes.
+        if mixminion.ClientMain.canBuildPacketsInParallel():
+            def fakeBuild(p, rt, ri, path1, path2, prng, suppressTag=0):
+                # Hex-encode the random bytes so they can't contain "/".
+                return "%s/%04x/%s/%s/%s/%s" % (
+                    p, rt, ri, path1[0].getNickname(),
+                    binascii.b2a_hex(prng.getBytes(8)),
+                    binascii.b2a_hex(
+                        mixminion.Crypto.getCommonPRNG().getBytes(8)))
+            replaceFunction(mixminion.BuildMessage, "buildForwardPacket",
+                            fakeBuild)
+            try:
+                address = parseAddress("smtp:joe@cledonism.net")
+                paths = directory.generatePaths(
+                    5, pathSpec1, address, time.time(), time.time()+200)
+                client.prng = AESCounterPRNG("Z"*16)
+                r = client._generateForwardPacketsInParallel(
+                    "ABCDE", paths, SMTP_TYPE, "joe@cledonism.net", 0, 2)
+                self.assertEquals(5, len(r))
+                seeds = AESCounterPRNG("Z"*16)
+                commonBytes = {}
+                for i in xrange(5):
+                    pkt, firstHop = r[i]
+                    self.assertEquals(firstHop.getNickname(), "Lola")
+                    fields = pkt.split("/")
+                    self.assertEquals(fields[:4],
+                        ["ABCDE"[i], "0100", "joe@cledonism.net", "Lola"])
+                    # Each packet's PRNG depends only on its seed...
+                    self.assertEquals(len(fields), 6)
+                    self.assertEquals(fields[4], binascii.b2a_hex(
+                        AESCounterPRNG(seeds.getBytes(16)).getBytes(8)))
+                    # ...and workers don't share the parent's common PRNG.
+                    commonBytes[fields[5]] = 1
+                self.assertEquals(len(commonBytes), 5)
+                self.assertEquals(mixminion.ClientMain._PACKET_JOBS, None)
+            finally:
+                undoReplacedAttributes()
+                clearCalls()
+
+        ## Test precomputed headers for pooled addresses.
+        poolClient = mixminion.ClientMain.MixminionClient(usercfg)
+        address = parseAddress("smtp:joe@cledonism.net")
+        pathSpec = parsePath(usercfg, "lola,joe:alice,joe")
+        poolClient.addPooledDestination(directory, address, pathSpec)
+        key = mixminion.ClientMain._getHeaderPoolKey(address, pathSpec)
+        self.assertEquals(poolClient.headerPool.count(key), 0)
+        self.assertEquals(poolClient.refillHeaderPool(), 8)
+        self.assertEquals(poolClient.headerPool.count(key), 8)
+        replaceFunction(mixminion.BuildMessage, "buildForwardPacket",
+                        lambda *a, **k:"X")
+        try:
+            now = time.time()
+            r = poolClient.generateForwardPackets(
+                directory, address, pathSpec, "Hey Joe", 0, now, now+200)
+            # We used a pooled header, not buildForwardPacket.
+            self.assertEquals(getReplacedFunctionCallLog(), [])
+            self.assertEquals(poolClient.headerPool.count(key), 7)
+            self.assertEquals(1, len(r))
+            self.assertEquals(32*1024, len(r[0][0]))
+            self.assertEquals("Lola", r[0][1].getNickname())
+            # Other paths to the same address don't use the pool.
+            poolClient.generateForwardPackets(
+                directory, address,
+                parsePath(usercfg, "alice,lola,joe:alice,joe"),
+                "Hey Joe", 0, now, now+200)
+            self.assertEquals(len(getReplacedFunctionCallLog()), 1)
+            self.assertEquals(poolClient.headerPool.count(key), 7)
+            clearCalls()
+            # If the directory no longer accepts a pooled path, we throw
+            # its headers away and build a fresh packet.
+            realValidate = directory.validatePath
+            def validatePath(spec, *args, **kwargs):
+                if isinstance(spec.path1[0],
+                              mixminion.ClientDirectory.DescriptorPathElement):
+                    raise UIError("Server Alice is gone")
+                return realValidate(spec, *args, **kwargs)
+            replaceAttribute(directory, "validatePath", validatePath)
+            r = poolClient.generateForwardPackets(
+                directory, address, pathSpec, "Hey Joe", 0, now, now+200)
+            self.assertEquals(r[0][0], "X")
+            self.assertEquals(len(getReplacedFunctionCallLog()), 1)
+            self.assertEquals(poolClient.headerPool.count(key), 0)
+        finally:
+            undoReplacedAttributes()
+            clearCalls()
+
         ### Now try some failing cases for generateForwardPackets
 
         # Temporarily replace BlockingClientConnection so we can try the client
         # without hitting the network.
         args = []
-        def fakeSendPackets(routing,packetList,timeout=300,callback=None,
-                            args=args):
-            args.append((routing,packetList,timeout,callback))
-            for i in xrange(len(packetList)):
-                callback(i)
-
-        replaceAttribute(mixminion.MMTPClient, "sendPackets", fakeSendPackets)
+        hooks = []
+        def fakeSendPacketsToServers(batches,timeout=300,totalTimeout=None,
+                                     idleHook=None,args=args,hooks=hooks):
+            hooks.append(idleHook)
+            for routing,packetList,callback in batches:
+                args.append((routing,packetList,timeout,callback))
+                for i in xrange(len(packetList)):
+                    callback(i)
+            return [None]*len(batches)
+
+        replaceAttribute(mixminion.MMTPClient, "sendPacketsToServers",
+                         fakeSendPacketsToServers)
         overrideDNS({'alice' : "10.0.0.100"})
         try:
             client.sendForwardMessage(
@@ -7728,6 +8806,31 @@ class ClientMainTests(TestCase):
             self.assertEquals(r.port, 48099)
             self.assertEquals(1, len(p))
             self.assertEquals(32*1024, len(p[0]))
+            # Without pooled addresses, we have nothing to do while idle...
+            self.assertEquals(hooks, [None])
+            # ...but with them, we refill the pool.
+            poolClient.sendForwardMessage(
+                directory,
+                parseAddress("mbox:granola@Lola"),
+                parsePath(usercfg,"alice,lola,joe,alice:joe,alice"),
+                "You only give me your information.",
+                time.time(), time.time()+300)
+            self.assertEquals(poolClient.headerPool.count(key), 0)
+            while hooks[-1]():
+                pass
+            self.assertEquals(poolClient.headerPool.count(key), 8)
+            # The next message to the pooled address uses one of them.
+            del args[:]
+            poolClient.sendForwardMessage(
+                directory, parseAddress("smtp:joe@cledonism.net"),
+                parsePath(usercfg, "lola,joe:alice,joe"),
+                "Hey Joe", time.time(), time.time()+300)
+            self.assertEquals(poolClient.headerPool.count(key), 7)
+            r,p,t,c = args[0]
+            self.assertEquals(r, directory.getServerInfo("Lola")
+                                          .getRoutingInfo())
+            self.assertEquals(1, len(p))
+            self.assertEquals(32*1024, len(p[0]))
 
         finally:
             undoReplacedAttributes()
@@ -7846,9 +8949,23 @@ class FragmentTests(TestCase):
         # enough for half of chunk2: 8 messages
         for p in pkts2[22:30]: pool.addFragment(p)
         pool.unchunkMessages()
+        self.assertEquals(pool.expiryList,
+                          [(previousMidnight(time.time()), pkts2[0].msgID)])
         # close and re-open messages
         pool.close()
-        pool = mixminion.Fragments.FragmentPool(loc)
+        self.assert_(os.path.exists(loc+"_idx"))
+        # Reopening shouldn't need to read any metadata files: it's all in
+        # the index.
+        try:
+            replaceFunction(mixminion.Filestore.BaseMetadataStore,
+                            "getMetadata")
+            pool = mixminion.Fragments.FragmentPool(loc)
+            self.assertEquals([], getReplacedFunctionCallLog())
+        finally:
+            undoReplacedAttributes()
+            clearReplacedFunctionCallLog()
+        self.assertEquals(pool.store.count(), len(pool.metadata))
+        self.assertEquals(pool.messagesWithReadyChunks, {})
         # Enough for the rest of message 4...  8 from 2, 17 from 3.
         for p in pkts2[36:44]+pkts2[49:66]:
             pool.addFragment(p)
@@ -7856,6 +8973,20 @@ class FragmentTests(TestCase):
         self.assertEquals(len(pool.listReadyMessages()), 1)
         mid = pool.listReadyMessages()[0]
         self.assertLongStringEq(M2, uncompressData(pool.getReadyMessage(mid)))
+        # Read it again, piecewise, from the scratch file.
+        pool.cleanQueue()
+        nFiles = len(os.listdir(loc))
+        f = pool.openReadyMessage(mid)
+        m = f.read(1000)
+        m += f.read()
+        f.close()
+        self.assertLongStringEq(M2, uncompressData(m))
+        f = pool.openReadyMessage(mid)
+        self.assertEquals(f.length, len(m))
+        self.assertLongStringEq(M2, mixminion.Packet.uncompressFile(f))
+        f.close()
+        pool.cleanQueue()
+        self.assertEquals(nFiles, len(os.listdir(loc)))
         pool.markMessageCompleted(mid)
         pool.close()
         pool = mixminion.Fragments.FragmentPool(loc)
@@ -7914,6 +9045,23 @@ class FragmentTests(TestCase):
         # Force pkts2 to rejected by expiring it.
         pool.expireMessages(time.time()+48*60*60)
         self.assertEquals(pool.listReadyMessages(), [])
+        self.assertEquals(pool.expiryList, [])
+        self.assertEquals(pool.handlesByMsgID, {})
+
+        # If the index is out of date, we read metadata for the fragments
+        # it's missing.
+        pkts4 = [ pp(x) for x in em(M1,0) ]
+        for i in xrange(3):
+            pool.addFragment(pkts4[i])
+        pool.sync()
+        for i in xrange(3,6):
+            pool.addFragment(pkts4[i])
+        pool2 = mixminion.Fragments.FragmentPool(loc)
+        self.assertEquals(pool2.store.count(), 6)
+        self.assertEquals(len(pool2.metadata), 6)
+        self.assertEquals(pool2.getStateByMsgID(disp64(pkts4[0].msgID,12))
+                          .getCompleteness(), (6, 8))
+        pool2.close()
         pool.close()
 
 #----------------------------------------------------------------------
@@ -7964,10 +9112,87 @@ wanted to play with the new experimental built-in pinger code.]"""
         suspendLog()
         try:
             log.gotPing("BL"*10, now=t+160) #Never sent.
+            # We don't find out until the events are written.
+            log.flush()
         finally:
             s = resumeLog()
         self.assertEndsWith(s, "Received ping with no record of its hash\n")
+        # Events are written in batches.
+        self.assertEquals(log._nPendingEvents, 0)
         log.gotPing("''"*10, now=t+161.1)
+        self.assertEquals(log._nPendingEvents, 1)
+        cur = log._db.getCursor()
+        cur.execute("SELECT received FROM ping WHERE hash = ?",
+                    (formatBase64("''"*10),))
+        self.assertEquals(cur.fetchall(), [(0,)])
+        log.flush()
+        self.assertEquals(log._nPendingEvents, 0)
+        cur.execute("SELECT received FROM ping WHERE hash = ?",
+                    (formatBase64("''"*10),))
+        self.assertEquals(cur.fetchall(), [(long(t+161),)])
+        stats = log.getFlushStats()
+        self.assertEquals(stats['flushes'], 3)
+        self.assertEquals(stats['events'], 21)
+        self.assertEquals(stats['dropped'], 0)
+        # A database error loses the batch, but doesn't reach the caller.
+        log._queueEvent("INSERT INTO noSuchTable (x) VALUES (?)", (1,))
+        log.connected(id3,now=t+162)
+        suspendLog()
+        try:
+            log.flush()
+        finally:
+            s = resumeLog()
+        self.assert_(stringContains(s, "Error writing 2 ping events"))
+        self.assertEquals(log._nPendingEvents, 0)
+        stats = log.getFlushStats()
+        self.assertEquals(stats['flushes'], 3)
+        self.assertEquals(stats['dropped'], 2)
+        cur.execute("SELECT COUNT(*) FROM connectionAttempt WHERE at = ?",
+                    (long(t+162),))
+        self.assertEquals(cur.fetchall(), [(0,)])
+        # The next batch goes through as usual.
+        log.connected(id3,now=t+163)
+        log.flush()
+        cur.execute("SELECT COUNT(*) FROM connectionAttempt WHERE at = ?",
+                    (long(t+163),))
+        self.assertEquals(cur.fetchall(), [(1,)])
+        # If the database is busy when we commit, we roll back and keep
+        # the events for next time.
+        class BusyCursor:
+            def __init__(self, cur, failures):
+                self.cur = cur
+                self.failures = failures
+            def execute(self, stmt, *args):
+                if stmt == "COMMIT" and self.failures:
+                    self.failures.pop()
+                    raise P.sqlite3.OperationalError("database is locked")
+                return self.cur.execute(stmt, *args)
+            def __getattr__(self, attr):
+                return getattr(self.cur, attr)
+        failures = [1]
+        realGetCursor = log._db.getCursor
+        replaceAttribute(log._db, "getCursor",
+                 lambda failures=failures, realGetCursor=realGetCursor:
+                         BusyCursor(realGetCursor(), failures))
+        try:
+            log.connected(id3,now=t+164)
+            suspendLog("INFO")
+            try:
+                log.flush()
+            finally:
+                s = resumeLog()
+            self.assert_(stringContains(s, "Database busy"))
+            self.assertEquals(failures, [])
+            self.assertEquals(log._nPendingEvents, 1)
+            self.assertEquals(log.getFlushStats()['dropped'], 2)
+            log.connected(id3,now=t+165)
+            log.flush()
+        finally:
+            undoReplacedAttributes()
+        self.assertEquals(log._nPendingEvents, 0)
+        cur.execute("SELECT at FROM connectionAttempt WHERE at > ?",
+                    (long(t+163),))
+        self.assertEquals(cur.fetchall(), [(long(t+164),), (long(t+165),)])
         log.rotate(t-15*24*60*60,t-15*24*60*60)
         log.heartbeat(t+200)
         log.calculateUptimes(t,t+200,now=t+200)
@@ -7986,6 +9211,37 @@ wanted to play with the new experimental built-in pinger code.]"""
         # id2 was only down once in the interval; we refuse to extrapolate.
         self.assert_(not ups[interval].has_key(id2))
 
+        # Recalculating only looks at the new data, but still gets the
+        # whole interval right.
+        cur = log._db.getCursor()
+        def oneHop(identity, log=log, cur=cur):
+            cur.execute("SELECT nSent, nReceived FROM echolotOneHopResult, "
+                        "statsInterval WHERE server = ? AND interval = "
+                        "statsInterval.id AND startAt = ?",
+                        (log._getServerID(identity), previousMidnight(t)))
+            return tuple(cur.fetchone())
+        log.calculateOneHopResult(now=t+200)
+        self.assertEquals(oneHop(id0), (2,1))
+        log.connectFailed(id2,now=t+100)
+        log.gotPing("<>"*10, now=t+170)
+        log.calculateUptimes(t,t+200,now=t+200)
+        ups = log.getUptimes(t,t+200)
+        self.assertFloatEq(ups[interval][id0], 1.0)
+        self.assertFloatEq(ups[interval][id1], 40/50.)
+        # id2 was up at 31 and down at 100.
+        self.assertFloatEq(ups[interval][id2], 0.5)
+        log.calculateOneHopResult(now=t+200)
+        self.assertEquals(oneHop(id0), (2,2))
+        self.assertEquals(oneHop(id1), (1,1))
+        # An attempt logged with the same timestamp as the high-water mark
+        # still makes us recompute its interval.
+        cur.execute("UPDATE uptime SET uptime = 0.25 WHERE server = ?",
+                    (log._getServerID(id2),))
+        log.connected(id2, now=t+100)
+        log.calculateUptimes(t,t+200,now=t+200)
+        ups = log.getUptimes(t,t+200)
+        self.assertFloatEq(ups[interval][id2], 0.5)
+
         log.calculateChainStatus(now=t+200)
         log.calculateAll(now=t+200)
         log.shutdown()
@@ -8003,6 +9259,24 @@ wanted to play with the new experimental built-in pinger code.]"""
         env = {}
         execfile(statusFile,env)
 
+        # Now try computing the same results in the background.
+        calc = P.PingStatsCalculator(log)
+        calc.start()
+        statusFile2 = os.path.join(d, "status2")
+        self.assert_(not calc.publish(statusFile2))
+        calc.scheduleCalculation(now=t+200)
+        # Wait for the calculation to finish.
+        for _ in xrange(100):
+            if not calc._inProgress: break
+            time.sleep(.1)
+        self.assert_(not calc._inProgress)
+        calc.shutdown()
+        calc.join()
+        self.assert_(not calc.isAlive())
+        self.assert_(calc.publish(statusFile2))
+        self.assert_(not calc.publish(statusFile2))
+        self.assertEquals(readFile(statusFile), readFile(statusFile2))
+
         log.rotate(t+15*24*60*60,t+30*24*60*60)
         log.close()
 
@@ -8058,6 +9332,8 @@ def testSuite():
                    FragmentTests,
                    QueueTests,
                    EventStatsTests,
+                   MetricsTests,
+                   ProfilerTests,
                    NetUtilTests,
                    DNSFarmTests,
                    ClientUtilTests,
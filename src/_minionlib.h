@@ -18,16 +18,46 @@ the README file for further instructions."
 #include <rsa.h>
 #endif
 
+/* Python before 2.5 used int for buffer lengths. */
+#if PY_VERSION_HEX < 0x02050000 && !defined(PY_SSIZE_T_MIN)
+typedef int Py_ssize_t;
+#endif
+
 #ifdef _MSC_VER
 #define INLINE __inline
 #else
 #define INLINE inline
 #endif
 
+/* OpenSSL 1.0.1 and later provide a counter mode through EVP that can use
+ * AES-NI and friends; we use it unless told not to. */
+#if (OPENSSL_VERSION_NUMBER >= 0x10001000L) && !defined(MM_NO_EVP_CTR)
+#define MM_USE_EVP_CTR
+#ifndef TRUNCATED_OPENSSL_INCLUDES
+#include <openssl/evp.h>
+#else
+#include <evp.h>
+#endif
+#endif
+
+/* An AES key as returned by aes_key().  We keep the expanded key for
+ * single-block operations, and (when using EVP) a keyed cipher context
+ * that is copied for each counter-mode operation.  The template context is
+ * never modified after creation, so several threads may share one key.
+ */
+typedef struct mm_AES_KEY {
+        AES_KEY key;
+#ifdef MM_USE_EVP_CTR
+        EVP_CIPHER_CTX *ctx;
+#endif
+} mm_AES_KEY;
+
 /* We provide our own implementation of counter mode; see aes_ctr.c
  */
-void mm_aes_counter128(const char *in, char *out, unsigned int len,
-                       AES_KEY *key, unsigned long count);
+int mm_aes_key_init(mm_AES_KEY *key, const unsigned char *k);
+void mm_aes_key_clear(mm_AES_KEY *key);
+int mm_aes_counter128(const char *in, char *out, unsigned int len,
+                      mm_AES_KEY *key, unsigned long count);
 
 /* Propagate an error from OpenSSL.  If 'crypto', it's a cryptography
  * error.  Else, it's a TLS error.
@@ -65,6 +95,10 @@ FUNC_DOC(mm_sha1);
 FUNC_DOC(mm_aes_key);
 FUNC_DOC(mm_aes_ctr128_crypt);
 FUNC_DOC(mm_aes128_block_crypt);
+FUNC_DOC(mm_lioness_encrypt);
+FUNC_DOC(mm_lioness_decrypt);
+FUNC_DOC(mm_bear_encrypt);
+FUNC_DOC(mm_bear_decrypt);
 FUNC_DOC(mm_strxor);
 FUNC_DOC(mm_openssl_seed);
 #ifdef MS_WINDOWS
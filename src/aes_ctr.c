@@ -11,6 +11,16 @@
  *
  * Disclosure: I have seen and played with the OpenSSL implementation for
  *   a while before I decided to abandon it.
+ *
+ * OpenSSL 1.0.1 added EVP_aes_128_ctr, which fixes (a) and (c), and which
+ * is far faster than we can hope to be: it uses AES-NI where present and
+ * encrypts several blocks at a time.  When it's available, we use it, and
+ * handle (b) by starting at the right block and discarding the first
+ * (count & 0xf) bytes of keystream.  (Short inputs still take the old path,
+ * since setting up an EVP context costs more than a block or two of AES.)
+ * The keystream is the same either way:
+ * E(0^96 || count>>4), E(0^96 || count>>4 + 1), ..., with the counter
+ * treated as one 128-bit big-endian integer.
  */
 
 #include "_minionlib.h"
@@ -75,9 +85,50 @@ mm_incr(u32 const* ctr32)
         INCR_U32(ctr32,  i);
 }
 
+int
+mm_aes_key_init(mm_AES_KEY *key, const unsigned char *k)
+{
+        if (AES_set_encrypt_key(k, 128, &key->key))
+                return -1;
+#ifdef MM_USE_EVP_CTR
+        if (!(key->ctx = EVP_CIPHER_CTX_new()))
+                return -1;
+        if (!EVP_EncryptInit_ex(key->ctx, EVP_aes_128_ctr(), NULL, k, NULL)) {
+                EVP_CIPHER_CTX_free(key->ctx);
+                key->ctx = NULL;
+                return -1;
+        }
+#endif
+        return 0;
+}
+
 void
-mm_aes_counter128(const char *in, char *out, unsigned int len, AES_KEY *key,
-                  unsigned long count)
+mm_aes_key_clear(mm_AES_KEY *key)
+{
+#ifdef MM_USE_EVP_CTR
+        if (key->ctx)
+                EVP_CIPHER_CTX_free(key->ctx);
+#endif
+        memset(key, 0, sizeof(mm_AES_KEY));
+}
+
+/* XOR a whole block of keystream into the output a word at a time.  We go
+   through memcpy so that unaligned buffers are safe; compilers turn this
+   into plain loads and stores. */
+static INLINE void
+mm_xor_block(char *out, const char *in, const unsigned char *ks)
+{
+        u32 a[4], b[4];
+        memcpy(a, in, 16);
+        memcpy(b, ks, 16);
+        a[0] ^= b[0]; a[1] ^= b[1]; a[2] ^= b[2]; a[3] ^= b[3];
+        memcpy(out, a, 16);
+}
+
+/* Software counter mode: one call to AES_encrypt per block. */
+static void
+mm_aes_counter128_sw(const char *in, char *out, unsigned int len,
+                     mm_AES_KEY *key, unsigned long count)
 {
         unsigned char counter[16];
         unsigned char tmp[16];
@@ -91,16 +142,89 @@ mm_aes_counter128(const char *in, char *out, unsigned int len, AES_KEY *key,
         count &= 0x0f;
 
         while (1) {
-                AES_encrypt(counter, tmp, key);
-                do {
-                        *(out++) = *(in++) ^ tmp[count];
-                        if (--len == 0) return;
-                } while (++count != 16);
+                AES_encrypt(counter, tmp, &key->key);
+                if (count == 0 && len >= 16) {
+                        mm_xor_block(out, in, tmp);
+                        in += 16; out += 16;
+                        if ((len -= 16) == 0) return;
+                } else {
+                        do {
+                                *(out++) = *(in++) ^ tmp[count];
+                                if (--len == 0) return;
+                        } while (++count != 16);
+                        count = 0;
+                }
                 mm_incr(CTR32);
-                count = 0;
         }
 }
 
+#ifdef MM_USE_EVP_CTR
+
+/* Below this many bytes, setting up an EVP context costs more than it
+   saves, and we use the software path instead. */
+#define MIN_EVP_LEN 48
+
+/* Largest chunk we hand to EVP_EncryptUpdate at once; it takes an int. */
+#define MAX_EVP_CHUNK (1<<30)
+
+int
+mm_aes_counter128(const char *in, char *out, unsigned int len,
+                  mm_AES_KEY *key, unsigned long count)
+{
+        unsigned char counter[16];
+        unsigned char tmp[16];
+        EVP_CIPHER_CTX *ctx;
+        int n, outl, r = -1;
+
+        if (len < MIN_EVP_LEN) {
+                mm_aes_counter128_sw(in, out, len, key, count);
+                return 0;
+        }
+        memset(counter, 0, 12);
+        SET_U32(counter+12, count >> 4);
+        count &= 0x0f;
+
+        /* Copying the keyed context is cheaper than re-expanding the key,
+           and leaves the shared template untouched. */
+        if (!(ctx = EVP_CIPHER_CTX_new()))
+                return -1;
+        if (!EVP_CIPHER_CTX_copy(ctx, key->ctx))
+                goto done;
+        if (!EVP_EncryptInit_ex(ctx, NULL, NULL, NULL, counter))
+                goto done;
+        if (count) {
+                memset(tmp, 0, sizeof(tmp));
+                if (!EVP_EncryptUpdate(ctx, tmp, &outl, tmp, (int)count))
+                        goto done;
+        }
+        while (len) {
+                n = (len > MAX_EVP_CHUNK) ? MAX_EVP_CHUNK : (int)len;
+                if (!EVP_EncryptUpdate(ctx, (unsigned char*)out, &outl,
+                                       (const unsigned char*)in, n))
+                        goto done;
+                in += n;
+                out += n;
+                len -= n;
+        }
+        r = 0;
+ done:
+        EVP_CIPHER_CTX_free(ctx);
+        memset(tmp, 0, sizeof(tmp));
+        return r;
+}
+
+#else
+
+int
+mm_aes_counter128(const char *in, char *out, unsigned int len,
+                  mm_AES_KEY *key, unsigned long count)
+{
+        mm_aes_counter128_sw(in, out, len, key, count);
+        return 0;
+}
+
+#endif
+
 /*
   Local Variables:
   mode:c
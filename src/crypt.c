@@ -108,7 +108,7 @@ static void
 aes_destruct(void *obj, void *desc)
 {
         assert(desc==aes_descriptor);
-        memset(obj, 0, sizeof(AES_KEY));
+        mm_aes_key_clear((mm_AES_KEY*) obj);
         free(obj);
 }
 
@@ -117,7 +117,7 @@ static int
 aes_arg_convert(PyObject *obj, void *adr)
 {
         if (PyCObject_Check(obj) && PyCObject_GetDesc(obj) == aes_descriptor) {
-                *((AES_KEY**) adr) = (AES_KEY*) PyCObject_AsVoidPtr(obj);
+                *((mm_AES_KEY**) adr) = (mm_AES_KEY*) PyCObject_AsVoidPtr(obj);
                 return 1;
         } else {
                 TYPE_ERR("Expected an AES key as an argument.");
@@ -141,7 +141,7 @@ mm_aes_key(PyObject *self, PyObject *args, PyObject *kwdict)
         char *key;
         int keylen;
         int r;
-        AES_KEY *aes_key = NULL;
+        mm_AES_KEY *aes_key = NULL;
         PyObject *result;
 
         if (!PyArg_ParseTupleAndKeywords(args, kwdict, "s#:aes_key", kwlist,
@@ -152,11 +152,11 @@ mm_aes_key(PyObject *self, PyObject *args, PyObject *kwdict)
                 return NULL;
         }
 
-        if (!(aes_key = malloc(sizeof(AES_KEY)))) {
+        if (!(aes_key = calloc(1, sizeof(mm_AES_KEY)))) {
                 PyErr_NoMemory(); goto err;
         }
         Py_BEGIN_ALLOW_THREADS
-        r = AES_set_encrypt_key((unsigned char*)key, keylen*8, aes_key);
+        r = mm_aes_key_init(aes_key, (unsigned char*)key);
         Py_END_ALLOW_THREADS
         if (r) {
                 mm_SSL_ERR(1);
@@ -169,7 +169,7 @@ mm_aes_key(PyObject *self, PyObject *args, PyObject *kwdict)
 
  err:
         if (aes_key) {
-                memset(aes_key, 0, sizeof(AES_KEY));
+                mm_aes_key_clear(aes_key);
                 free(aes_key);
         }
         return NULL;
@@ -192,9 +192,9 @@ mm_aes_ctr128_crypt(PyObject *self, PyObject *args, PyObject *kwdict)
 {
         static char *kwlist[] = { "key", "string", "idx", "prng", NULL };
         char *input;
-        int inputlen, prng=0;
+        int inputlen, prng=0, r;
         long idx=0;
-        AES_KEY *aes_key = NULL;
+        mm_AES_KEY *aes_key = NULL;
 
         PyObject *output;
 
@@ -221,11 +221,16 @@ mm_aes_ctr128_crypt(PyObject *self, PyObject *args, PyObject *kwdict)
         }
 
         Py_BEGIN_ALLOW_THREADS
-        mm_aes_counter128(input, PyString_AS_STRING(output), inputlen,
-                          aes_key, idx);
+        r = mm_aes_counter128(input, PyString_AS_STRING(output), inputlen,
+                              aes_key, idx);
         Py_END_ALLOW_THREADS
 
         if (prng) free(input);
+        if (r) {
+                Py_DECREF(output);
+                mm_SSL_ERR(1);
+                return NULL;
+        }
         return output;
 }
 
@@ -241,7 +246,7 @@ mm_aes128_block_crypt(PyObject *self, PyObject *args, PyObject *kwdict)
         long inputlen;
         int encrypt=0;
         PyObject *result;
-        AES_KEY *aes_key = NULL;
+        mm_AES_KEY *aes_key = NULL;
 
         if (!PyArg_ParseTupleAndKeywords(args, kwdict,
                                          "O&s#|i:aes128_block_crypt", kwlist,
@@ -260,14 +265,225 @@ mm_aes128_block_crypt(PyObject *self, PyObject *args, PyObject *kwdict)
                 return NULL;
         }
         if (encrypt) {
-                AES_encrypt(input, PyString_AS_USTRING(result), aes_key);
+                AES_encrypt(input, PyString_AS_USTRING(result), &aes_key->key);
+        } else {
+                AES_decrypt(input, PyString_AS_USTRING(result), &aes_key->key);
+        }
+
+        return result;
+}
+
+/* ==================== LIONESS and BEAR ==================== */
+
+/* Helper: set 'out' to SHA1(key || data || key), where key is
+ * SHA_DIGEST_LENGTH bytes long. */
+static void
+keyed_sha1(unsigned char *out, const unsigned char *key,
+           const unsigned char *data, size_t len)
+{
+        SHA_CTX ctx;
+        SHA1_Init(&ctx);
+        SHA1_Update(&ctx, key, SHA_DIGEST_LENGTH);
+        SHA1_Update(&ctx, data, len);
+        SHA1_Update(&ctx, key, SHA_DIGEST_LENGTH);
+        SHA1_Final(out, &ctx);
+        memset(&ctx, 0, sizeof(ctx));
+}
+
+/* Helper: XOR a digest into the left side of a LIONESS/BEAR block. */
+static INLINE void
+xor_digest(unsigned char *left, const unsigned char *digest)
+{
+        int i;
+        for (i = 0; i < SHA_DIGEST_LENGTH; ++i)
+                left[i] ^= digest[i];
+}
+
+/* Helper: encrypt 'len' bytes at 'data' in place, in counter mode, using
+ * the first 16 bytes of 'digest' as the AES key.  Return 0 on success,
+ * -1 on failure. */
+static int
+ctr_crypt_inplace(unsigned char *data, size_t len,
+                  const unsigned char *digest)
+{
+        mm_AES_KEY key;
+        int r;
+        memset(&key, 0, sizeof(key));
+        if (mm_aes_key_init(&key, digest)) {
+                mm_aes_key_clear(&key);
+                return -1;
+        }
+        r = mm_aes_counter128((const char*)data, (char*)data, len, &key, 0);
+        mm_aes_key_clear(&key);
+        return r;
+}
+
+/* LIONESS round helpers.  A 'hash' round sets left ^= H(k|right|k); a 'ctr'
+ * round sets right ^= PRNG(H(k|left|k)[:16]). */
+#define HASH_ROUND(k) do {                                      \
+        keyed_sha1(d, (k), right, rlen);                        \
+        xor_digest(left, d);                                    \
+        } while (0)
+#define CTR_ROUND(k) do {                                       \
+        keyed_sha1(d, (k), left, SHA_DIGEST_LENGTH);            \
+        if (ctr_crypt_inplace(right, rlen, d)) goto err;        \
+        } while (0)
+
+/* Encrypt or decrypt the 'len'-byte block at 'buf' in place, using LIONESS
+ * (if nKeys is 4) or BEAR (if nKeys is 2).  Return 0 on success, -1 on
+ * failure.  Requires len > SHA_DIGEST_LENGTH. */
+static int
+mm_lioness_or_bear(unsigned char *buf, size_t len,
+                   unsigned char keys[][SHA_DIGEST_LENGTH], int nKeys,
+                   int encrypt)
+{
+        unsigned char *left = buf, *right = buf + SHA_DIGEST_LENGTH;
+        size_t rlen = len - SHA_DIGEST_LENGTH;
+        unsigned char d[SHA_DIGEST_LENGTH];
+        int r = -1;
+
+        if (nKeys == 4) {
+                if (encrypt) {
+                        CTR_ROUND(keys[0]);
+                        HASH_ROUND(keys[1]);
+                        CTR_ROUND(keys[2]);
+                        HASH_ROUND(keys[3]);
+                } else {
+                        HASH_ROUND(keys[3]);
+                        CTR_ROUND(keys[2]);
+                        HASH_ROUND(keys[1]);
+                        CTR_ROUND(keys[0]);
+                }
+        } else {
+                HASH_ROUND(keys[encrypt ? 0 : 1]);
+                SHA1(left, SHA_DIGEST_LENGTH, d);
+                if (ctr_crypt_inplace(right, rlen, d)) goto err;
+                HASH_ROUND(keys[encrypt ? 1 : 0]);
+        }
+        r = 0;
+ err:
+        memset(d, 0, sizeof(d));
+        return r;
+}
+#undef HASH_ROUND
+#undef CTR_ROUND
+
+/* Helper: implements lioness_encrypt, lioness_decrypt, bear_encrypt, and
+ * bear_decrypt. */
+static PyObject *
+lioness_or_bear_fn(PyObject *args, PyObject *kwdict, const char *fmt,
+                   int nKeys, int encrypt)
+{
+        static char *kwlist[] = { "buffer", "keys", NULL };
+        PyObject *buffer, *keyseq, *key, *result;
+        unsigned char keys[4][SHA_DIGEST_LENGTH];
+        void *data;
+        Py_ssize_t len;
+        int i, r;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict, fmt, kwlist,
+                                         &buffer, &keyseq))
+                return NULL;
+
+        if (!PySequence_Check(keyseq) || PySequence_Size(keyseq) != nKeys) {
+                PyErr_Format(PyExc_TypeError, "Expected a sequence of %d keys",
+                             nKeys);
+                return NULL;
+        }
+        for (i = 0; i < nKeys; ++i) {
+                if (!(key = PySequence_GetItem(keyseq, i)))
+                        return NULL;
+                if (!PyString_Check(key) ||
+                    PyString_GET_SIZE(key) != SHA_DIGEST_LENGTH) {
+                        Py_DECREF(key);
+                        TYPE_ERR("Keys must be 20-byte strings");
+                        return NULL;
+                }
+                memcpy(keys[i], PyString_AS_STRING(key), SHA_DIGEST_LENGTH);
+                Py_DECREF(key);
+        }
+
+        /* Strings are immutable; we return an encrypted copy.  Anything
+           else must be a writable buffer, which we encrypt in place. */
+        if (PyString_Check(buffer)) {
+                if (!(result = PyString_FromStringAndSize(
+                              PyString_AS_STRING(buffer),
+                              PyString_GET_SIZE(buffer))))
+                        return NULL;
+                data = PyString_AS_STRING(result);
+                len = PyString_GET_SIZE(result);
         } else {
-                AES_decrypt(input, PyString_AS_USTRING(result), aes_key);
+                if (PyObject_AsWriteBuffer(buffer, &data, &len) < 0)
+                        return NULL;
+                result = Py_None;
+                Py_INCREF(result);
+        }
+        if (len <= SHA_DIGEST_LENGTH) {
+                Py_DECREF(result);
+                TYPE_ERR("Buffer must be longer than 20 bytes");
+                return NULL;
         }
 
+        Py_BEGIN_ALLOW_THREADS
+        r = mm_lioness_or_bear((unsigned char*)data, len, keys, nKeys,
+                               encrypt);
+        memset(keys, 0, sizeof(keys));
+        Py_END_ALLOW_THREADS
+
+        if (r) {
+                Py_DECREF(result);
+                mm_SSL_ERR(1);
+                return NULL;
+        }
         return result;
 }
 
+const char mm_lioness_encrypt__doc__[] =
+  "lioness_encrypt(buffer, (key1,key2,key3,key4)) -> str or None\n\n"
+  "Encrypts a block with the LIONESS super-pseudorandom permutation, given\n"
+  "four 20-byte keys.  If buffer is a string, returns an encrypted copy.\n"
+  "Otherwise, buffer must be a writable buffer (such as an array or an\n"
+  "mmap); it is encrypted in place, and None is returned.\n";
+
+PyObject*
+mm_lioness_encrypt(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        return lioness_or_bear_fn(args, kwdict, "OO:lioness_encrypt", 4, 1);
+}
+
+const char mm_lioness_decrypt__doc__[] =
+  "lioness_decrypt(buffer, (key1,key2,key3,key4)) -> str or None\n\n"
+  "Decrypts a block encrypted with lioness_encrypt.  Handles buffers as\n"
+  "lioness_encrypt does.\n";
+
+PyObject*
+mm_lioness_decrypt(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        return lioness_or_bear_fn(args, kwdict, "OO:lioness_decrypt", 4, 0);
+}
+
+const char mm_bear_encrypt__doc__[] =
+  "bear_encrypt(buffer, (key1,key2)) -> str or None\n\n"
+  "Encrypts a block with the BEAR pseudorandom permutation, given two\n"
+  "20-byte keys.  Handles buffers as lioness_encrypt does.\n";
+
+PyObject*
+mm_bear_encrypt(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        return lioness_or_bear_fn(args, kwdict, "OO:bear_encrypt", 2, 1);
+}
+
+const char mm_bear_decrypt__doc__[] =
+  "bear_decrypt(buffer, (key1,key2)) -> str or None\n\n"
+  "Decrypts a block encrypted with bear_encrypt.  Handles buffers as\n"
+  "lioness_encrypt does.\n";
+
+PyObject*
+mm_bear_decrypt(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        return lioness_or_bear_fn(args, kwdict, "OO:bear_decrypt", 2, 0);
+}
+
 const char mm_strxor__doc__[]=
   "strxor(str1, str2) -> str\n\n"
   "Computes the bitwise xor of two equally-long strings.  Throws TypeError\n"
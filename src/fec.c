@@ -150,6 +150,16 @@ static gf gf_mul_table[GF_SIZE + 1][GF_SIZE + 1];
 #define GF_MULC0(c) __gf_mulc_ = gf_mul_table[c]
 #define GF_ADDMULC(dst, x) dst ^= __gf_mulc_[x]
 
+#if (GF_BITS == 8)
+/*
+ * Split-nibble tables: c*x == gf_mul_lo[c][x & 15] ^ gf_mul_hi[c][x >> 4].
+ * Each row is 16 bytes, so a row fits in one SSE register, and PSHUFB can
+ * do 16 (or 32) table lookups at once.
+ */
+static gf gf_mul_lo[GF_SIZE + 1][16];
+static gf gf_mul_hi[GF_SIZE + 1][16];
+#endif
+
 static void
 init_mul_table()
 {
@@ -160,6 +170,14 @@ init_mul_table()
 
     for (j=0; j< GF_SIZE+1; j++)
 	    gf_mul_table[0][j] = gf_mul_table[j][0] = 0;
+
+#if (GF_BITS == 8)
+    for (i=0; i< GF_SIZE+1; i++)
+	for (j=0; j<16; j++) {
+	    gf_mul_lo[i][j] = gf_mul_table[i][j];
+	    gf_mul_hi[i][j] = gf_mul_table[i][j << 4];
+	}
+#endif
 }
 #else	/* GF_BITS > 8 */
 static INLINE gf
@@ -288,7 +306,7 @@ generate_gf(void)
  * Note that gcc on
  */
 #define addmul(dst, src, c, sz) \
-    if (c != 0) addmul1(dst, src, c, sz)
+    if (c != 0) addmul_impl(dst, src, c, sz)
 
 #define UNROLL 16 /* 1, 4, 8, 16 */
 static void
@@ -329,6 +347,96 @@ addmul1(gf *dst1, gf *src1, gf c, int sz)
 	GF_ADDMULC( *dst , *src );
 }
 
+#if (GF_BITS == 8)
+/*
+ * addmul_words() is addmul1() for machines without a byte shuffle: it still
+ * looks up one byte at a time, but reads and writes dst a word at a time.
+ * (We go through memcpy so that unaligned buffers are safe.)
+ */
+static void
+addmul_words(gf *dst, gf *src, gf c, int sz)
+{
+    const gf *t = gf_mul_table[c];
+    unsigned int a[2], b[2];
+    gf p[8];
+
+    for (; sz >= 8; sz -= 8, src += 8, dst += 8) {
+	p[0] = t[src[0]]; p[1] = t[src[1]]; p[2] = t[src[2]];
+	p[3] = t[src[3]]; p[4] = t[src[4]]; p[5] = t[src[5]];
+	p[6] = t[src[6]]; p[7] = t[src[7]];
+	memcpy(a, dst, 8);
+	memcpy(b, p, 8);
+	a[0] ^= b[0];
+	a[1] ^= b[1];
+	memcpy(dst, a, 8);
+    }
+    for (; sz > 0; --sz)
+	*dst++ ^= t[*src++];
+}
+
+/*
+ * On x86 with a recent enough GCC or clang, we can build SSSE3 and AVX2
+ * versions of addmul using the split-nibble tables, and pick one at
+ * runtime based on what the CPU supports.
+ */
+#if (defined(__x86_64__) || defined(__i386__)) && \
+    (defined(__clang__) || \
+     (defined(__GNUC__) && (__GNUC__ > 4 || \
+                            (__GNUC__ == 4 && __GNUC_MINOR__ >= 9)))) && \
+    !defined(MM_NO_SIMD_FEC)
+#define USE_SIMD_FEC
+#include <immintrin.h>
+
+__attribute__((target("ssse3"))) static void
+addmul_ssse3(gf *dst, gf *src, gf c, int sz)
+{
+    __m128i lo = _mm_loadu_si128((const __m128i*)gf_mul_lo[c]);
+    __m128i hi = _mm_loadu_si128((const __m128i*)gf_mul_hi[c]);
+    __m128i mask = _mm_set1_epi8(0x0f);
+    __m128i x, p;
+    const gf *t = gf_mul_table[c];
+
+    for (; sz >= 16; sz -= 16, src += 16, dst += 16) {
+	x = _mm_loadu_si128((const __m128i*)src);
+	p = _mm_xor_si128(
+		_mm_shuffle_epi8(lo, _mm_and_si128(x, mask)),
+		_mm_shuffle_epi8(hi, _mm_and_si128(_mm_srli_epi64(x, 4), mask)));
+	p = _mm_xor_si128(p, _mm_loadu_si128((const __m128i*)dst));
+	_mm_storeu_si128((__m128i*)dst, p);
+    }
+    for (; sz > 0; --sz)
+	*dst++ ^= t[*src++];
+}
+
+__attribute__((target("avx2"))) static void
+addmul_avx2(gf *dst, gf *src, gf c, int sz)
+{
+    __m256i lo = _mm256_broadcastsi128_si256(
+		    _mm_loadu_si128((const __m128i*)gf_mul_lo[c]));
+    __m256i hi = _mm256_broadcastsi128_si256(
+		    _mm_loadu_si128((const __m128i*)gf_mul_hi[c]));
+    __m256i mask = _mm256_set1_epi8(0x0f);
+    __m256i x, p;
+    const gf *t = gf_mul_table[c];
+
+    for (; sz >= 32; sz -= 32, src += 32, dst += 32) {
+	x = _mm256_loadu_si256((const __m256i*)src);
+	p = _mm256_xor_si256(
+	      _mm256_shuffle_epi8(lo, _mm256_and_si256(x, mask)),
+	      _mm256_shuffle_epi8(hi,
+			_mm256_and_si256(_mm256_srli_epi64(x, 4), mask)));
+	p = _mm256_xor_si256(p, _mm256_loadu_si256((const __m256i*)dst));
+	_mm256_storeu_si256((__m256i*)dst, p);
+    }
+    for (; sz > 0; --sz)
+	*dst++ ^= t[*src++];
+}
+#endif
+#endif
+
+/* The addmul implementation we're using; chosen by init_fec(). */
+static void (*addmul_impl)(gf *dst, gf *src, gf c, int sz) = addmul1;
+
 /*
  * computes C = AB where A is n*k, B is k*m, C is n*m
  */
@@ -551,6 +659,16 @@ init_fec()
 {
     generate_gf();
     init_mul_table();
+#if (GF_BITS == 8)
+    addmul_impl = addmul_words;
+#ifdef USE_SIMD_FEC
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("avx2"))
+	addmul_impl = addmul_avx2;
+    else if (__builtin_cpu_supports("ssse3"))
+	addmul_impl = addmul_ssse3;
+#endif
+#endif
     fec_initialized = 1 ;
 }
 
@@ -662,6 +780,34 @@ fec_encode(struct fec_parms *code, gf *src[], gf *fec, int index, int sz)
 	    index, code->n - 1 );
 }
 
+/*
+ * fec_encode_all is like calling fec_encode for every index from k to n-1,
+ * storing the results in fec[0]..fec[n-k-1].  It works through the packets
+ * a stripe at a time, so that each stripe of the sources stays in cache
+ * while we compute every output from it.
+ */
+#define FEC_STRIPE 4096
+static void
+fec_encode_all(struct fec_parms *code, gf *src[], gf *fec[], int sz)
+{
+    int i, j, off, len, k = code->k, n = code->n ;
+    gf *p ;
+
+    if (GF_BITS > 8)
+	sz /= 2 ;
+
+    for (j = 0; j < n - k; j++)
+	memset(fec[j], 0, sz*sizeof(gf));
+    for (off = 0; off < sz; off += FEC_STRIPE) {
+	len = (sz - off < FEC_STRIPE) ? sz - off : FEC_STRIPE;
+	for (j = 0; j < n - k; j++) {
+	    p = &(code->enc_matrix[(j+k)*k]);
+	    for (i = 0; i < k; i++)
+		addmul(fec[j] + off, src[i] + off, p[i], len) ;
+	}
+    }
+}
+
 static int
 shuffle(PyObject *pkt[], int index[], int k)
 {
@@ -859,77 +1005,101 @@ mm_FEC_getParameters(PyObject *self, PyObject *args, PyObject *kwargs)
         return Py_BuildValue("ii", fec->k, fec->n);
 }
 
-static const char mm_FEC_encode__doc__[] =
-"fec.encode(idx,[blocks...])\n\n"
-"Encode a single block of FEC-encoded data.  'idx' is the index of the block\n"
-"to return (0<=idx<N), and 'blocks' is a list of K strings of equal length,\n"
-"containing the original string to encode.";
-
-static PyObject *
-mm_FEC_encode(PyObject *self, PyObject *args, PyObject *kwargs)
+/* Helper: Check whether 'blocks' is a sequence of K equally sized strings.
+ * If so, set *tup to a new tuple holding the strings, *stringPtrs to a
+ * newly allocated array of pointers to their contents, and *sz to their
+ * length, and return 0.  Otherwise, raise FECError and return -1.
+ */
+static int
+get_source_blocks(struct fec_parms *fec, PyObject *blocks, PyObject **tup,
+                  char ***stringPtrs, int *sz)
 {
-	static char *kwlist[] = { "idx", "blocks", NULL };
-        struct fec_parms *fec;
-	int idx;
-	PyObject *blocks;
-
-        int sz = -1;
         int i;
         PyObject *o;
 
-        PyObject *tup = NULL;
-        char **stringPtrs = NULL;
-        PyObject *result = NULL;
-
-        if (!PyArg_ParseTupleAndKeywords(args, kwargs,
-                                         "iO:encode", kwlist,
-					 &idx, &blocks))
-                return NULL;
+        *tup = NULL;
+        *stringPtrs = NULL;
+        *sz = -1;
 
-        fec = ((mm_FEC*)self)->fec;
-
-        /* Check whether the second arg is a sequence of K equally sized
-         * strings. */
         if (!PySequence_Check(blocks)) {
                 PyErr_SetString(mm_FECError, "encode expects a sequence");
-                return NULL;
+                return -1;
         }
         if (PySequence_Size(blocks) != fec->k) {
                 PyErr_SetString(mm_FECError,
                                 "encode expects a list of length K");
-                return NULL;
-        }
-        if (idx < 0 || idx >= fec->n) {
-                PyErr_SetString(mm_FECError, "idx out of bounds");
-                return NULL;
+                return -1;
         }
 
         /* We hold onto the sequence as a tuple to prevent it changing
          * out from under us, and to temporarily incref all the strings.
          */
-        if (!(tup = PySequence_Tuple(blocks))) {
-                return NULL;
+        if (!(*tup = PySequence_Tuple(blocks))) {
+                return -1;
         }
-        if (!(stringPtrs = malloc((sizeof(gf*))*fec->k))) {
+        if (!(*stringPtrs = malloc((sizeof(gf*))*fec->k))) {
                 PyErr_NoMemory();
                 goto err;
         }
         for (i = 0; i < fec->k; ++i) {
-                o = PyTuple_GET_ITEM(tup, i);
+                o = PyTuple_GET_ITEM(*tup, i);
                 if (!PyString_Check(o)) {
                         PyErr_SetString(mm_FECError,
                                         "encode expects a list of strings");
                         goto err;
                 }
-                if (sz<0)
-                        sz = PyString_Size(o);
-                else if (sz != PyString_Size(o)) {
+                if (*sz<0)
+                        *sz = PyString_Size(o);
+                else if (*sz != PyString_Size(o)) {
                         PyErr_SetString(mm_FECError,
                               "encode expects a list of equally long strings");
                         goto err;
                 }
-                stringPtrs[i] = PyString_AS_STRING(o);
+                (*stringPtrs)[i] = PyString_AS_STRING(o);
         }
+        return 0;
+ err:
+        if (*stringPtrs)
+                free(*stringPtrs);
+        Py_XDECREF(*tup);
+        *stringPtrs = NULL;
+        *tup = NULL;
+        return -1;
+}
+
+static const char mm_FEC_encode__doc__[] =
+"fec.encode(idx,[blocks...])\n\n"
+"Encode a single block of FEC-encoded data.  'idx' is the index of the block\n"
+"to return (0<=idx<N), and 'blocks' is a list of K strings of equal length,\n"
+"containing the original string to encode.";
+
+static PyObject *
+mm_FEC_encode(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	static char *kwlist[] = { "idx", "blocks", NULL };
+        struct fec_parms *fec;
+	int idx;
+	PyObject *blocks;
+
+        int sz;
+
+        PyObject *tup = NULL;
+        char **stringPtrs = NULL;
+        PyObject *result = NULL;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                         "iO:encode", kwlist,
+					 &idx, &blocks))
+                return NULL;
+
+        fec = ((mm_FEC*)self)->fec;
+
+        if (idx < 0 || idx >= fec->n) {
+                PyErr_SetString(mm_FECError, "idx out of bounds");
+                return NULL;
+        }
+        if (get_source_blocks(fec, blocks, &tup, &stringPtrs, &sz))
+                return NULL;
 
         /* We could pull this up, but it's good to do all the checking. */
         if (idx < fec->k) {
@@ -960,6 +1130,78 @@ mm_FEC_encode(PyObject *self, PyObject *args, PyObject *kwargs)
 	return NULL;
 }
 
+static const char mm_FEC_encodeAll__doc__[] =
+"fec.encodeAll([blocks...]) -> list\n\n"
+"Encode all N blocks of FEC-encoded data at once.  'blocks' is a list of K\n"
+"strings of equal length, containing the original string to encode.\n"
+"Returns a list of N strings, where the i'th is fec.encode(i, blocks).\n"
+"This is faster than calling encode N times.";
+
+static PyObject *
+mm_FEC_encodeAll(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	static char *kwlist[] = { "blocks", NULL };
+        struct fec_parms *fec;
+	PyObject *blocks;
+
+        int sz, i;
+        PyObject *o;
+
+        PyObject *tup = NULL;
+        char **stringPtrs = NULL;
+        char **outPtrs = NULL;
+        PyObject *result = NULL;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                         "O:encodeAll", kwlist,
+					 &blocks))
+                return NULL;
+
+        fec = ((mm_FEC*)self)->fec;
+
+        if (get_source_blocks(fec, blocks, &tup, &stringPtrs, &sz))
+                return NULL;
+
+        if (!(result = PyList_New(fec->n)))
+                goto err;
+        /* The first K blocks are the input. */
+        for (i = 0; i < fec->k; ++i) {
+                o = PyTuple_GET_ITEM(tup, i);
+                Py_INCREF(o);
+                PyList_SET_ITEM(result, i, o);
+        }
+        if (fec->n > fec->k &&
+            !(outPtrs = malloc(sizeof(gf*)*(fec->n - fec->k)))) {
+                PyErr_NoMemory(); goto err;
+        }
+        for (i = fec->k; i < fec->n; ++i) {
+                if (!(o = PyString_FromStringAndSize(NULL, sz)))
+                        goto err;
+                PyList_SET_ITEM(result, i, o);
+                outPtrs[i - fec->k] = PyString_AS_STRING(o);
+        }
+
+        if (fec->n > fec->k) {
+                Py_BEGIN_ALLOW_THREADS
+                fec_encode_all(fec, (gf**)stringPtrs, (gf**)outPtrs, sz);
+                Py_END_ALLOW_THREADS
+        }
+
+        Py_DECREF(tup);
+        free(stringPtrs);
+        if (outPtrs)
+                free(outPtrs);
+        return result;
+ err:
+        if (stringPtrs)
+                free(stringPtrs);
+        if (outPtrs)
+                free(outPtrs);
+        Py_XDECREF(tup);
+        Py_XDECREF(result);
+	return NULL;
+}
+
 static const char mm_FEC_decode__doc__[] =
  "fec.decode([ (idx1,block1), (idx2, block2), ...])\n\n"
  "Recover a FEC-encoded string.  This methods expects as input a list of\n"
@@ -1103,6 +1345,7 @@ mm_FEC_decode(PyObject *self, PyObject *args, PyObject *kwargs)
 static PyMethodDef mm_FEC_methods[] = {
         METHOD(mm_FEC, getParameters),
         METHOD(mm_FEC, encode),
+        METHOD(mm_FEC, encodeAll),
         METHOD(mm_FEC, decode),
         { NULL, NULL }
 };
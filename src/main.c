@@ -55,6 +55,10 @@ static struct PyMethodDef _mixcryptlib_functions[] = {
         ENTRY(aes_key),
         ENTRY(aes_ctr128_crypt),
         ENTRY(aes128_block_crypt),
+        ENTRY(lioness_encrypt),
+        ENTRY(lioness_decrypt),
+        ENTRY(bear_encrypt),
+        ENTRY(bear_decrypt),
         ENTRY(strxor),
         ENTRY(openssl_seed),
         ENTRY(openssl_rand),
@@ -191,6 +195,12 @@ init_minionlib(void)
         if (PyDict_SetItemString(d, "POLL_IS_EMULATED",
                                  PyInt_FromLong(POLL_IS_EMULATED)))
                 return;
+
+        /* Which cipher suites we can negotiate depends on the version of
+         * OpenSSL we were built with. */
+        if (PyDict_SetItemString(d, "OPENSSL_VERSION_NUMBER",
+                                 PyInt_FromLong(OPENSSL_VERSION_NUMBER)))
+                return;
 }
 
 /*
@@ -33,6 +33,20 @@ char mm_TLSClosed__doc__[] =
 "Exception raised when a connection is unexpectedly closed.\n";
 PyObject *mm_TLSClosed = NULL;
 
+/* The cipher suites we offer and accept, in order of preference.  When
+ * both sides are new enough, we negotiate an ephemeral ECDH key exchange
+ * with an AEAD cipher; otherwise we fall back to the original MMTP
+ * suite, DHE-RSA with AES128-SHA, which every older peer supports. */
+#if (OPENSSL_VERSION_NUMBER >= 0x10001000L)
+#define MM_TLS_CIPHERS                          \
+        "ECDHE-RSA-AES128-GCM-SHA256:"          \
+        "ECDHE-RSA-CHACHA20-POLY1305:"          \
+        "ECDHE-RSA-AES256-GCM-SHA384:"          \
+        TLS1_TXT_DHE_RSA_WITH_AES_128_SHA
+#else
+#define MM_TLS_CIPHERS TLS1_TXT_DHE_RSA_WITH_AES_128_SHA
+#endif
+
 /* Convenience macro to set a type error with a given string. */
 #define TYPE_ERR(s) PyErr_SetString(PyExc_TypeError, s)
 
@@ -140,24 +154,39 @@ mm_TLSContext_new(PyObject *self, PyObject *args, PyObject *kwargs)
 
         Py_BEGIN_ALLOW_THREADS;
 
-        if (certfile) {
-                /* Accept SSL2 and SSL3 and TLS1. */
-                method = SSLv23_method();
-        } else {
-                /* Generate only TLS1. */
-                method = TLSv1_method();
-        }
-        /* Allow SSL2 and SSL3 and TLS1 */
+        /* Both sides negotiate the highest version they share.  (Clients
+           used to ask only for TLS1, which ruled out the AEAD suites.) */
+        method = SSLv23_method();
         if (!(ctx = SSL_CTX_new(method)))
                 err = 1;
-        /* But not actually SSL2. */
-        if (certfile) {
-                /*SSL_CTX_set_options(ctx, SSL_OP_NO_SSLv2);*/
-                SSL_CTX_set_options(ctx, SSL_OP_SINGLE_ECDH_USE|SSL_OP_SINGLE_DH_USE|SSL_OP_NO_SSLv2|SSL_OP_NO_SSLv3);
+        /* But never SSL2 or SSL3.  We also stay below TLS 1.3, since MMTP
+           relies on renegotiation to rotate connection keys, and TLS 1.3
+           has no renegotiation. */
+        if (!err) {
+                SSL_CTX_set_options(ctx, SSL_OP_SINGLE_ECDH_USE|
+                                    SSL_OP_SINGLE_DH_USE|
+                                    SSL_OP_NO_SSLv2|SSL_OP_NO_SSLv3);
+#ifdef SSL_OP_NO_TLSv1_3
+                SSL_CTX_set_options(ctx, SSL_OP_NO_TLSv1_3);
+#endif
         }
-        if (!err && !SSL_CTX_set_cipher_list(ctx,
-                                       TLS1_TXT_DHE_RSA_WITH_AES_128_SHA))
+        if (!err && !SSL_CTX_set_cipher_list(ctx, MM_TLS_CIPHERS))
+                err = 1;
+#if (OPENSSL_VERSION_NUMBER >= 0x10002000L) && \
+    (OPENSSL_VERSION_NUMBER < 0x10100000L)
+        /* 1.1.0 and later pick an ECDHE curve on their own. */
+        if (!err && !SSL_CTX_set_ecdh_auto(ctx, 1))
                 err = 1;
+#elif (OPENSSL_VERSION_NUMBER >= 0x10001000L) && \
+      (OPENSSL_VERSION_NUMBER < 0x10100000L)
+        if (!err) {
+                EC_KEY *ecdh = EC_KEY_new_by_curve_name(NID_X9_62_prime256v1);
+                if (!ecdh || !SSL_CTX_set_tmp_ecdh(ctx, ecdh))
+                        err = 1;
+                if (ecdh)
+                        EC_KEY_free(ecdh);
+        }
+#endif
         if (!err && certfile &&
             !SSL_CTX_use_certificate_chain_file(ctx,certfile))
                 err = 1;
@@ -266,7 +295,7 @@ mm_TLSContext_sock(PyObject *self, PyObject *args, PyObject *kwargs)
                 err = 1;
 
         if (!err && serverMode && !SSL_set_cipher_list(ssl,
-                    TLS1_TXT_DHE_RSA_WITH_AES_128_SHA ":"
+                    MM_TLS_CIPHERS ":"
                     SSL3_TXT_RSA_DES_192_CBC3_SHA))
                 err = 1;
 
@@ -815,6 +844,27 @@ mm_TLSSock_get_num_bytes_raw(PyObject *self, PyObject* args, PyObject *kwargs)
         return PyInt_FromLong((long)(r+w));
 }
 
+static char mm_TLSSock_get_cipher__doc__[] =
+"tlssock.get_cipher()\n\n"
+"Return a (cipher name, protocol version) tuple for the suite negotiated\n"
+"on this connection, or None if no handshake has completed.\n";
+
+static PyObject*
+mm_TLSSock_get_cipher(PyObject *self, PyObject* args, PyObject *kwargs)
+{
+        SSL *ssl;
+        const char *name;
+        assert(mm_TLSSock_Check(self));
+        FAIL_IF_ARGS();
+        ssl = ((mm_TLSSock*)self)->ssl;
+        if (!SSL_get_current_cipher(ssl)) {
+                Py_INCREF(Py_None);
+                return Py_None;
+        }
+        name = SSL_get_cipher_name(ssl);
+        return Py_BuildValue("ss", name, SSL_get_version(ssl));
+}
+
 static PyMethodDef mm_TLSSock_methods[] = {
         METHOD(mm_TLSSock, accept),
         METHOD(mm_TLSSock, connect),
@@ -829,6 +879,7 @@ static PyMethodDef mm_TLSSock_methods[] = {
         METHOD(mm_TLSSock, do_handshake),
         METHOD(mm_TLSSock, renegotiate),
         METHOD(mm_TLSSock, get_num_bytes_raw),
+        METHOD(mm_TLSSock, get_cipher),
         METHOD(mm_TLSSock, get_cert_lifetime),
         { NULL, NULL }
 };